@@ -0,0 +1,266 @@
+'''
+消息处理管线的压测脚本：加载与main.py相同的插件，把群消息事件逐个交给NoneBot处理，
+统计吞吐量、单个事件的处理延迟和每个事件的数据库操作次数
+
+不连接QQ客户端：用一个本地的假适配器代替，call_api只记录调用并返回构造的数据。
+数据库使用临时文件，不会改动data/base_data.db
+
+用法：
+python bench.py                                  # 合成1万条群消息
+python bench.py --events 50000 --groups 500      # 调整合成事件的数量和群数
+python bench.py --replay data/debug_spool        # 回放!debug spool记录的事件（msgpack）
+'''
+import argparse
+import asyncio
+import json
+import random
+import sys
+import tempfile
+import time
+from collections import Counter
+from datetime import datetime, timedelta
+from pathlib import Path
+from typing import Any, List
+
+import msgpack
+import nonebot
+from nonebot.adapters.onebot.v11 import Adapter as OnebotAdapter, Bot, Event, GroupMessageEvent, Message
+
+import config
+
+BENCH_SELF_ID = "10000"
+BENCH_SUPERUSER = "10001"
+
+
+class BenchAdapter(OnebotAdapter):
+    """不建立任何连接的OneBot适配器，API调用只计数并返回构造的数据"""
+
+    groups: List[int] = []
+    api_calls: Counter = Counter()
+
+    @classmethod
+    def get_name(cls) -> str:
+        return "OneBot V11 Bench"
+
+    def _setup(self) -> None:
+        pass
+
+    async def _call_api(self, bot: Bot, api: str, **data: Any) -> Any:
+        self.api_calls[api] += 1
+        if api == "get_group_list":
+            return [self._group(group_id) for group_id in self.groups]
+        if api == "get_group_info":
+            return self._group(data["group_id"])
+        if api == "get_group_member_list":
+            return [self._member(data["group_id"], user_id) for user_id in range(20000, 20010)]
+        if api == "get_group_member_info":
+            return self._member(data["group_id"], data["user_id"])
+        if api == "get_stranger_info":
+            return {"user_id": data["user_id"], "nickname": "bench", "sex": "unknown", "age": 0}
+        if api == "get_login_info":
+            return {"user_id": int(bot.self_id), "nickname": "bench"}
+        if api.startswith("send_"):
+            return {"message_id": sum(self.api_calls.values())}
+        return {}
+
+    @staticmethod
+    def _group(group_id: int) -> dict:
+        return {"group_id": group_id, "group_name": f"群{group_id}", "member_count": 100, "max_member_count": 500}
+
+    @staticmethod
+    def _member(group_id: int, user_id: int) -> dict:
+        return {"group_id": group_id, "user_id": user_id, "nickname": "bench", "role": "member"}
+
+
+def make_group_message(message_id: int, group_id: int, user_id: int, text: str) -> GroupMessageEvent:
+    return GroupMessageEvent.model_validate({
+        "time": int(time.time()),
+        "self_id": int(BENCH_SELF_ID),
+        "post_type": "message",
+        "sub_type": "normal",
+        "message_type": "group",
+        "message_id": message_id,
+        "group_id": group_id,
+        "user_id": user_id,
+        "message": Message(text),
+        "original_message": Message(text),
+        "raw_message": text,
+        "font": 0,
+        "sender": {"user_id": user_id, "nickname": "bench", "role": "member"},
+        "to_me": False,
+    })
+
+
+def synthetic_events(count: int, groups: List[int], users: int, command_ratio: float, seed: int) -> List[Event]:
+    """合成群消息：大部分是普通聊天，command_ratio比例是会被插件处理的指令"""
+    rng = random.Random(seed)
+    commands = ["!test", "!plugin list"]
+    events = []
+    for i in range(count):
+        text = rng.choice(commands) if rng.random() < command_ratio else f"随便聊聊 {i}"
+        events.append(make_group_message(i + 1, rng.choice(groups), 20000 + rng.randrange(users), text))
+    return events
+
+
+def replay_events(path: Path) -> List[Event]:
+    """读取!debug spool写出的msgpack文件（可以是单个文件或目录），按序号排序"""
+    files = sorted(path.glob("events*.msgpack")) if path.is_dir() else [path]
+    records = []
+    for file in files:
+        with open(file, "rb") as f:
+            records.extend(msgpack.Unpacker(f, raw=False))
+    records.sort(key=lambda record: record["seq"])
+    events = []
+    for record in records:
+        event = OnebotAdapter.json_to_event(record["event"])
+        if event is not None:
+            events.append(event)
+    return events
+
+
+async def run_bot_hooks(action, bot: Bot):
+    """调用adapter.bot_connect/bot_disconnect，并等待它触发的连接/断开钩子执行完毕
+
+    NoneBot在新任务中执行这些钩子，没有提供等待它们的接口；
+    bot_connect/bot_disconnect是同步方法，调用前后新出现的任务就是执行钩子的任务
+    """
+    before = asyncio.all_tasks()
+    action(bot)
+    # 钩子中的异常由NoneBot记录日志
+    await asyncio.gather(*(asyncio.all_tasks() - before), return_exceptions=True)
+
+
+def percentile(sorted_values: List[float], p: float) -> float:
+    if not sorted_values:
+        return 0.0
+    index = min(len(sorted_values) - 1, int(round(p / 100 * (len(sorted_values) - 1))))
+    return sorted_values[index]
+
+
+async def run(args: argparse.Namespace) -> dict:
+    from nonebot.message import handle_event
+    from utils.database.database_manager import DatabaseManager
+    from utils.database.group_db import GroupDatabase
+
+    driver = nonebot.get_driver()
+    db = DatabaseManager()
+
+    adapter = BenchAdapter(driver)
+    bot = Bot(adapter, BENCH_SELF_ID)
+    await run_bot_hooks(adapter.bot_connect, bot)
+
+    # 按比例给群授权，让插件检查走完整流程
+    group_db = GroupDatabase()
+    authed = BenchAdapter.groups[:int(len(BenchAdapter.groups) * args.authed_ratio)]
+    for group_id in authed:
+        await group_db.set_group_auth(str(group_id), "BENCH", 30, expires=datetime.now() + timedelta(days=30))
+
+    if args.replay:
+        events = replay_events(Path(args.replay))
+    else:
+        events = synthetic_events(args.events, BenchAdapter.groups, args.users, args.command_ratio, args.seed)
+    if not events:
+        raise SystemExit("没有可回放的事件")
+
+    for event in events[:args.warmup]:
+        await handle_event(bot, event)
+
+    latencies: List[float] = []
+    semaphore = asyncio.Semaphore(args.concurrency)
+
+    async def handle(event: Event):
+        async with semaphore:
+            start = time.perf_counter()
+            await handle_event(bot, event)
+            latencies.append(time.perf_counter() - start)
+
+    db.counters.clear()
+    BenchAdapter.api_calls.clear()
+    start = time.perf_counter()
+    await asyncio.gather(*(handle(event) for event in events))
+    elapsed = time.perf_counter() - start
+    counters = dict(db.counters)
+    api_calls = dict(BenchAdapter.api_calls)
+
+    await run_bot_hooks(adapter.bot_disconnect, bot)
+
+    latencies.sort()
+    return {
+        "events": len(events),
+        "elapsed": elapsed,
+        "events_per_sec": len(events) / elapsed,
+        "p50_ms": percentile(latencies, 50) * 1000,
+        "p99_ms": percentile(latencies, 99) * 1000,
+        "max_ms": latencies[-1] * 1000,
+        "db_queries_per_event": counters.get("query", 0) / len(events),
+        "db_writes_per_event": counters.get("write", 0) / len(events),
+        "db_commits": counters.get("commit", 0),
+        "api_calls": api_calls,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description="消息处理管线压测")
+    parser.add_argument("--events", type=int, default=10000, help="合成事件数")
+    parser.add_argument("--groups", type=int, default=200, help="合成事件的群数")
+    parser.add_argument("--users", type=int, default=1000, help="合成事件的用户数")
+    parser.add_argument("--command-ratio", type=float, default=0.05, help="合成事件中指令的比例")
+    parser.add_argument("--authed-ratio", type=float, default=0.5, help="已授权群的比例")
+    parser.add_argument("--replay", help="回放!debug spool写出的msgpack文件或目录")
+    parser.add_argument("--concurrency", type=int, default=1, help="同时处理的事件数")
+    parser.add_argument("--warmup", type=int, default=200, help="预热事件数，不计入统计")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--log-level", default="WARNING")
+    parser.add_argument("--json", action="store_true", help="以JSON输出结果")
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as tmp:
+        db_path = Path(tmp) / "bench.db"
+
+        nonebot.init(driver="~none", log_level=args.log_level, superusers={BENCH_SUPERUSER},
+                     command_start={""}, command_sep={" "})
+        nonebot.get_driver().register_adapter(BenchAdapter)
+
+        # DatabaseManager是单例，必须在加载插件之前用临时路径创建
+        from utils.database.database_manager import DatabaseManager
+        DatabaseManager(db_path=db_path)
+
+        nonebot.load_builtin_plugins("echo")
+        nonebot.load_plugins("kernel")
+        for model in config.plugins:
+            nonebot.load_plugin("plugins." + model)
+
+        BenchAdapter.groups = [100000 + i for i in range(args.groups)]
+        driver = nonebot.get_driver()
+        results = []
+
+        # 启动钩子按注册顺序依次执行，这个钩子最后注册，运行时其他插件都已启动完毕；
+        # 压测在单独的任务中进行，结束后通知驱动退出，由驱动执行各插件的关闭钩子
+        @driver.on_startup
+        async def _():
+            async def bench():
+                try:
+                    results.append(await run(args))
+                finally:
+                    driver.should_exit.set()
+
+            asyncio.get_running_loop().create_task(bench())
+
+        nonebot.run()
+        if not results:
+            raise SystemExit("压测未完成，见上方日志")
+        result = results[0]
+
+    if args.json:
+        print(json.dumps(result, ensure_ascii=False))
+        return
+    print(f"事件数: {result['events']}，并发: {args.concurrency}，用时: {result['elapsed']:.2f}s")
+    print(f"吞吐量: {result['events_per_sec']:.0f} 事件/秒")
+    print(f"延迟: p50 {result['p50_ms']:.3f}ms，p99 {result['p99_ms']:.3f}ms，最大 {result['max_ms']:.3f}ms")
+    print(f"数据库: 每事件查询 {result['db_queries_per_event']:.3f} 次，"
+          f"写入 {result['db_writes_per_event']:.3f} 次，共提交 {result['db_commits']} 次")
+    print("API调用: " + ("，".join(f"{api} {count}" for api, count in sorted(result["api_calls"].items())) or "无"))
+
+
+if __name__ == "__main__":
+    sys.exit(main())
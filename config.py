@@ -1,6 +1,15 @@
 ver_kernel = "2504182328"
 ver_plugin = "2405051200"
 
+# 数据库连接池大小
+db_pool_size = 4
+# 数据库合并提交：单次提交的最大写操作数、攒批的最长等待时间（秒）
+db_write_batch_size = 256
+db_write_batch_delay = 0.002
+# 数据库同步模式：FULL每次提交都fsync；改为NORMAL时只在WAL检查点fsync，写入更快，
+# 但断电时最近已确认的提交可能丢失
+db_synchronous = "FULL"
+
 plugins = [
     "normalmodel"
 ]
\ No newline at end of file
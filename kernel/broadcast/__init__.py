@@ -3,22 +3,83 @@ from nonebot.adapters import Message
 from nonebot.plugin import PluginMetadata
 from nonebot.adapters.onebot.v11 import PrivateMessageEvent
 from nonebot.params import CommandArg
-from nonebot import logger
 
-from typing import List
-from asyncio import sleep
-from random import randint, random
+import re
+from random import randint
+from typing import Tuple
+from uuid import uuid4
 
 from utils.qqdata import ApiGetGroupList
+from utils.database.group_db import GroupDatabase
+from utils.database.outbox_db import OutboxDatabase
+from .engine import BroadcastOptions
+from .outbox import OutboxDispatcher
 
 __plugin_meta__ = PluginMetadata(
     name="[kernel]群组广播",
-    description="向所有群组发送广播消息",
-    usage="（超级管理员、仅限私聊）!broadcast <消息内容>",
+    description="向群组发送广播消息",
+    usage='''
+（超级管理员、仅限私聊）!broadcast [选项] <消息内容>
+选项（可组合，不加选项时发送到所有群）：
+  --authed - 仅授权未过期的群
+  --plugin <插件名> - 仅启用了该插件的群
+  --expiring <天数> - 仅授权在该天数内到期的群
+'''.strip(),
     type="application",
     config=None,
 )
 
+# 主动发送的消息统一经过发件箱，由发送器在后台限速发送，进程重启后继续发送未完成的部分
+# 并发数、速率、重试等参数可在.env中以broadcast_*配置
+driver = get_driver()
+outbox_db = OutboxDatabase()
+group_db = GroupDatabase()
+dispatcher = OutboxDispatcher(outbox_db, BroadcastOptions.from_config(driver.config))
+
+
+@driver.on_bot_connect
+async def _(bot: Bot):
+    dispatcher.start(bot)
+
+
+@driver.on_bot_disconnect
+async def _(bot: Bot):
+    await dispatcher.stop()
+
+
+@driver.on_shutdown
+async def _():
+    # 关闭时bot不一定先断开，在这里停止，让这一轮的结果在数据库关闭前写回
+    await dispatcher.stop()
+
+
+_OPTION_PATTERN = re.compile(r"^\s*--(authed|plugin|expiring)(?=\s|$)(?:\s+(\S+))?")
+
+
+def parse_broadcast_args(argline: str) -> Tuple[dict, str]:
+    """解析消息开头的--选项，返回(筛选条件, 消息内容)"""
+    filters = {}
+    while True:
+        match = _OPTION_PATTERN.match(argline)
+        if not match:
+            break
+        name, value = match.groups()
+        if name == "authed":
+            filters["authed_only"] = True
+            argline = argline[match.end(1):]
+            continue
+        if value is None:
+            raise ValueError(f"选项--{name}缺少参数")
+        if name == "plugin":
+            filters["plugin"] = value
+        else:
+            if not value.isdigit():
+                raise ValueError("--expiring的参数必须是天数")
+            filters["expiring_days"] = int(value)
+        argline = argline[match.end():]
+    return filters, argline.strip()
+
+
 # 不在这里加权限控制的原因是如果权限不足需要提示用户
 sv_broadcast = on_command(("!广播", "!broadcast"))
 
@@ -27,30 +88,33 @@ async def _(bot: Bot, ev: PrivateMessageEvent, args: Message=CommandArg()):
     # 条件检查
     if ev.get_user_id() not in get_driver().config.superusers:
         await sv_broadcast.finish("权限不足")
-    argline = args.extract_plain_text()
+    try:
+        filters, argline = parse_broadcast_args(args.extract_plain_text())
+    except ValueError as e:
+        await sv_broadcast.finish(str(e))
     if not argline:
         await sv_broadcast.finish("广播内容为空")
 
-    group_list = await ApiGetGroupList(bot)
-    group_num_list : List[int] = []
-    for group in group_list:
-        group_num_list.append(group.group_id)
-
-    await sv_broadcast.send(f'开始推送')
+    # 机器人当前所在的群（缓存）与数据库筛选结果取交集，不符合条件的群不占用发送速率
+    group_ids = [str(group.group_id) for group in await ApiGetGroupList(bot)]
+    if filters:
+        selected = set(await group_db.select_groups(**filters))
+        group_ids = [group_id for group_id in group_ids if group_id in selected]
+    if not group_ids:
+        await sv_broadcast.finish("没有符合条件的群")
 
-    succeed = 0
-    failed = 0
-    for group in group_num_list:
-        message = f"{argline}\n随机数防暴毙：{randint(100000, 999999)}"
-
-        message_id = await bot.call_api('send_msg', group_id=group, message=message)
-        if message_id:
-            succeed += 1
-            logger.info(f'向{group}推送消息成功')
-        else:
-            failed += 1
-            logger.warning(f'向{group}推送消息失败')
-            await sv_broadcast.send(f'向{group}推送消息失败')
-        await sleep(random() * 5)
+    batch_id = f"broadcast:{uuid4().hex}"
+    count = await outbox_db.enqueue_batch(
+        batch_id,
+        (("group", group_id, f"{argline}\n随机数防暴毙：{randint(100000, 999999)}") for group_id in group_ids),
+        description=argline[:20],
+        notify_type="private",
+        notify_id=ev.get_user_id(),
+        max_attempts=dispatcher.options.retries + 1
+    )
+    dispatcher.wake()
 
-    await sv_broadcast.send(f'推送完成，共计向{len(group_num_list)}个群推送了消息\n成功{succeed}个\n失败{failed}个')
+    options = dispatcher.options
+    await sv_broadcast.finish(
+        f'已加入发送队列，共{count}个群，并发{options.concurrency}，速率{options.rate}条/秒\n完成后将发送汇总'
+    )
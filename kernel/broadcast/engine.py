@@ -0,0 +1,50 @@
+from dataclasses import dataclass, field
+from typing import Any, Dict, List
+
+
+@dataclass
+class BroadcastOptions:
+    concurrency: int = 4        # 同时进行的发送数
+    rate: float = 1.0           # 每秒最多发送的消息数（含重试）
+    burst: int = 1              # 令牌桶容量，允许短时间内突发的消息数
+    jitter: float = 0.0         # 每次发送前额外随机等待的最大秒数，0为不等待
+    retries: int = 2            # 单条消息失败后的重试次数
+    backoff: float = 2.0        # 首次重试前等待的秒数，之后每次翻倍
+
+    @classmethod
+    def from_config(cls, config: Any) -> "BroadcastOptions":
+        """从nonebot配置（.env）中读取broadcast_*配置项，未配置的使用默认值"""
+        options = cls()
+        for name in cls.__dataclass_fields__:
+            value = getattr(config, f"broadcast_{name}", None)
+            if value is not None:
+                setattr(options, name, type(getattr(options, name))(value))
+        if options.rate <= 0:
+            raise ValueError(f"broadcast_rate必须大于0，当前为{options.rate}")
+        if options.burst < 1:
+            raise ValueError(f"broadcast_burst不能小于1，当前为{options.burst}")
+        if options.concurrency < 1:
+            raise ValueError(f"broadcast_concurrency不能小于1，当前为{options.concurrency}")
+        return options
+
+
+@dataclass
+class BroadcastReport:
+    total: int = 0
+    succeeded: List[int] = field(default_factory=list)
+    failed: Dict[int, str] = field(default_factory=dict)   # 群号 -> 最后一次失败原因
+    retried: int = 0
+    elapsed: float = 0.0
+
+    def summary(self, max_failed: int = 20) -> str:
+        lines = [
+            f"推送完成，共计向{self.total}个群推送了消息，用时{self.elapsed:.1f}秒" if self.elapsed else
+            f"推送完成，共计向{self.total}个群推送了消息",
+            f"成功{len(self.succeeded)}个",
+            f"失败{len(self.failed)}个（重试{self.retried}次）",
+        ]
+        for group_id, reason in list(self.failed.items())[:max_failed]:
+            lines.append(f"  {group_id}: {reason}")
+        if len(self.failed) > max_failed:
+            lines.append(f"  ……其余{len(self.failed) - max_failed}个见日志")
+        return "\n".join(lines)
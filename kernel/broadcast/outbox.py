@@ -0,0 +1,157 @@
+import asyncio
+import time
+from datetime import datetime, timezone
+from random import random
+from typing import Optional
+
+from nonebot import Bot, logger
+
+from utils.database.outbox_db import OutboxDatabase
+from utils.ratelimit import TokenBucket
+from .engine import BroadcastOptions, BroadcastReport
+
+OUTBOX_MIN_LEASE = 300.0    # 取出的消息至少保留多久（秒），超过后未写回结果的消息重新发送
+
+
+class OutboxDispatcher:
+    """发件箱发送器
+
+    后台任务每次从outbox表取出最多batch_size条到期消息，
+    以最多concurrency个并发、令牌桶限速发送，结果在一个事务内写回。
+    失败的消息按指数退避重新排队，重试耗尽标记为failed；
+    一个批次全部结束后，向登记的通知对象发送一条汇总。
+    进程在一轮发送中途退出时，这一轮的消息会在重启后重新发送（至少一次）；
+    写回结果失败时，这一轮的消息在租约到期后重新发送
+    """
+
+    def __init__(self, outbox_db: OutboxDatabase, options: BroadcastOptions,
+                 batch_size: int = 50, poll_interval: float = 1.0):
+        self.outbox_db = outbox_db
+        self.options = options
+        self.batch_size = batch_size
+        self.poll_interval = poll_interval
+        self.bot: Optional[Bot] = None
+        self._bucket = TokenBucket(options.rate, options.burst)
+        # 租约要比一轮发送的时间长得多，否则还在发送的消息会被重复取出
+        self.lease = max(OUTBOX_MIN_LEASE, 4 * batch_size / options.rate)
+        self._task: Optional[asyncio.Task] = None
+        self._wakeup = asyncio.Event()
+        self._stopping = False
+
+    def start(self, bot: Bot):
+        self.bot = bot
+        self._stopping = False
+        if self._task is None or self._task.done():
+            self._task = asyncio.get_running_loop().create_task(self._run())
+
+    async def stop(self, timeout: float = 10):
+        """等待当前这一轮发送结束并写回结果后停止，超时则直接取消"""
+        if self._task is None:
+            return
+        self._stopping = True
+        self._wakeup.set()
+        try:
+            await asyncio.wait_for(self._task, timeout)
+        except (asyncio.TimeoutError, asyncio.CancelledError):
+            pass
+        self._task = None
+        self.bot = None
+
+    def wake(self):
+        """有新消息入队时调用，立即开始发送而不必等到下一次轮询"""
+        self._wakeup.set()
+
+    async def _run(self):
+        await self.outbox_db.initialize()
+        await self.outbox_db.reset_inflight()
+        await self.outbox_db.purge_sent()
+        while not self._stopping:
+            try:
+                sent = await self._dispatch_once()
+                if sent:
+                    continue
+                await self._notify_finished_batches()
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                logger.error(f"发件箱发送失败: {str(e)}")
+            await self._sleep_until_due()
+
+    async def _sleep_until_due(self):
+        if self._stopping:
+            return
+        # 先清除再查询，查询期间到来的wake不会丢失
+        self._wakeup.clear()
+        timeout = self.poll_interval
+        due = await self.outbox_db.next_due_time()
+        if due is not None:
+            timeout = min(timeout, max(due - time.time(), 0))
+        try:
+            await asyncio.wait_for(self._wakeup.wait(), timeout)
+        except asyncio.TimeoutError:
+            pass
+
+    async def _dispatch_once(self) -> int:
+        """发送一轮，返回本轮取出的消息数"""
+        rows = await self.outbox_db.claim(self.batch_size, time.time(), self.lease)
+        if not rows:
+            return 0
+
+        semaphore = asyncio.Semaphore(self.options.concurrency)
+        sent, retry, failed = [], [], []
+
+        async def send(row: dict):
+            async with semaphore:
+                error = await self._send(row)
+            if error is None:
+                sent.append(row["id"])
+                return
+            attempts = row["attempts"] + 1
+            logger.warning(f"向{row['target_type']} {row['target_id']}发送消息失败（第{attempts}次）：{error}")
+            if attempts >= row["max_attempts"]:
+                failed.append((error, row["id"]))
+            else:
+                retry.append((error, time.time() + self.options.backoff * 2 ** (attempts - 1), row["id"]))
+
+        await asyncio.gather(*(send(row) for row in rows))
+        await self.outbox_db.complete(sent, retry, failed)
+        return len(rows)
+
+    async def _send(self, row: dict) -> Optional[str]:
+        """发送一条消息，成功返回None，失败返回原因"""
+        if self.bot is None:
+            return "bot未连接"
+        await self._bucket.acquire()
+        if self.options.jitter > 0:
+            await asyncio.sleep(random() * self.options.jitter)
+        target = {"group_id": row["target_id"]} if row["target_type"] == "group" else {"user_id": row["target_id"]}
+        try:
+            message_id = await self.bot.call_api("send_msg", message=row["message"], **target)
+        except Exception as e:
+            return str(e) or type(e).__name__
+        return None if message_id else "未返回消息ID"
+
+    async def _notify_finished_batches(self):
+        for batch in await self.outbox_db.get_finished_batches():
+            messages = await self.outbox_db.get_batch_messages(batch["batch_id"])
+            report = BroadcastReport(total=len(messages))
+            for message in messages:
+                report.retried += max(message["attempts"] - 1, 0)
+                if message["status"] == "sent":
+                    report.succeeded.append(message["target_id"])
+                else:
+                    report.failed[message["target_id"]] = message["last_error"] or ""
+            if batch["created_at"]:
+                # created_at由CURRENT_TIMESTAMP写入，是不带时区的UTC时间
+                created_at = datetime.fromisoformat(batch["created_at"]).replace(tzinfo=timezone.utc)
+                report.elapsed = (datetime.now(timezone.utc) - created_at).total_seconds()
+            logger.info(f"批次{batch['batch_id']}（{batch['description']}）" + report.summary(max_failed=len(report.failed)))
+
+            # 汇总本身也经过发件箱，与批次标记在同一个事务内，重启后不会重复发送
+            async with self.outbox_db.db.transaction() as tx:
+                if batch["notify_id"]:
+                    await self.outbox_db.enqueue(
+                        batch["notify_type"], batch["notify_id"], report.summary(),
+                        priority=10, dedup_key=f"{batch['batch_id']}:summary", tx=tx
+                    )
+                await self.outbox_db.mark_batch_finished(batch["batch_id"], tx=tx)
@@ -4,20 +4,28 @@ from nonebot.exception import FinishedException
 from nonebot.params import CommandArg
 from nonebot.plugin import PluginMetadata
 
-import psutil
 import os
 import re
 import platform
+import time
+from typing import List
 
 import asyncio
 
+from utils.perf import perf_registry
+from utils.watchdog import loop_watchdog
+from .perf import format_perf, format_lag, PERF_DEFAULT_TOP
+from .sampler import SystemSampler, Sample
+from .shell import run_command, CMD_OUTPUT_CAP, CMD_SHOW_CHARS, CMD_TIMEOUT
+
 
 # 不在这里加权限控制的原因是如果权限不足需要提示用户
 sv_cmd = on_command("!cmd")
 sv_ping = on_fullmatch("!ping")
-sv_srvstat = on_fullmatch("!srvstat")
+sv_srvstat = on_command("!srvstat")
 sv_netstat = on_fullmatch("!netstat")
 sv_restart = on_fullmatch("!restart")
+sv_perf = on_command("!perf")
 
 __plugin_meta__ = PluginMetadata(
     name="[kernel]系统命令",
@@ -26,8 +34,11 @@ __plugin_meta__ = PluginMetadata(
           "（超级管理员）!cmd <命令> - 执行系统命令\n"
           "（超级管理员）!restart - 重启nonebot\n"
           "!ping - 测试服务器响应\n"
-          "!srvstat - 查询服务器状态\n"
-          "!netstat - 查询网络信息",
+          "!srvstat [分钟] - 查询服务器状态，带分钟数时附带这段时间内的最小/平均/最大值\n"
+          "!netstat - 查询网络信息\n"
+          "（超级管理员）!perf [数量] [plugin] - 查看最慢的事件响应器（或插件）的耗时分位数\n"
+          "（超级管理员）!perf lag - 查看事件循环延迟和最近的阻塞记录\n"
+          "（超级管理员）!perf reset - 清空耗时统计",
     type="application",
     config=None,
 )
@@ -40,54 +51,101 @@ async def _(ev: Event, args: Message=CommandArg()):
     if not cmd:
         await sv_cmd.finish("命令行为空")
 
+    logger.info(f"管理员 {ev.get_user_id()} 执行命令: {cmd}")
+
+    async def progress(text: str):
+        await sv_cmd.send(f"运行中，新输出：\n{text}")
+
     try:
-        # 异步执行命令
-        proc = await asyncio.create_subprocess_shell(
-            cmd,
-            stdout=asyncio.subprocess.PIPE,
-            stderr=asyncio.subprocess.PIPE
-        )
-        stdout, stderr = await asyncio.wait_for(proc.communicate(), timeout=30.0)
-
-        logger.info(f"管理员 {ev.get_user_id()} 执行命令: {cmd}")
-        if proc.returncode != 0:
-            logger.warning(f"命令执行失败（返回码 {proc.returncode}）：\n{stderr.decode().strip()}")
-            await sv_cmd.finish(f"命令执行失败（返回码 {proc.returncode}）：\n{stderr.decode().strip()}")
-        else:
-            logger.info("执行成功")
-            await sv_cmd.finish("执行结果（返回前500个字符）：\n" + stdout.decode("gbk").strip()[:500])
-    except asyncio.TimeoutError:
-        proc.kill()
-        logger.warning("执行超时")
-        await sv_cmd.finish("命令执行超时")
+        result = await run_command(cmd, on_progress=progress)
     except Exception as e:
-        if isinstance(e, FinishedException):
-            raise e
         logger.warning(f"发生错误：{str(e)}")
         await sv_cmd.finish(f"发生错误：\n{str(e)}")
 
+    output = result.text.strip()[:CMD_SHOW_CHARS]
+    notes = []
+    if result.timed_out:
+        notes.append(f"命令执行超时（{CMD_TIMEOUT:.0f}秒），进程已结束")
+    if result.capped:
+        notes.append(f"输出超过{CMD_OUTPUT_CAP // 1024}KB，进程已结束")
+    if result.spill_path is not None:
+        notes.append(f"完整输出（{result.total_bytes}字节）已保存到{result.spill_path}")
+    footer = ("\n\n" + "\n".join(notes)) if notes else ""
+
+    if result.timed_out or result.capped:
+        logger.warning("；".join(notes))
+        await sv_cmd.finish(f"执行结果（返回前{CMD_SHOW_CHARS}个字符）：\n{output}{footer}")
+    if result.returncode != 0:
+        logger.warning(f"命令执行失败（返回码 {result.returncode}）：\n{output}")
+        await sv_cmd.finish(f"命令执行失败（返回码 {result.returncode}）：\n{output}{footer}")
+    logger.info("执行成功")
+    await sv_cmd.finish(f"执行结果（返回前{CMD_SHOW_CHARS}个字符）：\n{output}{footer}")
+
 @sv_ping.handle()
 async def _():
     await sv_ping.finish("pong!")
 
 
-@sv_srvstat.handle()
+# 系统状态由后台采样器定期采集，!srvstat只读取最近的样本
+SRVSTAT_MAX_MINUTES = 60
+driver = get_driver()
+sampler = SystemSampler(interval=5.0, capacity=SRVSTAT_MAX_MINUTES * 60 // 5)
+
+
+@driver.on_startup
 async def _():
+    sampler.start()
+    loop_watchdog.start()
+
+
+@driver.on_shutdown
+async def _():
+    await sampler.stop()
+    await loop_watchdog.stop()
+
+
+@sv_srvstat.handle()
+async def _(args: Message=CommandArg()):
+    sample = sampler.latest
+    if sample is None:
+        await sv_srvstat.finish("系统状态采样尚未完成，请稍后再试")
+    arg = args.extract_plain_text().strip()
     try:
-        await sv_srvstat.finish(f"{CpuInfo()}\n{MemInfo()}\n{DiskInfo()}")
+        info = f"{CpuInfo(sample)}\n{MemInfo(sample)}\n{DiskInfo(sample)}\n{ProcInfo(sample)}"
+        if arg.isdigit():
+            minutes = min(max(int(arg), 1), SRVSTAT_MAX_MINUTES)
+            info += "\n" + TrendInfo(sampler.window(minutes * 60), minutes)
+        await sv_srvstat.finish(info)
     except Exception as e:
         if isinstance(e, FinishedException):
             raise e
         await sv_srvstat.finish(f"获取服务器状态失败: {str(e)}")
 
 
+@sv_perf.handle()
+async def _(ev: Event, args: Message=CommandArg()):
+    if ev.get_user_id() not in get_driver().config.superusers:
+        await sv_perf.finish("权限不足")
+    argv = args.extract_plain_text().split()
+    if "lag" in argv:
+        await sv_perf.finish(format_lag())
+    if "reset" in argv:
+        perf_registry.reset()
+        await sv_perf.finish("耗时统计已清空")
+    n = next((int(arg) for arg in argv if arg.isdigit()), PERF_DEFAULT_TOP)
+    await sv_perf.finish(format_perf(n, plugins="plugin" in argv))
+
+
 @sv_netstat.handle()
 async def _():
     if platform.system() != "Windows":
         await sv_netstat.finish("此功能仅在Windows系统上可用")
 
     try:
-        output = os.popen("ipconfig /all").read()
+        result = await run_command("ipconfig /all")
+        if result.timed_out:
+            await sv_netstat.finish(f"获取网络信息超时（{CMD_TIMEOUT:.0f}秒）")
+        output = result.text
         ipv6_matches = re.findall(r"(([a-f0-9]{1,4}:){7}[a-f0-9]{1,4})", output, re.I)
         ipv4_matches = re.findall(r"\d{1,3}\.\d{1,3}\.\d{1,3}\.\d{1,3}", output)
 
@@ -111,54 +169,71 @@ async def _(ev: Event):
     logger.info("执行操作：指令重启")
     await sv_restart.send("正在重启，请稍等")
     path = os.path.dirname(__file__)
-    os.system(path + "\\restart.exe " + str(os.getpid()) + " main.py")
+    # 不等待restart.exe退出，它会结束本进程后重新启动
+    await asyncio.create_subprocess_exec(os.path.join(path, "restart.exe"), str(os.getpid()), "main.py")
 
-def MemInfo() -> str:
-    try:
-        memory = psutil.virtual_memory()
-        total = round(memory.total / 1024.0 / 1024.0, 2)
-        used = round(memory.used / 1024.0 / 1024.0, 2)
-        free = round(memory.free / 1024.0 / 1024.0, 2)
-        percent = memory.percent
+def _mb(value: int) -> float:
+    return round(value / 1024.0 / 1024.0, 2)
 
-        info = f'''
-=== MemoryInfo ===
-total memory: {total} MB;
-used: {used} MB; free: {free} MB
-usage: {percent}%
-        '''.strip()
-        return info
-    except Exception as e:
-        return f"获取内存信息失败: {str(e)}"
 
+def _gb(value: int) -> float:
+    return round(value / 1024 / 1024 / 1024, 2)
+
+
+def MemInfo(sample: Sample) -> str:
+    info = f'''
+=== MemoryInfo ===
+total memory: {_mb(sample.mem_total)} MB;
+used: {_mb(sample.mem_used)} MB; free: {_mb(sample.mem_free)} MB
+usage: {sample.mem_percent}%
+    '''.strip()
+    return info
 
-def CpuInfo() -> str:
-    try:
-        count = psutil.cpu_count(logical=False)
-        usage = psutil.cpu_percent(interval=0.5, percpu=True)
-        times = psutil.cpu_times_percent(percpu=False)
 
-        info = f'''
+def CpuInfo(sample: Sample) -> str:
+    info = f'''
 === CpuInfo ===
-total core: {count};
-usage(avg): {round(sum(usage) / len(usage), 2)}%
-usage(per): {", ".join([str(i) + "%" for i in usage])}
-[user: {times.user}%; system: {times.system}%; idle: {times.idle}%]
-        '''.strip()
-        return info
-    except Exception as e:
-        return f"获取CPU信息失败: {str(e)}"
+total core: {sampler.core_count};
+usage(avg): {round(sample.cpu, 2)}%
+usage(per): {", ".join([str(i) + "%" for i in sample.cpu_per])}
+[user: {sample.cpu_user}%; system: {sample.cpu_system}%; idle: {sample.cpu_idle}%]
+    '''.strip()
+    return info
 
 
-def DiskInfo() -> str:
-    try:
-        disk = psutil.disk_usage("C:\\")
-        info = f'''
+def DiskInfo(sample: Sample) -> str:
+    info = f'''
 === DiskInfo ===
-total: {round(disk.total / 1024 / 1024 / 1024, 2)} GB
-used: {round(disk.used / 1024 / 1024 / 1024, 2)} GB
-usage: {disk.percent}%
-        '''.strip()
-        return info
-    except Exception as e:
-        return f"获取磁盘信息失败: {str(e)}"
\ No newline at end of file
+total: {_gb(sample.disk_total)} GB
+used: {_gb(sample.disk_used)} GB
+usage: {sample.disk_percent}%
+    '''.strip()
+    return info
+
+
+def ProcInfo(sample: Sample) -> str:
+    info = f'''
+=== ProcessInfo ===
+rss: {_mb(sample.rss)} MB; open files: {sample.fds}
+event loop lag: {round(sample.loop_lag * 1000, 1)} ms (p99 {round(loop_watchdog.lag.percentile(99), 1)} ms, stalls {loop_watchdog.stalls})
+sampled: {time.strftime("%H:%M:%S", time.localtime(sample.time))}
+    '''.strip()
+    return info
+
+
+def TrendInfo(samples: List[Sample], minutes: int) -> str:
+    if not samples:
+        return f"=== Trend ({minutes} min) ===\nno samples"
+
+    def line(name: str, values: list, fmt) -> str:
+        return f"{name}: {fmt(min(values))} / {fmt(sum(values) / len(values))} / {fmt(max(values))}"
+
+    info = "\n".join([
+        f"=== Trend ({minutes} min, {len(samples)} samples, min/avg/max) ===",
+        line("cpu", [s.cpu for s in samples], lambda v: f"{v:.1f}%"),
+        line("memory", [s.mem_percent for s in samples], lambda v: f"{v:.1f}%"),
+        line("rss", [s.rss for s in samples], lambda v: f"{_mb(v)}MB"),
+        line("open files", [s.fds for s in samples], lambda v: f"{v:.0f}"),
+        line("loop lag", [s.loop_lag for s in samples], lambda v: f"{v * 1000:.1f}ms"),
+    ])
+    return info
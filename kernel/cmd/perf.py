@@ -0,0 +1,74 @@
+'''
+事件响应器耗时统计：在每个事件响应器运行前后计时，同时累计其间的数据库耗时和OneBot API耗时，
+按事件响应器和插件分别记入固定分桶的直方图，由!perf查看
+'''
+import time
+from typing import Any, Dict, Optional
+
+from nonebot.adapters import Bot
+from nonebot.matcher import Matcher
+from nonebot.message import run_preprocessor, run_postprocessor
+
+from utils.database.database_manager import DatabaseManager
+from utils.perf import perf_registry, matcher_key
+from utils.watchdog import loop_watchdog
+
+PERF_DEFAULT_TOP = 10
+
+
+@run_preprocessor
+async def _(matcher: Matcher):
+    perf_registry.begin(matcher.state, matcher_key(matcher), matcher.plugin_name or "")
+
+
+@run_postprocessor
+async def _(matcher: Matcher, exception: Optional[Exception]):
+    perf_registry.end(matcher.state, error=exception is not None)
+
+
+@Bot.on_calling_api
+async def _(bot: Bot, api: str, data: Dict[str, Any]):
+    perf_registry.api_started(data)
+
+
+@Bot.on_called_api
+async def _(bot: Bot, exception: Optional[Exception], api: str, data: Dict[str, Any], result: Any):
+    perf_registry.api_finished(data)
+
+
+DatabaseManager().timing_listeners.append(perf_registry.add_db_time)
+
+
+def format_perf(n: int = PERF_DEFAULT_TOP, plugins: bool = False) -> str:
+    rows = perf_registry.top(n, plugins=plugins)
+    since = time.strftime("%m-%d %H:%M", time.localtime(perf_registry.since))
+    title = "插件" if plugins else "事件响应器"
+    if not rows:
+        return f"自{since}以来没有{title}运行记录"
+    lines = [f"自{since}以来最慢的{len(rows)}个{title}（按p99，单位ms）："]
+    for key, stats in rows:
+        wall, db, api = stats.wall, stats.db, stats.api
+        lines.append(
+            f"{key} ×{wall.count}" + (f"（异常{stats.errors}）" if stats.errors else "") + "\n"
+            f"  总 p50 {wall.percentile(50):.1f} / p95 {wall.percentile(95):.1f} / p99 {wall.percentile(99):.1f} / max {wall.max:.1f}\n"
+            f"  数据库 p50 {db.percentile(50):.1f} / p99 {db.percentile(99):.1f}，API p50 {api.percentile(50):.1f} / p99 {api.percentile(99):.1f}"
+        )
+    return "\n".join(lines)
+
+
+def format_lag(reports: int = 3) -> str:
+    lag = loop_watchdog.lag
+    if not loop_watchdog.running:
+        return "事件循环监视未运行"
+    lines = [
+        f"事件循环延迟（ms）：p50 {lag.percentile(50):.1f} / p99 {lag.percentile(99):.1f} / max {lag.max:.1f}",
+        f"超过{loop_watchdog.threshold * 1000:.0f}ms的阻塞：{loop_watchdog.stalls}次",
+    ]
+    for report in list(loop_watchdog.reports)[-reports:][::-1]:
+        duration = f"{report.duration * 1000:.0f}ms" if report.duration is not None else "进行中"
+        lines.append(
+            f"{time.strftime('%m-%d %H:%M:%S', time.localtime(report.started))} 阻塞{duration}\n"
+            f"  事件响应器：{report.matcher or '无'}\n"
+            f"  位置：{report.site or '未知'}"
+        )
+    return "\n".join(lines)
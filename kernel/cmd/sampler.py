@@ -0,0 +1,109 @@
+import asyncio
+import os
+import time
+from collections import deque
+from typing import Deque, List, Optional
+
+import psutil
+from nonebot import logger
+
+
+class Sample:
+    """一次系统状态采样"""
+
+    __slots__ = (
+        "time", "cpu", "cpu_per", "cpu_user", "cpu_system", "cpu_idle",
+        "mem_total", "mem_used", "mem_free", "mem_percent",
+        "disk_total", "disk_used", "disk_percent",
+        "rss", "fds", "loop_lag",
+    )
+
+    def __init__(self, **fields):
+        for name in self.__slots__:
+            setattr(self, name, fields.get(name))
+
+
+class SystemSampler:
+    """后台系统状态采样器
+
+    每interval秒在线程中采集一次CPU、内存、磁盘、本进程内存和打开的文件数，
+    同时用sleep的超时量估计事件循环延迟，结果保存在最多capacity个样本的环形缓冲区中。
+    查询状态时直接读取最近的样本，不会阻塞事件循环
+    """
+
+    def __init__(self, interval: float = 5.0, capacity: int = 720):
+        self.interval = interval
+        self.samples: Deque[Sample] = deque(maxlen=capacity)
+        # 本机磁盘根目录，Windows下为当前盘符
+        self.disk_path = os.path.splitdrive(os.getcwd())[0] + os.sep
+        self.core_count = psutil.cpu_count(logical=False)
+        self._process = psutil.Process()
+        self._task: Optional[asyncio.Task] = None
+
+    def start(self):
+        if self._task is None or self._task.done():
+            self._task = asyncio.get_running_loop().create_task(self._run())
+
+    async def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+
+    @property
+    def latest(self) -> Optional[Sample]:
+        return self.samples[-1] if self.samples else None
+
+    def window(self, seconds: float) -> List[Sample]:
+        """最近seconds秒内的样本"""
+        since = time.time() - seconds
+        return [sample for sample in self.samples if sample.time >= since]
+
+    async def _run(self):
+        loop = asyncio.get_running_loop()
+        # cpu_percent(interval=None)返回距上次调用的平均值，第一次调用只用于建立基准
+        await asyncio.to_thread(self._prime)
+        lag = 0.0
+        while True:
+            try:
+                sample = await asyncio.to_thread(self._collect)
+                sample.loop_lag = lag
+                self.samples.append(sample)
+            except Exception as e:
+                logger.warning(f"系统状态采样失败: {str(e)}")
+            start = loop.time()
+            await asyncio.sleep(self.interval)
+            lag = max(loop.time() - start - self.interval, 0.0)
+
+    @staticmethod
+    def _prime():
+        psutil.cpu_percent(percpu=True)
+        psutil.cpu_times_percent()
+
+    def _collect(self) -> Sample:
+        cpu_per = psutil.cpu_percent(percpu=True)
+        times = psutil.cpu_times_percent()
+        memory = psutil.virtual_memory()
+        disk = psutil.disk_usage(self.disk_path)
+        process = self._process
+        fds = process.num_fds() if hasattr(process, "num_fds") else process.num_handles()
+        return Sample(
+            time=time.time(),
+            cpu=sum(cpu_per) / len(cpu_per) if cpu_per else 0.0,
+            cpu_per=cpu_per,
+            cpu_user=times.user,
+            cpu_system=times.system,
+            cpu_idle=times.idle,
+            mem_total=memory.total,
+            mem_used=memory.used,
+            mem_free=memory.free,
+            mem_percent=memory.percent,
+            disk_total=disk.total,
+            disk_used=disk.used,
+            disk_percent=disk.percent,
+            rss=process.memory_info().rss,
+            fds=fds,
+        )
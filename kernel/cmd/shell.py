@@ -0,0 +1,179 @@
+import asyncio
+import codecs
+import os
+import signal
+import tempfile
+import time
+from pathlib import Path
+from typing import Awaitable, Callable, Optional
+
+from charset_normalizer import from_bytes
+
+CMD_TIMEOUT = 30.0                  # 命令最长运行时间（秒）
+CMD_OUTPUT_CAP = 4 * 1024 * 1024    # 最多读取的输出字节数，达到后立即结束进程
+CMD_MEMORY_BYTES = 64 * 1024        # 内存中保留的输出字节数，超过后全部输出改为写入临时文件
+CMD_SHOW_CHARS = 500                # 回复中显示的字符数
+CMD_PROGRESS_INTERVAL = 5.0         # 长时间运行的命令每隔多少秒发送一次新输出
+CMD_PROGRESS_MAX = 5                # 最多发送几次进度
+CMD_READ_SIZE = 4096
+CMD_KILL_WAIT = 2.0                 # 结束进程后等待其退出的时间（秒）
+CMD_SPILL_FLUSH_BYTES = 256 * 1024  # 临时文件每次写入的字节数
+CMD_SPILL_DIR = Path(__file__).parent.parent.parent / "data" / "cmd_output"
+
+
+def detect_encoding(data: bytes) -> str:
+    """检测输出的编码：依次尝试UTF-8和GBK（Windows中文控制台），都不是时交给charset_normalizer"""
+    for encoding in ("utf-8", "gbk"):
+        try:
+            # 末尾可能截断了多字节字符，按未结束的流解码
+            codecs.getincrementaldecoder(encoding)().decode(data, final=False)
+            return encoding
+        except UnicodeDecodeError:
+            pass
+    best = from_bytes(data).best()
+    return best.encoding if best is not None else "gbk"
+
+
+class CommandResult:
+    def __init__(self):
+        self.returncode: Optional[int] = None
+        self.head = bytearray()             # 输出的前CMD_MEMORY_BYTES字节
+        self.total_bytes = 0
+        self.capped = False                 # 输出达到上限，进程被结束
+        self.timed_out = False
+        self.spill_path: Optional[Path] = None
+        self.encoding = "utf-8"
+
+    @property
+    def text(self) -> str:
+        return bytes(self.head).decode(self.encoding, errors="replace")
+
+
+async def run_command(cmd: str, on_progress: Optional[Callable[[str], Awaitable[None]]] = None) -> CommandResult:
+    """执行shell命令并逐块读取输出（stderr合并到stdout）
+
+    内存中只保留前CMD_MEMORY_BYTES字节，超出的部分连同已读取的内容写入临时文件（文件操作在线程中进行）；
+    读取量达到CMD_OUTPUT_CAP或运行超过CMD_TIMEOUT时结束进程。
+    运行时间较长时每隔CMD_PROGRESS_INTERVAL秒把新输出交给on_progress
+    """
+    kwargs = {} if os.name == "nt" else {"start_new_session": True}
+    proc = await asyncio.create_subprocess_shell(
+        cmd,
+        stdout=asyncio.subprocess.PIPE,
+        stderr=asyncio.subprocess.STDOUT,
+        **kwargs
+    )
+    result = CommandResult()
+    spill = None
+    spill_buffer = bytearray()     # 待写入临时文件的输出，攒够CMD_SPILL_FLUSH_BYTES后在线程中写入
+    pending = bytearray()    # 上次发送进度后的新输出，只保留开头一段
+    progress_sent = 0
+    finished = False    # 读到了输出结尾
+    loop = asyncio.get_running_loop()
+    deadline = loop.time() + CMD_TIMEOUT
+    next_progress = loop.time() + CMD_PROGRESS_INTERVAL
+
+    try:
+        while True:
+            now = loop.time()
+            if now >= deadline:
+                result.timed_out = True
+                break
+            if on_progress is not None and now >= next_progress:
+                next_progress = now + CMD_PROGRESS_INTERVAL
+                if pending and progress_sent < CMD_PROGRESS_MAX:
+                    progress_sent += 1
+                    await on_progress(_decode(pending, result.head))
+                    pending.clear()
+
+            # 没有on_progress时next_progress不会更新，只等到deadline
+            wake_at = deadline if on_progress is None else min(deadline, next_progress)
+            try:
+                chunk = await asyncio.wait_for(proc.stdout.read(CMD_READ_SIZE), timeout=wake_at - now)
+            except asyncio.TimeoutError:
+                continue
+            if not chunk:
+                finished = True
+                break
+
+            chunk = chunk[:CMD_OUTPUT_CAP - result.total_bytes]
+            result.total_bytes += len(chunk)
+            if len(pending) < CMD_SHOW_CHARS * 4:
+                pending += chunk
+            if spill is None and len(result.head) + len(chunk) > CMD_MEMORY_BYTES:
+                spill = await asyncio.to_thread(_open_spill)
+                result.spill_path = Path(spill.name)
+                spill_buffer += result.head
+            if spill is not None:
+                spill_buffer += chunk
+                if len(spill_buffer) >= CMD_SPILL_FLUSH_BYTES:
+                    await asyncio.to_thread(spill.write, bytes(spill_buffer))
+                    spill_buffer.clear()
+            if len(result.head) < CMD_MEMORY_BYTES:
+                result.head += chunk[:CMD_MEMORY_BYTES - len(result.head)]
+
+            if result.total_bytes >= CMD_OUTPUT_CAP:
+                result.capped = True
+                break
+    finally:
+        if spill is not None:
+            await asyncio.to_thread(_close_spill, spill, bytes(spill_buffer))
+        if finished:
+            # 输出已结束但进程可能还在运行，最多等到超时
+            try:
+                await asyncio.wait_for(proc.wait(), max(deadline - loop.time(), 0.1))
+            except asyncio.TimeoutError:
+                result.timed_out = True
+                _kill(proc)
+        else:
+            _kill(proc)
+            # 管道中剩余的输出读完之前wait不会返回
+            await _discard_output(proc)
+        try:
+            result.returncode = await asyncio.wait_for(proc.wait(), CMD_KILL_WAIT)
+        except asyncio.TimeoutError:
+            result.returncode = proc.returncode
+
+    result.encoding = detect_encoding(bytes(result.head))
+    return result
+
+
+def _open_spill():
+    CMD_SPILL_DIR.mkdir(parents=True, exist_ok=True)
+    return tempfile.NamedTemporaryFile(
+        "wb", dir=CMD_SPILL_DIR, prefix=time.strftime("%Y%m%d-%H%M%S-"), suffix=".log", delete=False
+    )
+
+
+def _close_spill(spill, data: bytes):
+    try:
+        spill.write(data)
+    finally:
+        spill.close()
+
+
+def _decode(data: bytes, sample: bytes) -> str:
+    text = bytes(data).decode(detect_encoding(bytes(sample)), errors="replace").strip()
+    return text[:CMD_SHOW_CHARS]
+
+
+async def _discard_output(proc: asyncio.subprocess.Process):
+    async def discard():
+        while await proc.stdout.read(65536):
+            pass
+
+    try:
+        await asyncio.wait_for(discard(), CMD_KILL_WAIT)
+    except asyncio.TimeoutError:
+        pass
+
+
+def _kill(proc: asyncio.subprocess.Process):
+    """结束进程，非Windows下连同它启动的子进程一起结束"""
+    try:
+        if os.name == "nt":
+            proc.kill()
+        else:
+            os.killpg(proc.pid, signal.SIGKILL)
+    except ProcessLookupError:
+        pass
@@ -1,23 +1,36 @@
+import asyncio
+import copy
 import json
+import time
 from pathlib import Path
 
-from nonebot import on_command, on_notice, on_request, on_message, logger, get_driver, Bot
+from nonebot import on_command, logger, get_driver, Bot
 from nonebot.adapters import Event
 from nonebot.rule import to_me
 from nonebot.params import CommandArg
 from nonebot.matcher import Matcher
+from nonebot.message import event_preprocessor
 from nonebot.permission import SUPERUSER
 from nonebot.plugin import PluginMetadata
-from nonebot.adapters.onebot.v11 import Message, GroupMessageEvent
+from nonebot.adapters.onebot.v11 import Message
+
+from .recorder import EventRecorder, EventSpooler
 
 CONFIG_PATH = Path(__file__).parent / "debug_config.json"
+SPOOL_DIR = Path(__file__).parent.parent.parent / "data" / "debug_spool"
 
 DEFAULT_CONFIG = {
     "enabled": False,
     "monitored_events": [],
     "monitored_groups": [],
+    "spool": False,
 }
 
+RECORDER_CAPACITY = 1000     # 环形缓冲区保留的事件数
+DUMP_DEFAULT = 5             # !debug dump不带参数时输出的事件数
+DUMP_MAX = 20                # !debug dump一次最多输出的事件数
+DUMP_MAX_CHARS = 1500        # 单个事件输出的最大字符数
+
 
 def load_config() -> dict:
     """加载配置文件"""
@@ -40,7 +53,20 @@ def save_config(config: dict):
         print(f"保存配置文件失败: {e}")
 
 
-config = load_config()
+config = {**DEFAULT_CONFIG, **load_config()}
+
+# 开启后事件只以引用的形式进入环形缓冲区，序列化推迟到!debug dump或后台落盘时
+recorder = EventRecorder(RECORDER_CAPACITY)
+spooler = EventSpooler(recorder, SPOOL_DIR)
+
+
+async def apply_config():
+    """同步配置到记录器并保存，写文件在线程中进行，不阻塞事件循环"""
+    recorder.configure(config["enabled"], config["monitored_events"], config["monitored_groups"])
+    await asyncio.to_thread(save_config, copy.deepcopy(config))
+
+
+recorder.configure(config["enabled"], config["monitored_events"], config["monitored_groups"])
 
 __plugin_meta__ = PluginMetadata(
     name="[kernel]调试监视器",
@@ -54,6 +80,8 @@ __plugin_meta__ = PluginMetadata(
 （超级管理员，仅限私聊）!debug group add [群号] - 添加监视群聊
 （超级管理员，仅限私聊）!debug group remove [群号] - 移除监视群聊
 （超级管理员，仅限私聊）!debug list - 显示当前配置状态
+（超级管理员，仅限私聊）!debug dump [数量] - 输出最近记录的事件
+（超级管理员，仅限私聊）!debug spool on/off - 开启/关闭事件定期落盘（msgpack）
     '''.strip(),
     type="application",
     config=None
@@ -73,17 +101,17 @@ async def _(matcher: Matcher, args: Message = CommandArg()):
 
     if cmd == "on":
         config["enabled"] = True
-        save_config(config)
+        await apply_config()
         await matcher.finish("事件监视已开启")
     elif cmd == "off":
         config["enabled"] = False
-        save_config(config)
+        await apply_config()
         await matcher.finish("事件监视已关闭")
     elif cmd == "add" and len(args) > 1:
         event_type = args[1]
         if event_type not in config["monitored_events"]:
             config["monitored_events"].append(event_type)
-            save_config(config)
+            await apply_config()
             await matcher.finish(f"已添加监视事件类型: {event_type}")
         else:
             await matcher.finish(f"事件类型已存在: {event_type}")
@@ -91,7 +119,7 @@ async def _(matcher: Matcher, args: Message = CommandArg()):
         event_type = args[1]
         if event_type in config["monitored_events"]:
             config["monitored_events"].remove(event_type)
-            save_config(config)
+            await apply_config()
             await matcher.finish(f"已移除监视事件类型: {event_type}")
         else:
             await matcher.finish(f"未找到事件类型: {event_type}")
@@ -103,55 +131,76 @@ async def _(matcher: Matcher, args: Message = CommandArg()):
         if sub_cmd == "add":
             if group_id not in config["monitored_groups"]:
                 config["monitored_groups"].append(group_id)
-                save_config(config)
+                await apply_config()
                 await matcher.finish(f"已添加监视群聊: {group_id}")
             else:
                 await matcher.finish(f"群聊已存在: {group_id}")
         elif sub_cmd == "remove":
             if group_id in config["monitored_groups"]:
                 config["monitored_groups"].remove(group_id)
-                save_config(config)
+                await apply_config()
                 await matcher.finish(f"已移除监视群聊: {group_id}")
             else:
                 await matcher.finish(f"未找到群聊: {group_id}")
     elif cmd == "list":
         enabled = "开启" if config["enabled"] else "关闭"
+        spool = f"开启（已写入{spooler.written}条）" if spooler.running else "关闭"
         events = "\n".join(config["monitored_events"]) or "无"
         groups = "\n".join(config["monitored_groups"]) or "无"
         await matcher.finish(
             f"当前监视配置:\n"
             f"状态: {enabled}\n"
+            f"缓冲区: {len(recorder)}/{recorder.capacity}（累计记录{recorder.recorded}条）\n"
+            f"落盘: {spool}\n"
             f"监视的事件类型:\n{events}\n"
             f"监视的群聊:\n{groups}"
         )
+    elif cmd == "dump":
+        count = int(args[1]) if len(args) > 1 and args[1].isdigit() else DUMP_DEFAULT
+        records = recorder.latest(min(count, DUMP_MAX))
+        if not records:
+            await matcher.finish("缓冲区中没有事件")
+        lines = []
+        for seq, timestamp, event_type, event in records:
+            content = event.model_dump_json()
+            if len(content) > DUMP_MAX_CHARS:
+                content = content[:DUMP_MAX_CHARS] + "..."
+            lines.append(f"#{seq} {time.strftime('%H:%M:%S', time.localtime(timestamp))} {event_type}\n{content}")
+        await matcher.finish("\n\n".join(lines))
+    elif cmd == "spool" and len(args) > 1 and args[1] in ("on", "off"):
+        config["spool"] = args[1] == "on"
+        await apply_config()
+        if config["spool"]:
+            spooler.start()
+            await matcher.finish(f"事件落盘已开启，文件位于{SPOOL_DIR}")
+        await spooler.stop()
+        await matcher.finish(f"事件落盘已关闭，共写入{spooler.written}条")
     else:
         await matcher.finish(__plugin_meta__.usage)
 
 
+@event_preprocessor
 async def log_event(event: Event):
-    if not config["enabled"]:
+    # 只记录消息、通知和请求，心跳等元事件不记录
+    if event.get_type() not in ("message", "notice", "request"):
         return
+    recorder.record(event)
 
-    # 检查事件类型
-    event_type = event.get_type()
-    logger.info(event_type)
-    if config["monitored_events"] and event_type not in config["monitored_events"]:
-        return
 
-    # 如果是群消息事件，检查群号
-    if isinstance(event, GroupMessageEvent):
-        group_id = str(event.group_id)
-        if config["monitored_groups"] and group_id not in config["monitored_groups"]:
-            return
+driver = get_driver()
+
 
-    # 输出事件信息到控制台
-    logger.info("=" * 20)
-    logger.info(f"事件类型: {event_type}")
-    logger.info(f"事件内容: {event.model_dump_json()}")
-    logger.info("=" * 20)
+@driver.on_startup
+async def _():
+    if config["spool"]:
+        spooler.start()
+
+
+@driver.on_shutdown
+async def _():
+    await spooler.stop()
 
 
-driver = get_driver()
 @driver.on_bot_connect
 async def start_notify(bot: Bot):
     superuser = driver.config.superusers
@@ -169,7 +218,3 @@ async def start_notify(bot: Bot):
     except Exception as e:
         logger.warning(str(e))
 
-
-on_message(priority=1, block=False).append_handler(log_event)
-on_notice(priority=1, block=False).append_handler(log_event)
-on_request(priority=1, block=False).append_handler(log_event)
@@ -0,0 +1,152 @@
+import asyncio
+import time
+from collections import deque
+from pathlib import Path
+from typing import Deque, Iterable, List, Optional, Tuple
+
+import msgpack
+from nonebot import logger
+from nonebot.adapters import Event
+from nonebot.adapters.onebot.v11 import GroupMessageEvent
+
+# (序号, 时间戳, 事件类型, 事件对象)
+Record = Tuple[int, float, str, Event]
+
+
+class EventRecorder:
+    """事件记录器
+
+    记录时只把事件对象的引用放进定长环形缓冲区，不做任何序列化，
+    超出容量时最早的记录被覆盖。序列化推迟到dump或落盘时进行
+    """
+
+    def __init__(self, capacity: int = 1000):
+        self.enabled = False
+        self.events: set = set()   # 为空时记录所有事件类型
+        self.groups: set = set()   # 为空时记录所有群
+        self._buffer: Deque[Record] = deque(maxlen=capacity)
+        self._seq = 0
+
+    @property
+    def capacity(self) -> int:
+        return self._buffer.maxlen
+
+    @property
+    def recorded(self) -> int:
+        """累计记录的事件数（包括已被覆盖的）"""
+        return self._seq
+
+    def configure(self, enabled: bool, events: Iterable[str], groups: Iterable[str]):
+        self.enabled = enabled
+        self.events = set(events)
+        self.groups = set(groups)
+
+    def record(self, event: Event):
+        if not self.enabled:
+            return
+        event_type = event.get_type()
+        if self.events and event_type not in self.events:
+            return
+        if self.groups and isinstance(event, GroupMessageEvent) and str(event.group_id) not in self.groups:
+            return
+        self._seq += 1
+        self._buffer.append((self._seq, time.time(), event_type, event))
+
+    def latest(self, n: int) -> List[Record]:
+        if n <= 0:
+            return []
+        return list(self._buffer)[-n:]
+
+    def since(self, seq: int) -> List[Record]:
+        """序号大于seq的记录"""
+        return [record for record in self._buffer if record[0] > seq]
+
+    def __len__(self) -> int:
+        return len(self._buffer)
+
+
+class EventSpooler:
+    """把事件记录器中的新记录定期以msgpack写入滚动文件
+
+    每条记录是一个{"seq", "time", "type", "event"}对象，依次追加写入，
+    可以用msgpack.Unpacker逐条读取。文件超过max_bytes后滚动，最多保留backups个旧文件
+    """
+
+    def __init__(self, recorder: EventRecorder, directory: Path,
+                 interval: float = 5.0, max_bytes: int = 8 * 1024 * 1024, backups: int = 5):
+        self.recorder = recorder
+        self.directory = directory
+        self.interval = interval
+        self.max_bytes = max_bytes
+        self.backups = backups
+        self.written = 0
+        self._last_seq = 0
+        self._task: Optional[asyncio.Task] = None
+
+    @property
+    def path(self) -> Path:
+        return self.directory / "events.msgpack"
+
+    @property
+    def running(self) -> bool:
+        return self._task is not None and not self._task.done()
+
+    def start(self):
+        if not self.running:
+            # 只落盘开启之后的事件
+            self._last_seq = self.recorder.recorded
+            self._task = asyncio.get_running_loop().create_task(self._run())
+
+    async def stop(self):
+        if self._task is None:
+            return
+        self._task.cancel()
+        try:
+            await self._task
+        except asyncio.CancelledError:
+            pass
+        self._task = None
+        await self.flush()
+
+    async def _run(self):
+        while True:
+            await asyncio.sleep(self.interval)
+            try:
+                await self.flush()
+            except Exception as e:
+                logger.error(f"事件落盘失败: {str(e)}")
+
+    async def flush(self):
+        records = self.recorder.since(self._last_seq)
+        if not records:
+            return
+        self._last_seq = records[-1][0]
+        # 序列化在事件循环内进行（事件对象不是线程安全的），文件写入放到线程中
+        data = b"".join(
+            msgpack.packb({
+                "seq": seq,
+                "time": timestamp,
+                "type": event_type,
+                "event": event.model_dump(mode="json"),
+            })
+            for seq, timestamp, event_type, event in records
+        )
+        await asyncio.to_thread(self._write, data)
+        self.written += len(records)
+
+    def _write(self, data: bytes):
+        self.directory.mkdir(parents=True, exist_ok=True)
+        if self.path.exists() and self.path.stat().st_size + len(data) > self.max_bytes:
+            self._rotate()
+        with open(self.path, "ab") as f:
+            f.write(data)
+
+    def _rotate(self):
+        for i in range(self.backups - 1, 0, -1):
+            src = self.directory / f"events.{i}.msgpack"
+            if src.exists():
+                src.replace(self.directory / f"events.{i + 1}.msgpack")
+        if self.backups > 0:
+            self.path.replace(self.directory / "events.1.msgpack")
+        else:
+            self.path.unlink()
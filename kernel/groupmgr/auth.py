@@ -1,5 +1,10 @@
+import asyncio
+import random
+import string
 from datetime import datetime, timedelta
-from nonebot import on_command, on_message, logger, get_driver, Bot
+from pathlib import Path
+from typing import Optional, Tuple, List
+from nonebot import on_command, on_message, logger, get_driver
 from nonebot.adapters import Event, Message
 from nonebot.params import CommandArg
 from nonebot.matcher import Matcher
@@ -14,7 +19,6 @@ from nonebot.exception import FinishedException
 
 from utils.database.group_db import GroupDatabase
 from utils.database.cdkey_db import CDKeyDatabase
-from utils.qqdata import ApiGetGroupList
 
 __plugin_meta__ = PluginMetadata(
     name="[kernel]群授权管理",
@@ -35,16 +39,7 @@ cdkey_db = CDKeyDatabase()
 driver = get_driver()
 
 
-@driver.on_bot_connect
-async def _(bot: Bot):
-    await auth_db.initialize()
-    groups = await ApiGetGroupList(bot)
-    for group in groups:
-        # 如果已经在数据库中，则略过
-        if await auth_db.get_group_info(group.group_id):
-            continue
-        await auth_db.create_group_info(group_id=group.group_id)
-    logger.info("群信息表初始化完毕")
+# 群信息表与群列表的同步统一由插件管理器的init_pluginmgr完成
 
 
 sv_cdkey_admin = on_command("!cdkey", permission=SUPERUSER, priority=5, block=True, rule=to_me())
@@ -52,11 +47,19 @@ sv_cdkey_use = on_command("!cdkey use", priority=5, block=True)
 sv_auth_status = on_command("!authstatus", priority=5, block=True)
 
 
+CDKEY_CHARS = string.ascii_uppercase + string.digits
+# 单条消息最多直接展示的CDKey数量，超过时导出到文件
+CDKEY_SHOW_LIMIT = 50
+CDKEY_EXPORT_DIR = Path(__file__).parent.parent.parent / "data" / "cdkey_export"
+
+
 def generate_cdkey(length: int = 16) -> str:
-    import random
-    import string
-    chars = string.ascii_uppercase + string.digits
-    return "".join(random.choice(chars) for _ in range(length))
+    return "".join(random.choices(CDKEY_CHARS, k=length))
+
+
+def _export_cdkeys(path: Path, cdkeys: List[str]):
+    path.parent.mkdir(parents=True, exist_ok=True)
+    path.write_text("\n".join(cdkeys), encoding="utf-8")
 
 
 async def is_cdkey_valid(cdkey: str) -> bool:
@@ -84,6 +87,42 @@ async def group_authed_days(group_id: str) -> int:
     return max(days, 0)
 
 
+async def redeem_cdkey(group_id: str, cdkey: str) -> Tuple[Optional[datetime], Optional[str]]:
+    """在同一个事务内校验CDKey、延长群授权并标记CDKey已使用
+
+    返回(新到期时间, 错误信息)，成功时错误信息为None
+    """
+    async with auth_db.db.transaction() as tx:
+        cdkey_data = await cdkey_db.get_cdkey(cdkey, tx=tx)
+        now = datetime.now()
+        if not cdkey_data or (cdkey_data["expires"] and datetime.fromisoformat(cdkey_data["expires"]) < now):
+            return None, "CDKey无效或已过期"
+        if cdkey_data["used"]:
+            return None, "该CDKey已被使用"
+
+        days = cdkey_data["days"]
+        current_auth = await auth_db.get_group_info(group_id, tx=tx)
+
+        # 计算新有效期
+        if current_auth and current_auth["expires"]:
+            current_expires = datetime.fromisoformat(current_auth["expires"])
+            new_expires = max(current_expires, now) + timedelta(days=days)
+        else:
+            new_expires = now + timedelta(days=days)
+
+        # 更新数据库
+        await auth_db.create_group_info(
+            group_id=group_id,
+            cdkey=cdkey,
+            days=days,
+            expires=new_expires,
+            tx=tx
+        )
+        await cdkey_db.mark_cdkey_used(cdkey, group_id, tx=tx)
+
+    return new_expires, None
+
+
 @sv_auth_status.handle()
 async def handle_auth_status(matcher: Matcher, event: GroupMessageEvent):
     group_id = str(event.group_id)
@@ -113,36 +152,39 @@ async def handle_cdkey_admin(matcher: Matcher, event: PrivateMessageEvent, args:
             if days <= 0:
                 await matcher.finish("天数必须大于0")
 
-            new_cdkeys = []
-            expires = datetime.now() + timedelta(days=30)
-
-            for _ in range(count):
-                cdkey = generate_cdkey()
-                await cdkey_db.create_cdkey(
-                    cdkey=cdkey,
-                    days=days,
-                    created=datetime.now(),
-                    expires=expires,
-                    used=False
-                )
-                new_cdkeys.append(cdkey)
+            if count <= 0:
+                await matcher.finish("数量必须大于0")
 
-            await matcher.finish(
-                f"成功创建{count}个CDKey（有效期至{expires.strftime('%Y-%m-%d')}）：\n" + "\n".join(new_cdkeys))
+            now = datetime.now()
+            expires = now + timedelta(days=30)
+            new_cdkeys = await cdkey_db.create_cdkeys_bulk(
+                count=count,
+                days=days,
+                created=now,
+                expires=expires,
+                key_factory=generate_cdkey
+            )
+
+            header = f"成功创建{count}个CDKey（有效期至{expires.strftime('%Y-%m-%d')}）："
+            if count <= CDKEY_SHOW_LIMIT:
+                await matcher.finish(header + "\n" + "\n".join(new_cdkeys))
+
+            # 数量太多时不直接发送，写入文件
+            path = CDKEY_EXPORT_DIR / f"cdkey_{now.strftime('%Y%m%d%H%M%S')}_{days}d_{count}.txt"
+            await asyncio.to_thread(_export_cdkeys, path, new_cdkeys)
+            await matcher.finish(f"{header}\n数量超过{CDKEY_SHOW_LIMIT}个，已导出到：{path}")
 
         elif sub_cmd == "list":
-            cdkeys = await cdkey_db.get_all_cdkeys()
-            if not cdkeys:
-                await matcher.finish("没有可用的CDKey")
-
             msg = ["CDKey列表:"]
-            for record in cdkeys:
+            async for record in cdkey_db.iter_all_cdkeys():
                 status = "✅ 未使用" if not record["used"] else "❌ 已使用"
                 expires = datetime.fromisoformat(record["expires"]).strftime("%Y-%m-%d")
                 msg.append(
                     f"{record['cdkey']} - {record['days']}天 | {status}\n"
                     f"有效期至: {expires} | 创建于: {record['created'][:10]}"
                 )
+            if len(msg) == 1:
+                await matcher.finish("没有可用的CDKey")
             await matcher.finish("\n\n".join(msg))
 
         elif sub_cmd == "delete" and len(cmd) >= 2:
@@ -157,34 +199,9 @@ async def handle_cdkey_admin(matcher: Matcher, event: PrivateMessageEvent, args:
             group_id = cmd[1]
             cdkey = cmd[2]
 
-            if not await is_cdkey_valid(cdkey):
-                await matcher.finish("CDKey无效或已过期")
-
-            cdkey_data = await cdkey_db.get_cdkey(cdkey)
-            if cdkey_data["used"]:
-                await matcher.finish("该CDKey已被使用")
-
-            days = cdkey_data["days"]
-            current_auth = await auth_db.get_group_info(group_id)
-            now = datetime.now()
-
-            # 计算新有效期
-            if current_auth and current_auth["expires"]:
-                current_expires = datetime.fromisoformat(current_auth["expires"])
-                new_expires = max(current_expires, now) + timedelta(days=days)
-            else:
-                new_expires = now + timedelta(days=days)
-
-            # 更新数据库
-            async with auth_db.db.connect() as conn:
-                await auth_db.create_group_info(
-                    group_id=group_id,
-                    cdkey=cdkey,
-                    days=days,
-                    expires=new_expires
-                )
-                await cdkey_db.mark_cdkey_used(cdkey, group_id)
-                await conn.commit()
+            new_expires, error = await redeem_cdkey(group_id, cdkey)
+            if error:
+                await matcher.finish(error)
 
             expire_str = new_expires.strftime("%Y-%m-%d")
             await matcher.finish(f"成功为群 {group_id} 分配CDKey\n新到期时间: {expire_str}")
@@ -207,34 +224,9 @@ async def handle_cdkey_use(matcher: Matcher, event: GroupMessageEvent, args: Mes
 
     group_id = str(event.group_id)
 
-    if not await is_cdkey_valid(cdkey):
-        await matcher.finish("CDKey无效或已过期")
-
-    cdkey_data = await cdkey_db.get_cdkey(cdkey)
-    if cdkey_data["used"]:
-        await matcher.finish("该CDKey已被使用")
-
-    days = cdkey_data["days"]
-    current_auth = await auth_db.get_group_info(group_id)
-    now = datetime.now()
-
-    # 计算新有效期
-    if current_auth and current_auth["expires"]:
-        current_expires = datetime.fromisoformat(current_auth["expires"])
-        new_expires = max(current_expires, now) + timedelta(days=days)
-    else:
-        new_expires = now + timedelta(days=days)
-
-    # 更新数据库
-    async with auth_db.db.connect() as conn:
-        await auth_db.create_group_info(
-            group_id=group_id,
-            cdkey=cdkey,
-            days=days,
-            expires=new_expires
-        )
-        await cdkey_db.mark_cdkey_used(cdkey, group_id)
-        await conn.commit()
+    new_expires, error = await redeem_cdkey(group_id, cdkey)
+    if error:
+        await matcher.finish(error)
 
     expire_str = new_expires.strftime("%Y-%m-%d")
     await matcher.finish(f"CDKey使用成功！\n新到期时间: {expire_str}")
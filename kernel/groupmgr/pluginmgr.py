@@ -14,7 +14,8 @@ from nonebot.plugin import PluginMetadata, get_loaded_plugins, Plugin
 from nonebot.message import run_preprocessor
 from nonebot.exception import MatcherException, IgnoredException
 
-from typing import List
+import time
+from typing import List, Dict
 
 import config
 from utils.qqdata import ApiGetGroupList
@@ -28,6 +29,9 @@ driver = get_driver()
 @driver.on_startup
 async def _():
     await group_db.initialize()
+    # 关闭钩子按注册顺序执行；启动时所有插件都已加载，在这里注册可以保证
+    # 数据库在其他插件的关闭钩子（发件箱发送器、订阅轮询等）执行完之后才关闭
+    driver.on_shutdown(group_db.db.close)
 
 
 __plugin_meta__ = PluginMetadata(
@@ -37,6 +41,7 @@ __plugin_meta__ = PluginMetadata(
 !plugin enable <插件名> - 启用本群插件
 !plugin disable <插件名> - 禁用本群插件
 !plugin list - 查看本群插件状态
+!plugin stats - 查看授权缓存命中情况（超级管理员）
 '''.strip(),
     type="application",
     extra={}
@@ -93,6 +98,15 @@ async def handle_plugin(
                 ("\n  ".join(data) if data else "无"),
             ]
             await matcher.finish("\n".join(msg))
+        elif operation == "stats":                      # 缓存统计
+            if not is_superuser:
+                await matcher.finish("权限不足")
+            stats = group_db.auth_cache.stats()
+            await matcher.finish(
+                f"授权缓存: {stats['size']}个群\n"
+                f"命中 {stats['hits']} / 未命中 {stats['misses']}（命中率 {stats['hit_rate']:.2%}）\n"
+                f"失效 {stats['invalidations']}次"
+            )
         else:
             await matcher.finish(__plugin_meta__.usage)
 
@@ -129,23 +143,26 @@ async def toggle_plugin(
 # 插件可用性检查
 @driver.on_bot_connect
 async def init_pluginmgr(bot: Bot):
-
-
-    # 检查所有插件是否都存在于数据库，不存在的补上
-    user_plugins_config = config.plugins
-    user_plugins_loaded: List[Plugin] = []
+    # 检查所有群和插件是否都存在于数据库，不存在的按默认状态补上
+    default_plugins: Dict[str, bool] = {}
     for plugin in get_loaded_plugins():
-        if plugin.name in user_plugins_config:
-            user_plugins_loaded.append(plugin)
+        if plugin.name in config.plugins:
+            meta = get_plugin_metadata(plugin)
+            default_plugins[plugin.name] = meta.extra.get("default_enabled", False)
 
+    start = time.perf_counter()
     groups = await ApiGetGroupList(bot)
-    for group in groups:
-        user_plugins_database = await group_db.get_group_plugins(str(group.group_id))
-        for plugin in user_plugins_loaded:
-            if plugin.name not in user_plugins_database.keys():
-                meta = get_plugin_metadata(plugin)
-                enabled = meta.extra.get("default_enabled", False)
-                await group_db.set_plugin_enabled(str(group.group_id), plugin.name, enabled)
+    fetched = time.perf_counter()
+    new_groups, new_plugins = await group_db.reconcile_groups(
+        (str(group.group_id) for group in groups),
+        default_plugins
+    )
+    done = time.perf_counter()
+    logger.info(
+        f"群信息表初始化完毕：共{len(groups)}个群，新增群{new_groups}个、插件状态{new_plugins}条；"
+        f"获取群列表{(fetched - start) * 1000:.1f}ms，写入数据库{(done - fetched) * 1000:.1f}ms"
+    )
+
 
 @run_preprocessor
 async def check_plugin_availability(event: Event, matcher: Matcher):
@@ -158,22 +175,22 @@ async def check_plugin_availability(event: Event, matcher: Matcher):
 
         # 核心功能无条件启用
         if current_plugin.name not in config.plugins:
-            logger.info(f"核心插件启用: {current_plugin.name} @ {group_id}")
+            logger.debug(f"核心插件启用: {current_plugin.name} @ {group_id}")
             return
 
-        # 先检查数据库中是否启用
+        # 先检查是否启用（授权缓存命中时不查库）
         db_enabled = await group_db.is_plugin_enabled(group_id, current_plugin.name)
         if not db_enabled:
-            logger.info(f"插件未启用，跳过: {current_plugin.name} @ {group_id}")
+            logger.debug(f"插件未启用，跳过: {current_plugin.name} @ {group_id}")
             raise IgnoredException("插件未启用")
 
         # 再检查是否授权使用
         is_authed = await group_db.is_group_authed(group_id)
         if not is_authed:
-            logger.info(f"群未授权，跳过: {current_plugin.name} @ {group_id}")
+            logger.debug(f"群未授权，跳过: {current_plugin.name} @ {group_id}")
             raise IgnoredException("群未授权")
 
-        logger.info(f"消息处理: {current_plugin.name} @ {group_id}")
+        logger.debug(f"消息处理: {current_plugin.name} @ {group_id}")
     except MatcherException:
         raise
     except IgnoredException:
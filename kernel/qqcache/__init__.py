@@ -0,0 +1,36 @@
+from nonebot import get_driver, Bot
+from nonebot.adapters import Event
+from nonebot.message import event_preprocessor
+from nonebot.plugin import PluginMetadata
+
+from utils.qqdata import invalidate_by_notice, invalidate_group_cache, touch_group_member
+
+__plugin_meta__ = PluginMetadata(
+    name="[kernel]QQ数据缓存",
+    description="根据群通知事件和群消息维护utils.qqdata中群列表、群信息、群成员信息的缓存以及群成员表",
+    usage="无指令，被动运行",
+    type="application",
+    config=None,
+)
+
+driver = get_driver()
+
+
+@driver.on_bot_connect
+async def _(bot: Bot):
+    invalidate_group_cache(bot.self_id)
+
+
+@driver.on_bot_disconnect
+async def _(bot: Bot):
+    invalidate_group_cache(bot.self_id)
+
+
+# 在事件预处理阶段完成，每个事件只执行一次，不经过事件响应器
+@event_preprocessor
+async def _(event: Event):
+    post_type = getattr(event, "post_type", None)
+    if post_type == "notice":
+        invalidate_by_notice(event)
+    elif post_type == "message" and getattr(event, "message_type", None) == "group":
+        touch_group_member(event.self_id, event.group_id, event.user_id, event.time)
@@ -24,8 +24,49 @@ __plugin_meta__ = PluginMetadata(
     }
 )
 
-from nonebot import on_command, Bot
-from nonebot.message import Event
+from nonebot import on_command, on_message, get_driver, Bot
+from nonebot.adapters import Event
+from nonebot.typing import T_State
+
+from utils.database.group_db import GroupDatabase
+from utils.database.outbox_db import OutboxDatabase
+from .bilibili_db import bDatabase
+from .poller import SubscriptionPoller
+from .resolver import link_resolver, message_text, prefilter
+
+driver = get_driver()
+bili_db = bDatabase()
+sub_poller = SubscriptionPoller(bili_db, OutboxDatabase(), GroupDatabase())
+
+
+@driver.on_startup
+async def _():
+    sub_poller.start()
+
+
+@driver.on_shutdown
+async def _():
+    await sub_poller.stop()
+
+
+async def _has_bili_link(ev: Event, state: T_State) -> bool:
+    if ev.get_type() != "message":
+        return False
+    text = message_text(ev.get_message())
+    if not prefilter(text):
+        return False
+    state["bili_text"] = text
+    return True
+
+
+sv_resolve = on_message(rule=_has_bili_link, priority=10, block=False)
+
+@sv_resolve.handle()
+async def _(state: T_State):
+    summaries = await link_resolver.resolve(state["bili_text"])
+    if summaries:
+        await sv_resolve.finish("\n\n".join(summaries))
+
 
 sv_bsub = on_command(("!b订阅", "!bsub"), block=True)
 
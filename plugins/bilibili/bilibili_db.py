@@ -1,10 +1,16 @@
 import aiosqlite
 import pathlib
 import asyncio
-import datetime
 
 from dataclasses import dataclass
-from typing import List
+from typing import AsyncIterator, Iterable, Tuple
+
+from nonebot import logger
+
+from utils.database.database_manager import DatabaseManager, TableDefinition
+
+# 旧版本单独使用的数据库文件，首次启动时导入共享数据库，导入记录在bilibili_legacy_import表中
+LEGACY_DB_PATH = pathlib.Path(__file__).parent / "bilibili_db.db"
 
 '''
 gid: 群id，即群号
@@ -13,12 +19,13 @@ last_update_video：上一次更新的视频BV号
 last_update_time：上一次更新的时间
 '''
 db_subvideo_inital = """
-CREATE TABLE IF NOT EXISTS bilibili_subvideo (
-    gid TEXT,
-    uid TEXT,
+CREATE TABLE bilibili_subvideo (
+    gid TEXT NOT NULL,
+    uid TEXT NOT NULL,
     last_update_video TEXT,
-    last_update_time TIMESTAMP
-);
+    last_update_time TIMESTAMP,
+    PRIMARY KEY (gid, uid)
+)
 """
 
 '''
@@ -28,24 +35,53 @@ last_update_dynamic：上一次更新的动态id
 last_update_time：上一次更新的时间
 '''
 db_subdynamic_inital = """
-CREATE TABLE IF NOT EXISTS bilibili_subdynamic (
-    gid TEXT,
-    uid TEXT,
+CREATE TABLE bilibili_subdynamic (
+    gid TEXT NOT NULL,
+    uid TEXT NOT NULL,
     last_update_dynamic TEXT,
-    last_update_time TIMESTAMP
-);
+    last_update_time TIMESTAMP,
+    PRIMARY KEY (gid, uid)
+)
 """
 
+'''
+gid: 群id，即群号
+uid：订阅的UP主的id，即B站uid
+rid：直播间id
+status：上一次记录的直播状态
+last_update_time：上一次更新的时间
+'''
 db_sublive_inital = """
-CREATE TABLE IF NOT EXISTS bilibili_sublive (
-    gid TEXT,
-    uid TEXT,
+CREATE TABLE bilibili_sublive (
+    gid TEXT NOT NULL,
+    uid TEXT NOT NULL,
     rid TEXT,
     status BOOLEAN,
-    last_update_time TIMESTAMP
-);
+    last_update_time TIMESTAMP,
+    PRIMARY KEY (gid, uid)
+)
 """
 
+# 各表的列（与数据类的构造参数顺序一致）
+SUB_COLUMNS = {
+    "bilibili_subvideo": "gid, uid, last_update_video, last_update_time",
+    "bilibili_subdynamic": "gid, uid, last_update_dynamic, last_update_time",
+    "bilibili_sublive": "gid, uid, rid, status, last_update_time",
+}
+
+
+def _sub_table(name: str, create_sql: str) -> TableDefinition:
+    """订阅表定义：主键(gid, uid)同时用于按群查询，另建uid索引用于按UP主查询"""
+    return TableDefinition(
+        name=name,
+        create_sql=create_sql,
+        migrations=[],
+        indexes=[
+            f"CREATE INDEX IF NOT EXISTS idx_{name}_uid ON {name} (uid)",
+        ]
+    )
+
+
 @dataclass
 class SubVideoInfo:
     gid: str
@@ -98,116 +134,162 @@ class SubLiveInfo:
 
 class bDatabase:
 
-    def __init__(self, db_path = ""):
-        if db_path != "":
-            self.db_path = db_path
-        else:
-            self.db_path = pathlib.Path(__file__).parent / "bilibili_db.db"
+    def __init__(self, legacy_path=LEGACY_DB_PATH):
+        self.db = DatabaseManager()
+        self.legacy_path = pathlib.Path(legacy_path)
+        self.db.register_table(_sub_table("bilibili_subvideo", db_subvideo_inital))
+        self.db.register_table(_sub_table("bilibili_subdynamic", db_subdynamic_inital))
+        self.db.register_table(_sub_table("bilibili_sublive", db_sublive_inital))
+        # 已导入过的旧数据库文件，导入后不删除也不改名
+        self.db.register_table(
+            TableDefinition(
+                name="bilibili_legacy_import",
+                create_sql="""CREATE TABLE bilibili_legacy_import (
+                    path TEXT PRIMARY KEY,
+                    imported_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+                )""",
+                migrations=[]
+            )
+        )
 
     async def init_database(self):
-        await self._init_db()
-
-    async def _init_db(self):
-        async with aiosqlite.connect(self.db_path) as conn:
-            await conn.executescript(db_subvideo_inital)
-            await conn.executescript(db_subdynamic_inital)
-            await conn.executescript(db_sublive_inital)
+        await self.db.initialize()
+        if self.legacy_path.exists():
+            result = await self.db.execute_query(
+                "SELECT 1 FROM bilibili_legacy_import WHERE path = ?", (str(self.legacy_path.resolve()),)
+            )
+            if not result:
+                await self._import_legacy()
+
+    async def _import_legacy(self):
+        """把旧数据库文件中的订阅导入共享数据库，重复的订阅只保留最近更新的一条，并记录已导入"""
+        imported = {}
+        async with aiosqlite.connect(self.legacy_path) as conn:
+            for table, columns in SUB_COLUMNS.items():
+                cursor = await conn.execute(
+                    "SELECT name FROM sqlite_master WHERE type='table' AND name=?", (table,)
+                )
+                if await cursor.fetchone() is None:
+                    continue
+                # INSERT OR IGNORE保留先插入的行，所以按更新时间从新到旧读取
+                cursor = await conn.execute(
+                    f"""SELECT {columns} FROM {table}
+                    ORDER BY last_update_time IS NULL, last_update_time DESC, rowid DESC"""
+                )
+                imported[table] = (columns, await cursor.fetchall())
+
+        async with self.db.transaction() as tx:
+            for table, (columns, rows) in imported.items():
+                placeholders = ", ".join("?" * len(columns.split(",")))
+                await self.db.execute_many(
+                    f"INSERT OR IGNORE INTO {table} ({columns}) VALUES ({placeholders})",
+                    [tuple(row) for row in rows],
+                    tx=tx
+                )
+            await self.db.execute_write(
+                "INSERT OR IGNORE INTO bilibili_legacy_import (path) VALUES (?)",
+                (str(self.legacy_path.resolve()),),
+                tx=tx
+            )
+        logger.info("已导入旧的bilibili订阅数据库：" + "，".join(
+            f"{table} {len(rows)}行" for table, (columns, rows) in imported.items()
+        ))
 
     async def sub_add_video(self, gid, uid):
-        async with aiosqlite.connect(self.db_path) as conn:
-            await conn.execute("INSERT INTO bilibili_subvideo (gid, uid) VALUES (?, ?)",
-                               (gid, uid))
-            await conn.commit()
+        await self.db.execute_write("INSERT OR IGNORE INTO bilibili_subvideo (gid, uid) VALUES (?, ?)",
+                                    (gid, uid))
 
     async def sub_remove_video(self, gid, uid):
-        async with aiosqlite.connect(self.db_path) as conn:
-            await conn.execute("DELETE FROM bilibili_subvideo WHERE gid = ? AND uid = ?",
-                               (gid, uid))
-            await conn.commit()
+        await self.db.execute_write("DELETE FROM bilibili_subvideo WHERE gid = ? AND uid = ?",
+                                    (gid, uid))
 
     async def sub_add_dynamic(self, gid, uid):
-        async with aiosqlite.connect(self.db_path) as conn:
-            await conn.execute("INSERT INTO bilibili_subdynamic (gid, uid) VALUES (?, ?)",
-                               (gid, uid))
-            await conn.commit()
+        await self.db.execute_write("INSERT OR IGNORE INTO bilibili_subdynamic (gid, uid) VALUES (?, ?)",
+                                    (gid, uid))
 
     async def sub_remove_dynamic(self, gid, uid):
-        async with aiosqlite.connect(self.db_path) as conn:
-            await conn.execute("DELETE FROM bilibili_subdynamic WHERE gid = ? AND uid = ?",
-                               (gid, uid))
-            await conn.commit()
+        await self.db.execute_write("DELETE FROM bilibili_subdynamic WHERE gid = ? AND uid = ?",
+                                    (gid, uid))
 
     async def sub_add_live(self, gid, uid, rid):
-        async with aiosqlite.connect(self.db_path) as conn:
-            await conn.execute("INSERT INTO bilibili_sublive (gid, uid, rid) VALUES (?, ?, ?)",
-                               (gid, uid, rid))
-            await conn.commit()
+        await self.db.execute_write("INSERT OR IGNORE INTO bilibili_sublive (gid, uid, rid) VALUES (?, ?, ?)",
+                                    (gid, uid, rid))
 
     async def sub_remove_live(self, gid, uid, rid):
-        async with aiosqlite.connect(self.db_path) as conn:
-            await conn.execute("DELETE FROM bilibili_sublive WHERE gid = ? AND uid = ? AND rid = ?",
-                               (gid, uid, rid))
-            await conn.commit()
+        await self.db.execute_write("DELETE FROM bilibili_sublive WHERE gid = ? AND uid = ? AND rid = ?",
+                                    (gid, uid, rid))
+
+    async def _get_rows(self, table, row_type, gid=None) -> list:
+        sql = f"SELECT {SUB_COLUMNS[table]} FROM {table}"
+        params = ()
+        if gid is not None:
+            sql += " WHERE gid = ?"
+            params = (gid,)
+        return [row_type(*row) async for row in self.db.iter_query(sql, params, row_type=tuple)]
 
     async def sub_get_video_group(self, gid) -> list[SubVideoInfo]:
-        async with aiosqlite.connect(self.db_path) as conn:
-            cursor = await conn.execute("SELECT * FROM bilibili_subvideo WHERE gid = ?", (gid,))
-            rows = await cursor.fetchall()
-            return [SubVideoInfo(*row) for row in rows]
+        return await self._get_rows("bilibili_subvideo", SubVideoInfo, gid)
 
     async def sub_get_video_all(self) -> list[SubVideoInfo]:
-        async with aiosqlite.connect(self.db_path) as conn:
-            cursor = await conn.execute("SELECT * FROM bilibili_subvideo")
-            rows = await cursor.fetchall()
-            return [SubVideoInfo(*row) for row in rows]
+        return await self._get_rows("bilibili_subvideo", SubVideoInfo)
 
     async def sub_get_dynamic_group(self, gid) -> list[SubDynamicInfo]:
-        async with aiosqlite.connect(self.db_path) as conn:
-            cursor = await conn.execute("SELECT * FROM bilibili_subdynamic WHERE gid = ?", (gid,))
-            rows = await cursor.fetchall()
-            return [SubDynamicInfo(*row) for row in rows]
+        return await self._get_rows("bilibili_subdynamic", SubDynamicInfo, gid)
 
     async def sub_get_dynamic_all(self) -> list[SubDynamicInfo]:
-        async with aiosqlite.connect(self.db_path) as conn:
-            cursor = await conn.execute("SELECT * FROM bilibili_subdynamic")
-            rows = await cursor.fetchall()
-            return [SubDynamicInfo(*row) for row in rows]
+        return await self._get_rows("bilibili_subdynamic", SubDynamicInfo)
 
     async def sub_get_live_group(self, gid) -> list[SubLiveInfo]:
-        async with aiosqlite.connect(self.db_path) as conn:
-            cursor = await conn.execute("SELECT * FROM bilibili_sublive WHERE gid = ?", (gid,))
-            rows = await cursor.fetchall()
-            return [SubLiveInfo(*row) for row in rows]
+        return await self._get_rows("bilibili_sublive", SubLiveInfo, gid)
 
     async def sub_get_live_all(self) -> list[SubLiveInfo]:
-        async with aiosqlite.connect(self.db_path) as conn:
-            cursor = await conn.execute("SELECT * FROM bilibili_sublive")
-            rows = await cursor.fetchall()
-            return [SubLiveInfo(*row) for row in rows]
+        return await self._get_rows("bilibili_sublive", SubLiveInfo)
+
+    # 流式读取全部订阅，按块fetchmany，避免订阅表过大时一次性载入内存
+    async def _iter_rows(self, table, row_type, chunk_size=256):
+        async for row in self.db.iter_query(f"SELECT {SUB_COLUMNS[table]} FROM {table}",
+                                            chunk_size=chunk_size, row_type=tuple):
+            yield row_type(*row)
+
+    async def sub_iter_video_all(self) -> AsyncIterator[SubVideoInfo]:
+        async for info in self._iter_rows("bilibili_subvideo", SubVideoInfo):
+            yield info
+
+    async def sub_iter_dynamic_all(self) -> AsyncIterator[SubDynamicInfo]:
+        async for info in self._iter_rows("bilibili_subdynamic", SubDynamicInfo):
+            yield info
+
+    async def sub_iter_live_all(self) -> AsyncIterator[SubLiveInfo]:
+        async for info in self._iter_rows("bilibili_sublive", SubLiveInfo):
+            yield info
 
     async def sub_set_video_last(self, gid, uid, video_id):
-        async with aiosqlite.connect(self.db_path) as conn:
-            await conn.execute("UPDATE bilibili_subvideo SET last_update_time = CURRENT_TIMESTAMP, last_update_video = ? WHERE gid = ? AND uid = ?",
-                               (video_id, gid, uid))
-            await conn.commit()
+        await self.db.execute_write("UPDATE bilibili_subvideo SET last_update_time = CURRENT_TIMESTAMP, last_update_video = ? WHERE gid = ? AND uid = ?",
+                                    (video_id, gid, uid))
 
     async def sub_set_dynamic_last(self, gid, uid, dynamic_id):
-        async with aiosqlite.connect(self.db_path) as conn:
-            await conn.execute("UPDATE bilibili_subdynamic SET last_update_time = CURRENT_TIMESTAMP, last_update_dynamic = ? WHERE gid = ? AND uid = ?",
-                               (dynamic_id, gid, uid))
-            await conn.commit()
+        await self.db.execute_write("UPDATE bilibili_subdynamic SET last_update_time = CURRENT_TIMESTAMP, last_update_dynamic = ? WHERE gid = ? AND uid = ?",
+                                    (dynamic_id, gid, uid))
 
+    # 按主键(gid, uid)更新，旧数据导入或添加时未知直播间的订阅rid为NULL，传入room_id时顺便补上
     async def sub_set_live_last(self, gid, uid, room_id, status):
-        async with aiosqlite.connect(self.db_path) as conn:
-            await conn.execute("UPDATE bilibili_sublive SET last_update_time = CURRENT_TIMESTAMP, status = ? WHERE gid = ? AND uid = ? AND rid = ?",
-                               (status, gid, uid, room_id))
-            await conn.commit()
+        await self.db.execute_write("UPDATE bilibili_sublive SET last_update_time = CURRENT_TIMESTAMP, status = ?, rid = COALESCE(?, rid) WHERE gid = ? AND uid = ?",
+                                    (status, room_id, gid, uid))
+
+    async def sub_set_live_last_batch(self, updates: Iterable[Tuple[str, str, str, bool]]):
+        """批量写回直播状态，updates为(gid, uid, rid, status)，在一个事务内提交"""
+        rows = [(status, rid, gid, uid) for gid, uid, rid, status in updates]
+        if rows:
+            await self.db.execute_many("UPDATE bilibili_sublive SET last_update_time = CURRENT_TIMESTAMP, status = ?, rid = COALESCE(?, rid) WHERE gid = ? AND uid = ?",
+                                       rows)
 
 
 
 if __name__ == '__main__':
-    db = bDatabase()
-    asyncio.run(db.init_database())
-    asyncio.run(db.sub_set_live_last("123", "456", "789", True))
-    data = asyncio.run(db.sub_get_live_all())
-    print(data)
+    async def main():
+        db = bDatabase()
+        await db.init_database()
+        await db.sub_set_live_last("123", "456", "789", True)
+        print(await db.sub_get_live_all())
+
+    asyncio.run(main())
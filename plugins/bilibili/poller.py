@@ -0,0 +1,370 @@
+'''
+订阅轮询：把订阅按UP主（uid）分组，每个UP主的视频、动态、直播状态各作为一个轮询任务，
+与各订阅记录的上次更新比较后，把新内容分发给所有订阅了这个UP主的群
+
+每个轮询任务有自己的下次轮询时间，保存在按时间排序的堆中：内容有更新后轮询间隔回到最小值，
+之后每次没有更新就逐渐拉长，上限由该UP主的平均更新间隔决定；直播中的UP主保持较短的间隔。
+直播状态一次请求可以查询多个UP主，同一时刻到期的直播任务合并为一次查询；
+同时运行的请求数和每秒请求数都有上限，以免触发bilibili的风控
+
+只向已授权并启用了本插件的群推送，推送消息写入发件箱（utils.database.outbox_db），由内核的发送器限速发送；
+去重键包含群号和内容id，同一条内容不会向同一个群推送两次
+'''
+import asyncio
+import datetime
+import heapq
+import random
+import time
+from collections import defaultdict
+from dataclasses import dataclass
+from typing import Dict, List, Optional, Set, Tuple, TypeVar, AsyncIterator
+
+from bilibili_api import user
+from bilibili_api.utils.network import Api
+from nonebot import logger
+
+from utils.database.group_db import GroupDatabase
+from utils.database.outbox_db import OutboxDatabase
+from utils.ratelimit import TokenBucket
+from .bilibili_db import bDatabase
+
+T = TypeVar("T")
+
+POLL_MIN_INTERVAL = 60.0        # 最短轮询间隔（秒），内容更新后回到这个值
+POLL_MAX_INTERVAL = 1800.0      # 最长轮询间隔（秒）
+POLL_BACKOFF = 1.5              # 没有更新时轮询间隔的增长倍数
+POLL_GAP_DIVISOR = 4            # 轮询间隔不超过平均更新间隔的几分之一
+POLL_LIVE_INTERVAL = 60.0       # 直播中的UP主，直播状态的轮询间隔
+POLL_LIVE_MAX_INTERVAL = 300.0  # 未开播的UP主，直播状态的最长轮询间隔
+POLL_ACTIVE_MAX_INTERVAL = 180.0  # 直播中的UP主，视频和动态的最长轮询间隔
+POLL_REFRESH_INTERVAL = 60.0    # 重新读取订阅列表的间隔（秒）
+POLL_CONCURRENCY = 2            # 同时进行的请求数
+POLL_RATE = 0.5                 # 每秒请求数
+POLL_BURST = 3
+LIVE_BATCH_SIZE = 50            # 每次请求查询的直播间数
+LIVE_BATCH_LOOKAHEAD = 10.0     # 即将在几秒内到期的直播任务也并入当前这次查询
+
+PLUGIN_NAME = "bilibili"
+
+LIVE_STATUS_URL = "https://api.live.bilibili.com/room/v1/Room/get_status_info_by_uids"
+
+
+@dataclass
+class VideoUpdate:
+    bvid: str
+    title: str
+    author: str
+
+
+@dataclass
+class DynamicUpdate:
+    dynamic_id: str
+    author: str
+
+
+@dataclass
+class LiveUpdate:
+    room_id: str
+    live: bool
+    title: str
+    author: str
+
+
+async def fetch_latest_video(uid: str) -> Optional[VideoUpdate]:
+    data = await user.User(int(uid)).get_videos(ps=1)
+    videos = data.get("list", {}).get("vlist") or []
+    if not videos:
+        return None
+    video = videos[0]
+    return VideoUpdate(video["bvid"], video.get("title", ""), video.get("author", uid))
+
+
+async def fetch_latest_dynamic(uid: str) -> Optional[DynamicUpdate]:
+    data = await user.User(int(uid)).get_dynamics_new()
+    # 置顶动态不一定是最新的，取id最大的一条
+    items = [item for item in data.get("items") or [] if item.get("id_str")]
+    if not items:
+        return None
+    item = max(items, key=lambda item: int(item["id_str"]))
+    author = item.get("modules", {}).get("module_author", {}).get("name", uid)
+    return DynamicUpdate(item["id_str"], author)
+
+
+async def fetch_live_statuses(uids: List[str]) -> Dict[str, LiveUpdate]:
+    """一次请求查询多个UP主的直播间状态，返回uid到直播状态的映射，没有直播间的UP主不在结果中"""
+    api = Api(url=LIVE_STATUS_URL, method="POST", json_body=True, no_csrf=True)
+    data = await api.update_data(uids=[int(uid) for uid in uids]).result
+    rooms = data.values() if isinstance(data, dict) else []
+    return {
+        str(room["uid"]): LiveUpdate(str(room["room_id"]), room.get("live_status") == 1,
+                                     room.get("title", ""), room.get("uname", str(room["uid"])))
+        for room in rooms
+    }
+
+
+async def group_by_uid(rows: AsyncIterator[T]) -> Dict[str, List[T]]:
+    groups: Dict[str, List[T]] = defaultdict(list)
+    async for row in rows:
+        groups[row.uid].append(row)
+    return groups
+
+
+class PollJob:
+    """一个UP主的一种订阅（video/dynamic/live）的轮询状态"""
+
+    __slots__ = ("kind", "uid", "subs", "interval", "next_at", "last_change", "gap", "running")
+
+    def __init__(self, kind: str, uid: str, next_at: float):
+        self.kind = kind
+        self.uid = uid
+        self.subs: list = []                # 订阅了这个UP主的各群的记录
+        self.interval = POLL_MIN_INTERVAL
+        self.next_at = next_at              # 下次轮询的时间（time.monotonic）
+        self.last_change: Optional[float] = None  # 上次发现更新的时间
+        self.gap: Optional[float] = None    # 更新间隔的指数移动平均
+        self.running = False
+
+
+class SubscriptionPoller:
+    """订阅轮询调度器，每个UP主的每种订阅单独安排下次轮询的时间"""
+
+    def __init__(self, db: bDatabase, outbox: OutboxDatabase, group_db: GroupDatabase,
+                 concurrency: int = POLL_CONCURRENCY, rate: float = POLL_RATE, burst: float = POLL_BURST):
+        self.db = db
+        self.outbox = outbox
+        self.group_db = group_db
+        self.jobs: Dict[Tuple[str, str], PollJob] = {}
+        self.live_uids: Set[str] = set()    # 正在直播的UP主
+        self.requests = 0   # 累计请求次数
+        self._heap: List[Tuple[float, int, Tuple[str, str]]] = []
+        self._seq = 0
+        self._slots = asyncio.Semaphore(concurrency)
+        self._budget = TokenBucket(rate, burst)
+        self._next_refresh = 0.0
+        self._tasks: Set[asyncio.Task] = set()
+        self._task: Optional[asyncio.Task] = None
+
+    def start(self):
+        if self._task is None or self._task.done():
+            self._task = asyncio.get_running_loop().create_task(self._run())
+
+    async def stop(self):
+        tasks = list(self._tasks)
+        if self._task is not None:
+            tasks.append(self._task)
+            self._task = None
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+
+    async def _run(self):
+        await self.db.init_database()
+        await self.outbox.initialize()
+        while True:
+            now = time.monotonic()
+            if now >= self._next_refresh:
+                self._next_refresh = now + POLL_REFRESH_INTERVAL
+                try:
+                    await self.refresh()
+                except Exception as e:
+                    logger.error(f"读取bilibili订阅失败: {str(e)}")
+                continue
+            if not self._heap or self._heap[0][0] > now:
+                wake = self._heap[0][0] if self._heap else self._next_refresh
+                await asyncio.sleep(min(wake, self._next_refresh) - now)
+                continue
+
+            next_at, _, key = heapq.heappop(self._heap)
+            job = self.jobs.get(key)
+            # 堆中可能留有已取消的订阅或已重新安排的旧记录
+            if job is None or job.next_at != next_at or job.running:
+                continue
+            # 直播状态按批查询，顺带查询其余最早到期的直播任务
+            batch = self._live_batch(job) if job.kind == "live" else [job]
+            await self._budget.acquire()
+            await self._slots.acquire()
+            for item in batch:
+                item.running = True
+            task = asyncio.get_running_loop().create_task(
+                self._poll_live(batch) if job.kind == "live" else self._poll(job)
+            )
+            self._tasks.add(task)
+            task.add_done_callback(self._tasks.discard)
+
+    async def refresh(self):
+        """重新读取订阅列表：新的UP主加入调度（随机错开首次轮询），已无人订阅的移出"""
+        tables = {
+            "video": await group_by_uid(self.db.sub_iter_video_all()),
+            "dynamic": await group_by_uid(self.db.sub_iter_dynamic_all()),
+            "live": await group_by_uid(self.db.sub_iter_live_all()),
+        }
+        now = time.monotonic()
+        current = set()
+        for kind, groups in tables.items():
+            for uid, subs in groups.items():
+                key = (kind, uid)
+                current.add(key)
+                job = self.jobs.get(key)
+                if job is None:
+                    job = self.jobs[key] = PollJob(kind, uid, now + random.uniform(0, POLL_MIN_INTERVAL))
+                    self._push(job)
+                job.subs = subs
+        for key in self.jobs.keys() - current:
+            del self.jobs[key]
+        self.live_uids &= {uid for kind, uid in current if kind == "live"}
+        logger.debug(f"bilibili订阅：{sum(len(groups) for groups in tables.values())}个轮询任务，"
+                     f"{sum(len(subs) for groups in tables.values() for subs in groups.values())}条订阅")
+
+    def _live_batch(self, job: PollJob) -> List[PollJob]:
+        """与job一起查询的直播任务：只取已到期（或LIVE_BATCH_LOOKAHEAD秒内到期）的，其余留在堆中按各自的间隔轮询"""
+        horizon = time.monotonic() + LIVE_BATCH_LOOKAHEAD
+        others = heapq.nsmallest(
+            LIVE_BATCH_SIZE - 1,
+            (other for other in self.jobs.values()
+             if other.kind == "live" and other is not job and not other.running and other.next_at <= horizon),
+            key=lambda other: other.next_at
+        )
+        return [job] + others
+
+    def _push(self, job: PollJob):
+        self._seq += 1
+        heapq.heappush(self._heap, (job.next_at, self._seq, (job.kind, job.uid)))
+
+    async def _poll(self, job: PollJob):
+        changed = False
+        try:
+            self.requests += 1
+            if job.kind == "video":
+                changed = await self._check_video(job.uid, job.subs)
+            else:
+                changed = await self._check_dynamic(job.uid, job.subs)
+        except Exception as e:
+            logger.warning(f"bilibili UP主{job.uid}的{job.kind}轮询失败: {str(e)}")
+        finally:
+            self._slots.release()
+            job.running = False
+        self._reschedule(job, changed)
+
+    async def _poll_live(self, jobs: List[PollJob]):
+        changed: Set[str] = set()
+        try:
+            self.requests += 1
+            changed = await self._check_live(jobs)
+        except Exception as e:
+            logger.warning(f"bilibili直播状态批量查询失败（{len(jobs)}个UP主）: {str(e)}")
+        finally:
+            self._slots.release()
+            for job in jobs:
+                job.running = False
+        for job in jobs:
+            self._reschedule(job, job.uid in changed)
+
+    def _reschedule(self, job: PollJob, changed: bool):
+        now = time.monotonic()
+        if changed:
+            if job.last_change is not None:
+                gap = now - job.last_change
+                job.gap = gap if job.gap is None else job.gap * 0.7 + gap * 0.3
+            job.last_change = now
+            job.interval = POLL_MIN_INTERVAL
+        else:
+            job.interval *= POLL_BACKOFF
+
+        if job.kind == "live":
+            limit = POLL_LIVE_INTERVAL if job.uid in self.live_uids else POLL_LIVE_MAX_INTERVAL
+        elif job.uid in self.live_uids:
+            limit = POLL_ACTIVE_MAX_INTERVAL
+        elif job.gap is not None:
+            limit = min(max(job.gap / POLL_GAP_DIVISOR, POLL_MIN_INTERVAL), POLL_MAX_INTERVAL)
+        else:
+            limit = POLL_MAX_INTERVAL
+        job.interval = min(max(job.interval, POLL_MIN_INTERVAL), limit)
+        job.next_at = now + job.interval
+        # 轮询期间订阅可能已被全部取消
+        if self.jobs.get((job.kind, job.uid)) is job:
+            self._push(job)
+
+    async def _can_push(self, gid: str) -> bool:
+        """群已授权且启用了本插件时才推送；不推送的群照常记录最新状态，重新启用后不会补发旧内容"""
+        return (await self.group_db.is_group_authed(gid)
+                and await self.group_db.is_plugin_enabled(gid, PLUGIN_NAME))
+
+    async def _check_video(self, uid: str, subs: list) -> bool:
+        latest = await fetch_latest_video(uid)
+        if latest is None:
+            return False
+        changed = False
+        for sub in subs:
+            if sub.last_update_video == latest.bvid:
+                continue
+            # 刚添加的订阅只记录当前最新的视频，不推送
+            if sub.last_update_video is not None:
+                changed = True
+            if sub.last_update_video is not None and await self._can_push(sub.gid):
+                await self.outbox.enqueue(
+                    "group", sub.gid,
+                    f"{latest.author}发布了新视频：\n{latest.title}\nhttps://www.bilibili.com/video/{latest.bvid}",
+                    dedup_key=f"bilibili:video:{sub.gid}:{latest.bvid}"
+                )
+            await self.db.sub_set_video_last(sub.gid, uid, latest.bvid)
+            sub.last_update_video = latest.bvid
+        return changed
+
+    async def _check_dynamic(self, uid: str, subs: list) -> bool:
+        latest = await fetch_latest_dynamic(uid)
+        if latest is None:
+            return False
+        changed = False
+        for sub in subs:
+            if sub.last_update_dynamic == latest.dynamic_id:
+                continue
+            if sub.last_update_dynamic is not None:
+                changed = True
+            if sub.last_update_dynamic is not None and await self._can_push(sub.gid):
+                await self.outbox.enqueue(
+                    "group", sub.gid,
+                    f"{latest.author}发布了新动态：\nhttps://t.bilibili.com/{latest.dynamic_id}",
+                    dedup_key=f"bilibili:dynamic:{sub.gid}:{latest.dynamic_id}"
+                )
+            await self.db.sub_set_dynamic_last(sub.gid, uid, latest.dynamic_id)
+            sub.last_update_dynamic = latest.dynamic_id
+        return changed
+
+    async def _check_live(self, jobs: List[PollJob]) -> Set[str]:
+        """查询一批UP主的直播状态，与各订阅记录的status比较，只写回和推送实际发生的开播/下播，返回状态变化的uid"""
+        statuses = await fetch_live_statuses([job.uid for job in jobs])
+        updates = []
+        messages = []
+        changed = set()
+        now = datetime.datetime.now(datetime.timezone.utc).strftime("%Y-%m-%d %H:%M:%S")
+        for job in jobs:
+            latest = statuses.get(job.uid)
+            if latest is None:
+                continue
+            if latest.live:
+                self.live_uids.add(job.uid)
+            else:
+                self.live_uids.discard(job.uid)
+            for sub in job.subs:
+                status = None if sub.status is None else bool(sub.status)
+                if status == latest.live:
+                    continue
+                # 刚添加的订阅只记录当前状态，不推送
+                if status is not None:
+                    changed.add(job.uid)
+                if status is not None and await self._can_push(sub.gid):
+                    if latest.live:
+                        message = f"{latest.author}开播了：{latest.title}\nhttps://live.bilibili.com/{latest.room_id}"
+                    else:
+                        message = f"{latest.author}下播了"
+                    messages.append((
+                        "group", sub.gid, message,
+                        f"bilibili:live:{sub.gid}:{latest.room_id}:{latest.live}:{sub.last_update_time}"
+                    ))
+                updates.append((sub.gid, job.uid, latest.room_id, latest.live))
+                sub.status = latest.live
+                sub.last_update_time = now
+        # 先入队再写回状态：写回前中断时下次会重新入队，由去重键保证不重复推送
+        await self.outbox.enqueue_many(messages)
+        await self.db.sub_set_live_last_batch(updates)
+        return changed
@@ -0,0 +1,168 @@
+'''
+链接解析：从群消息的文本和小程序卡片（json消息段）中找出bilibili的短链接、视频、专栏、直播间链接，
+获取标题等信息后回复摘要
+
+每条消息先用一个只包含固定关键词的正则预筛，绝大多数消息在这一步就被排除，
+不会执行提取链接的正则，也不会解析卡片的JSON；卡片只把转义的斜杠还原后按文本匹配。
+短链接的跳转结果和视频/专栏/直播间的信息都放在有大小上限的TTL缓存中，
+同一个链接同时出现在多个群里时只请求一次
+'''
+import re
+from typing import List, Optional, Tuple
+
+from bilibili_api import article, live, video
+from bilibili_api.utils.network import get_client
+from nonebot import logger
+from nonebot.adapters import Message
+
+from utils.cache import TTLCache
+
+RESOLVE_MAX_LINKS = 3               # 每条消息最多解析的链接数
+SHORT_LINK_CACHE_SIZE = 2048
+SHORT_LINK_TTL = 24 * 3600.0        # 短链接的跳转目标基本不变
+INFO_CACHE_SIZE = 1024
+INFO_TTL = 180.0                    # 播放量、直播状态等会变化
+
+# 预筛：只含固定字符串，没有可回溯的部分
+_PREFILTER = re.compile(r"b23\.tv|bili2233\.cn|bilibili\.com|BV1")
+
+_LINK_PATTERN = re.compile(
+    r"(?P<short>(?:b23\.tv|bili2233\.cn)/[0-9A-Za-z]+)"
+    r"|(?<![0-9A-Za-z])(?P<bvid>BV1[0-9A-Za-z]{9})(?![0-9A-Za-z])"
+    r"|bilibili\.com/video/av(?P<aid>\d+)"
+    r"|bilibili\.com/read/cv(?P<cvid>\d+)"
+    r"|live\.bilibili\.com/(?:h5/)?(?P<room>\d+)"
+)
+
+
+def message_text(message: Message) -> str:
+    """取出消息中的文本和卡片内容，卡片JSON中转义的斜杠还原后一起按文本处理"""
+    parts = []
+    for segment in message:
+        if segment.type == "text":
+            parts.append(segment.data.get("text", ""))
+        elif segment.type == "json":
+            parts.append(str(segment.data.get("data", "")).replace("\\/", "/"))
+    return "\n".join(parts)
+
+
+def prefilter(text: str) -> bool:
+    return _PREFILTER.search(text) is not None
+
+
+def extract_links(text: str) -> List[Tuple[str, str]]:
+    """按出现顺序返回去重后的(类型, id)，类型为short/video/article/live"""
+    links = []
+    for match in _LINK_PATTERN.finditer(text):
+        if match["short"]:
+            link = ("short", match["short"])
+        elif match["bvid"]:
+            link = ("video", match["bvid"])
+        elif match["aid"]:
+            link = ("video", "av" + match["aid"])
+        elif match["cvid"]:
+            link = ("article", match["cvid"])
+        else:
+            link = ("live", match["room"])
+        if link not in links:
+            links.append(link)
+    return links
+
+
+async def expand_short_link(short: str) -> Optional[str]:
+    """返回短链接的跳转目标，链接无效时返回None"""
+    resp = await get_client().request("GET", f"https://{short}", allow_redirects=False)
+    headers = {key.lower(): value for key, value in resp.headers.items()}
+    return headers.get("location")
+
+
+async def fetch_video_summary(video_id: str) -> str:
+    if video_id.startswith("av"):
+        v = video.Video(aid=int(video_id[2:]))
+    else:
+        v = video.Video(bvid=video_id)
+    info = await v.get_info()
+    stat = info.get("stat", {})
+    return (
+        f"{info['title']}\n"
+        f"UP主：{info.get('owner', {}).get('name', '')}\n"
+        f"播放 {stat.get('view', 0)} · 点赞 {stat.get('like', 0)}\n"
+        f"https://www.bilibili.com/video/{info.get('bvid', video_id)}"
+    )
+
+
+async def fetch_article_summary(cvid: str) -> str:
+    info = await article.Article(int(cvid)).get_info()
+    return (
+        f"{info['title']}\n"
+        f"作者：{info.get('author_name', '')}\n"
+        f"阅读 {info.get('stats', {}).get('view', 0)}\n"
+        f"https://www.bilibili.com/read/cv{cvid}"
+    )
+
+
+async def fetch_live_summary(room: str) -> str:
+    info = await live.LiveRoom(int(room)).get_room_info()
+    room_info = info.get("room_info", {})
+    uname = info.get("anchor_info", {}).get("base_info", {}).get("uname", "")
+    status = "直播中" if room_info.get("live_status") == 1 else "未开播"
+    return (
+        f"{uname}的直播间：{room_info.get('title', '')}（{status}）\n"
+        f"https://live.bilibili.com/{room_info.get('room_id', room)}"
+    )
+
+
+_FETCHERS = {
+    "video": fetch_video_summary,
+    "article": fetch_article_summary,
+    "live": fetch_live_summary,
+}
+
+
+class LinkResolver:
+    """把消息中的bilibili链接解析为摘要，短链接和摘要分别缓存"""
+
+    def __init__(self, max_links: int = RESOLVE_MAX_LINKS):
+        self.max_links = max_links
+        self.short_links = TTLCache(SHORT_LINK_CACHE_SIZE, SHORT_LINK_TTL)
+        self.infos = TTLCache(INFO_CACHE_SIZE, INFO_TTL)
+
+    async def resolve(self, text: str) -> List[str]:
+        targets = []
+        for kind, value in extract_links(text):
+            if kind == "short":
+                target = await self._expand(value)
+                if target is None:
+                    continue
+                # 跳转目标中不会再有短链接
+                kind, value = target
+            if (kind, value) not in targets:
+                targets.append((kind, value))
+            if len(targets) >= self.max_links:
+                break
+
+        summaries = []
+        for kind, value in targets:
+            try:
+                summaries.append(
+                    await self.infos.get_or_load((kind, value), lambda: _FETCHERS[kind](value))
+                )
+            except Exception as e:
+                logger.warning(f"bilibili {kind} {value}解析失败: {str(e)}")
+        return summaries
+
+    async def _expand(self, short: str) -> Optional[Tuple[str, str]]:
+        async def load():
+            url = await expand_short_link(short)
+            links = [link for link in extract_links(url or "") if link[0] != "short"]
+            # 无效的短链接也缓存，避免重复请求
+            return links[0] if links else None
+
+        try:
+            return await self.short_links.get_or_load(short, load)
+        except Exception as e:
+            logger.warning(f"bilibili短链接{short}解析失败: {str(e)}")
+            return None
+
+
+link_resolver = LinkResolver()
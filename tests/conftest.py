@@ -0,0 +1,21 @@
+import sys
+from pathlib import Path
+
+import nonebot
+import pytest
+
+sys.path.insert(0, str(Path(__file__).parent.parent))
+
+# 内核插件和bilibili插件在导入时会调用get_driver()
+nonebot.init(driver="~none")
+
+from utils.database.database_manager import DatabaseManager, Singleton  # noqa: E402
+
+
+@pytest.fixture
+def db(tmp_path):
+    """使用临时文件的DatabaseManager；DatabaseManager是单例，测试前后都替换掉已有实例"""
+    Singleton._instances.pop(DatabaseManager, None)
+    manager = DatabaseManager(db_path=tmp_path / "test.db")
+    yield manager
+    Singleton._instances.pop(DatabaseManager, None)
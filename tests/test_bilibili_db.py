@@ -0,0 +1,22 @@
+import asyncio
+
+from plugins.bilibili.bilibili_db import bDatabase
+
+
+def test_live_status_saved_for_rows_without_room_id(db, tmp_path):
+    async def main():
+        bili_db = bDatabase(legacy_path=tmp_path / "missing.db")
+        await bili_db.init_database()
+        # 旧数据导入的订阅可能没有rid
+        await bili_db.sub_add_live("1", "100", None)
+        await bili_db.sub_add_live("2", "200", "900")
+        await bili_db.sub_set_live_last_batch([("1", "100", "800", True), ("2", "200", None, True)])
+        await bili_db.sub_set_live_last("1", "100", None, False)
+        rows = {row.gid: row for row in await bili_db.sub_get_live_all()}
+        await db.close()
+        return rows
+
+    rows = asyncio.run(main())
+    assert (rows["1"].rid, bool(rows["1"].status)) == ("800", False)
+    assert (rows["2"].rid, bool(rows["2"].status)) == ("900", True)
+    assert rows["1"].last_update_time is not None
@@ -0,0 +1,39 @@
+import json
+
+from nonebot.adapters.onebot.v11 import Message, MessageSegment
+
+from plugins.bilibili.resolver import extract_links, message_text, prefilter
+
+
+def test_prefilter():
+    assert not prefilter("今天吃什么")
+    assert not prefilter("bilibili")
+    assert prefilter("https://b23.tv/abc")
+    assert prefilter("BV1xx411c7mD")
+
+
+def test_extract_links_kinds_and_dedup():
+    text = (
+        "BV1xx411c7mD https://www.bilibili.com/video/BV1xx411c7mD "
+        "https://m.bilibili.com/video/av170001 https://www.bilibili.com/read/cv12345 "
+        "https://live.bilibili.com/h5/21452505 https://b23.tv/AbCdEf1"
+    )
+    assert extract_links(text) == [
+        ("video", "BV1xx411c7mD"),
+        ("video", "av170001"),
+        ("article", "12345"),
+        ("live", "21452505"),
+        ("short", "b23.tv/AbCdEf1"),
+    ]
+
+
+def test_bvid_must_stand_alone():
+    assert extract_links("xBV1xx411c7mD") == []
+    assert extract_links("BV1xx411c7mDx") == []
+
+
+def test_card_links_are_extracted_without_parsing():
+    card = json.dumps({"meta": {"detail_1": {"qqdocurl": "https://b23.tv/AbCdEf1?share_medium=android"}}})
+    text = message_text(Message([MessageSegment.text("看 "), MessageSegment.json(card)]))
+    assert prefilter(text)
+    assert extract_links(text) == [("short", "b23.tv/AbCdEf1")]
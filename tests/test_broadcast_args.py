@@ -0,0 +1,33 @@
+import pytest
+
+from kernel.broadcast import parse_broadcast_args
+
+
+def test_plain_message():
+    assert parse_broadcast_args("  大家好  ") == ({}, "大家好")
+
+
+def test_all_options():
+    filters, message = parse_broadcast_args("--authed --plugin bilibili --expiring 3 维护通知")
+    assert filters == {"authed_only": True, "plugin": "bilibili", "expiring_days": 3}
+    assert message == "维护通知"
+
+
+def test_authed_does_not_consume_message():
+    assert parse_broadcast_args("--authed 你好") == ({"authed_only": True}, "你好")
+
+
+def test_options_only_at_start():
+    filters, message = parse_broadcast_args("注意 --authed 不是选项")
+    assert filters == {}
+    assert message == "注意 --authed 不是选项"
+
+
+def test_unknown_option_is_message():
+    assert parse_broadcast_args("--all 你好") == ({}, "--all 你好")
+
+
+@pytest.mark.parametrize("argline", ["--plugin", "--expiring", "--expiring abc 你好"])
+def test_invalid_option_values(argline):
+    with pytest.raises(ValueError):
+        parse_broadcast_args(argline)
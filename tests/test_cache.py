@@ -0,0 +1,113 @@
+import asyncio
+
+import pytest
+
+import utils.cache
+from utils.cache import TTLCache
+
+
+class FakeClock:
+    def __init__(self):
+        self.now = 1000.0
+
+    def __call__(self):
+        return self.now
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    clock = FakeClock()
+    monkeypatch.setattr(utils.cache.time, "monotonic", clock)
+    return clock
+
+
+def test_entries_expire_after_ttl(clock):
+    cache = TTLCache(maxsize=10, ttl=5)
+    cache.set("a", 1)
+    clock.now += 4.9
+    assert cache.get("a") == 1
+    clock.now += 0.2
+    assert cache.get("a") is None
+    assert len(cache) == 0
+
+
+def test_least_recently_used_entry_is_evicted():
+    cache = TTLCache(maxsize=2, ttl=60)
+    cache.set("a", 1)
+    cache.set("b", 2)
+    cache.get("a")
+    cache.set("c", 3)
+    assert cache.get("b") is None
+    assert cache.get("a") == 1
+    assert cache.get("c") == 3
+
+
+def test_invalidate_by_predicate():
+    cache = TTLCache(maxsize=10, ttl=60)
+    cache.set(("g", 1), 1)
+    cache.set(("g", 2), 2)
+    cache.invalidate(lambda key: key[1] == 1)
+    assert cache.get(("g", 1)) is None
+    assert cache.get(("g", 2)) == 2
+
+
+def test_concurrent_loads_are_coalesced():
+    cache = TTLCache(maxsize=10, ttl=60)
+    calls = []
+
+    async def load():
+        calls.append(1)
+        await asyncio.sleep(0.01)
+        return "value"
+
+    async def main():
+        results = await asyncio.gather(*(cache.get_or_load("k", load) for _ in range(20)))
+        again = await cache.get_or_load("k", load)
+        return results, again
+
+    results, again = asyncio.run(main())
+    assert results == ["value"] * 20
+    assert again == "value"
+    assert len(calls) == 1
+    assert cache.hits == 1
+
+
+def test_cancelled_caller_does_not_fail_other_waiters():
+    cache = TTLCache(maxsize=10, ttl=60)
+    calls = []
+
+    async def load():
+        calls.append(1)
+        await asyncio.sleep(0.05)
+        return 42
+
+    async def main():
+        first = asyncio.create_task(cache.get_or_load("k", load))
+        await asyncio.sleep(0)
+        second = asyncio.create_task(cache.get_or_load("k", load))
+        await asyncio.sleep(0.01)
+        first.cancel()
+        with pytest.raises(asyncio.CancelledError):
+            await first
+        return await second
+
+    assert asyncio.run(main()) == 42
+    assert len(calls) == 1
+    assert cache.get("k") == 42
+
+
+def test_failed_load_is_not_cached():
+    cache = TTLCache(maxsize=10, ttl=60)
+
+    async def fail():
+        raise ValueError("boom")
+
+    async def ok():
+        return 1
+
+    async def main():
+        with pytest.raises(ValueError):
+            await cache.get_or_load("k", fail)
+        return await cache.get_or_load("k", ok)
+
+    assert asyncio.run(main()) == 1
@@ -0,0 +1,52 @@
+import asyncio
+from datetime import datetime
+
+import pytest
+
+from utils.database.cdkey_db import CDKeyDatabase, CDKEY_BULK_MAX_ROUNDS
+
+
+def test_bulk_create_regenerates_collisions(db):
+    keys = iter(["OLD1", "NEW1", "OLD2", "NEW2", "NEW1", "NEW3"])
+
+    async def main():
+        cdkey_db = CDKeyDatabase()
+        await cdkey_db.initialize()
+        now = datetime.now()
+        await cdkey_db.create_cdkey("OLD1", 7, now, None)
+        await cdkey_db.create_cdkey("OLD2", 7, now, None)
+        created = await cdkey_db.create_cdkeys_bulk(3, 30, now, None, lambda: next(keys))
+        old = await cdkey_db.get_cdkey("OLD1")
+        total = len(await cdkey_db.get_all_cdkeys())
+        await cdkey_db.db.close()
+        return created, old, total
+
+    created, old, total = asyncio.run(main())
+    assert sorted(created) == ["NEW1", "NEW2", "NEW3"]
+    # 已有的CDKey不会被覆盖
+    assert old["days"] == 7
+    assert total == 5
+
+
+def test_bulk_create_gives_up_after_max_rounds(db):
+    calls = []
+
+    def factory():
+        calls.append(1)
+        return "TAKEN"
+
+    async def main():
+        cdkey_db = CDKeyDatabase()
+        await cdkey_db.initialize()
+        await cdkey_db.create_cdkey("TAKEN", 7, datetime.now(), None)
+        try:
+            with pytest.raises(RuntimeError):
+                await cdkey_db.create_cdkeys_bulk(1, 30, datetime.now(), None, factory)
+            # 失败时整个事务回滚
+            return len(await cdkey_db.get_all_cdkeys())
+        finally:
+            await cdkey_db.db.close()
+
+    assert asyncio.run(main()) == 1
+    # 每轮只调用一次key_factory，不会无限重试
+    assert len(calls) == CDKEY_BULK_MAX_ROUNDS
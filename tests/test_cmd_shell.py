@@ -0,0 +1,43 @@
+import asyncio
+
+import kernel.cmd.shell as shell
+from kernel.cmd.shell import run_command
+
+
+def test_output_after_progress_interval_without_callback(monkeypatch):
+    monkeypatch.setattr(shell, "CMD_PROGRESS_INTERVAL", 0.2)
+    monkeypatch.setattr(shell, "CMD_TIMEOUT", 5.0)
+
+    async def main():
+        loop = asyncio.get_running_loop()
+        start = loop.time()
+        result = await run_command("sleep 0.6; echo hi")
+        return result, loop.time() - start
+
+    result, elapsed = asyncio.run(main())
+    assert result.text == "hi\n"
+    assert not result.timed_out
+    assert result.returncode == 0
+    assert elapsed < 3
+
+
+def test_progress_callback_receives_output(monkeypatch):
+    monkeypatch.setattr(shell, "CMD_PROGRESS_INTERVAL", 0.2)
+    monkeypatch.setattr(shell, "CMD_TIMEOUT", 5.0)
+    progress = []
+
+    async def on_progress(text):
+        progress.append(text)
+
+    result = asyncio.run(run_command("echo a; sleep 1; echo b", on_progress))
+    assert result.text == "a\nb\n"
+    assert not result.timed_out
+    assert progress == ["a"], progress
+
+
+def test_timeout_kills_command(monkeypatch):
+    monkeypatch.setattr(shell, "CMD_TIMEOUT", 0.5)
+
+    result = asyncio.run(run_command("echo start; sleep 10"))
+    assert result.timed_out
+    assert result.text == "start\n"
@@ -0,0 +1,98 @@
+import asyncio
+
+import pytest
+
+from utils.database.database_manager import TableDefinition
+
+
+def _register(db):
+    db.register_table(TableDefinition(
+        name="item",
+        create_sql="CREATE TABLE item (id INTEGER PRIMARY KEY, name TEXT NOT NULL)",
+        migrations=[]
+    ))
+
+
+def test_transaction_commits_and_runs_callbacks(db):
+    _register(db)
+    called = []
+
+    async def main():
+        await db.initialize()
+        async with db.transaction() as tx:
+            await db.execute_write("INSERT INTO item (name) VALUES (?)", ("a",), tx=tx)
+            await db.execute_many("INSERT INTO item (name) VALUES (?)", [("b",), ("c",)], tx=tx)
+            tx.call_after_commit(lambda: called.append(True))
+            # 提交前不执行
+            assert called == []
+        rows = await db.execute_query("SELECT name FROM item ORDER BY id")
+        await db.close()
+        return rows
+
+    rows = asyncio.run(main())
+    assert [row["name"] for row in rows] == ["a", "b", "c"]
+    assert called == [True]
+
+
+def test_transaction_rolls_back_on_error(db):
+    _register(db)
+    called = []
+
+    async def main():
+        await db.initialize()
+        await db.execute_write("INSERT INTO item (name) VALUES (?)", ("kept",))
+        with pytest.raises(RuntimeError):
+            async with db.transaction() as tx:
+                await db.execute_write("INSERT INTO item (name) VALUES (?)", ("dropped",), tx=tx)
+                tx.call_after_commit(lambda: called.append(True))
+                raise RuntimeError("boom")
+        # 回滚后写连接仍可用
+        await db.execute_write("INSERT INTO item (name) VALUES (?)", ("after",))
+        rows = await db.execute_query("SELECT name FROM item ORDER BY id")
+        await db.close()
+        return rows
+
+    rows = asyncio.run(main())
+    assert [row["name"] for row in rows] == ["kept", "after"]
+    assert called == []
+
+
+def test_concurrent_writes_are_all_committed(db):
+    _register(db)
+
+    async def main():
+        await db.initialize()
+        await asyncio.gather(*(
+            db.execute_write("INSERT INTO item (name) VALUES (?)", (str(i),)) for i in range(100)
+        ))
+        rows = await db.execute_query("SELECT COUNT(*) AS n FROM item")
+        await db.close()
+        return rows[0]["n"]
+
+    assert asyncio.run(main()) == 100
+
+
+def test_closed_database_rejects_new_operations(db):
+    _register(db)
+
+    async def main():
+        await db.initialize()
+        pending = asyncio.ensure_future(db.execute_write("INSERT INTO item (name) VALUES (?)", ("queued",)))
+        await asyncio.sleep(0)
+        await db.close()
+        # 关闭前已入队的写入仍会提交
+        await pending
+        for operation in (
+            lambda: db.execute_write("INSERT INTO item (name) VALUES (?)", ("late",)),
+            lambda: db.execute_many("INSERT INTO item (name) VALUES (?)", [("late",)]),
+            lambda: db.execute_query("SELECT * FROM item"),
+        ):
+            with pytest.raises(RuntimeError):
+                await operation()
+        with pytest.raises(RuntimeError):
+            async with db.transaction():
+                pass
+        await db.close()
+        return db._writer_task, db._writer_conn
+
+    assert asyncio.run(main()) == (None, None)
@@ -0,0 +1,54 @@
+import asyncio
+
+from utils.database.outbox_db import OutboxDatabase
+
+
+def test_claimed_messages_are_reclaimed_after_lease(db):
+    async def main():
+        outbox = OutboxDatabase()
+        await outbox.initialize()
+        await outbox.enqueue_many([("group", "1", "a", "k1"), ("group", "2", "b", "k2")])
+
+        first = await outbox.claim(10, now=100.0, lease=60.0)
+        # 租约未到期时不会重复取出，下次到期时间是租约到期时间
+        again = await outbox.claim(10, now=120.0, lease=60.0)
+        due = await outbox.next_due_time()
+        # 没有写回结果（如complete失败），租约到期后重新取出
+        reclaimed = await outbox.claim(10, now=161.0, lease=60.0)
+        await db.close()
+        return first, again, due, reclaimed
+
+    first, again, due, reclaimed = asyncio.run(main())
+    assert [row["message"] for row in first] == ["a", "b"]
+    assert again == []
+    assert due == 160.0
+    assert [row["id"] for row in reclaimed] == [row["id"] for row in first]
+
+
+def test_reset_inflight_makes_messages_due_immediately(db):
+    async def main():
+        outbox = OutboxDatabase()
+        await outbox.initialize()
+        await outbox.enqueue("group", "1", "a")
+        await outbox.claim(10, now=100.0, lease=600.0)
+        await outbox.reset_inflight()
+        rows = await outbox.claim(10, now=101.0, lease=600.0)
+        await db.close()
+        return rows
+
+    assert [row["message"] for row in asyncio.run(main())] == ["a"]
+
+
+def test_completed_messages_are_not_reclaimed(db):
+    async def main():
+        outbox = OutboxDatabase()
+        await outbox.initialize()
+        await outbox.enqueue("group", "1", "a")
+        rows = await outbox.claim(10, now=100.0, lease=60.0)
+        await outbox.complete([rows[0]["id"]], [], [])
+        due = await outbox.next_due_time()
+        later = await outbox.claim(10, now=1000.0, lease=60.0)
+        await db.close()
+        return due, later
+
+    assert asyncio.run(main()) == (None, [])
@@ -0,0 +1,32 @@
+import pytest
+
+from utils.qqdata import GroupMemberTable
+
+
+def _table() -> GroupMemberTable:
+    table = GroupMemberTable(100)
+    table.upsert(1, join_time=10, last_sent_time=20, role="owner", level="LV5")
+    table.upsert(2, join_time=11, last_sent_time=21, role="member", level="LV1")
+    table.upsert(3, join_time=12, last_sent_time=22, role="admin", level="LV3")
+    return table
+
+
+def test_row_follows_table_updates():
+    table = _table()
+    row = table.row(3)
+    table.touch(3, 99)
+    # 删除其他成员会移动行号，视图仍指向同一个成员
+    table.remove(1)
+    assert row.present
+    assert (row.role, row.level, row.join_time, row.last_sent_time) == ("admin", "LV3", 12, 99)
+
+
+def test_row_of_member_who_left():
+    table = _table()
+    row = table.row(2)
+    table.remove(2)
+    assert not row.present
+    with pytest.raises(LookupError, match="已不在群100"):
+        row.role
+    assert repr(row) == "GroupMemberRow(user_id=2, present=False)"
+    assert table.row(2) is None
@@ -0,0 +1,85 @@
+import asyncio
+import time
+from collections import OrderedDict
+from typing import Any, Awaitable, Callable, Dict, Hashable, Optional, Tuple
+
+_MISSING = object()
+
+
+class TTLCache:
+    """带过期时间的LRU缓存
+
+    超过maxsize时淘汰最久未使用的条目，条目写入ttl秒后过期。
+    get_or_load会合并同一个键上并发的加载，同一时刻同一个键只有一个加载在进行
+    """
+
+    def __init__(self, maxsize: int, ttl: float):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self._data: "OrderedDict[Hashable, Tuple[float, Any]]" = OrderedDict()
+        self._inflight: Dict[Hashable, asyncio.Future] = {}
+        # 每次失效都会递增，加载期间发生过失效的结果不写入缓存
+        self._generation = 0
+        self.hits = 0
+        self.misses = 0
+
+    def __len__(self) -> int:
+        return len(self._data)
+
+    def get(self, key: Hashable, default: Any = None) -> Any:
+        item = self._data.get(key)
+        if item is None:
+            return default
+        expires_at, value = item
+        if expires_at < time.monotonic():
+            del self._data[key]
+            return default
+        self._data.move_to_end(key)
+        return value
+
+    def set(self, key: Hashable, value: Any):
+        self._data[key] = (time.monotonic() + self.ttl, value)
+        self._data.move_to_end(key)
+        while len(self._data) > self.maxsize:
+            self._data.popitem(last=False)
+
+    def invalidate(self, match: Optional[Callable[[Hashable], bool]] = None):
+        """清除满足match的键，不传match时全部清除"""
+        self._generation += 1
+        if match is None:
+            self._data.clear()
+            return
+        for key in [key for key in self._data if match(key)]:
+            del self._data[key]
+
+    async def get_or_load(self, key: Hashable, loader: Callable[[], Awaitable[Any]]) -> Any:
+        """命中时直接返回，否则调用loader加载并写入缓存，并发的相同请求共享同一次加载"""
+        value = self.get(key, _MISSING)
+        if value is not _MISSING:
+            self.hits += 1
+            return value
+        self.misses += 1
+
+        # 加载在单独的任务中进行，调用方被取消时加载继续，其他等待同一个键的调用方不受影响
+        task = self._inflight.get(key)
+        if task is None:
+            task = asyncio.get_running_loop().create_task(self._load(key, loader))
+            task.add_done_callback(_retrieve_exception)
+            self._inflight[key] = task
+        return await asyncio.shield(task)
+
+    async def _load(self, key: Hashable, loader: Callable[[], Awaitable[Any]]) -> Any:
+        generation = self._generation
+        try:
+            value = await loader()
+        finally:
+            del self._inflight[key]
+        if generation == self._generation:
+            self.set(key, value)
+        return value
+
+
+def _retrieve_exception(task: asyncio.Task):
+    # 所有调用方都已取消时没有人读取异常，避免“exception was never retrieved”警告
+    if not task.cancelled():
+        task.exception()
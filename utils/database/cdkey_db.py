@@ -1,6 +1,11 @@
+import json
 from datetime import datetime
-from typing import Optional
-from .database_manager import DatabaseManager, TableDefinition
+from typing import Optional, Callable, List, Iterable, Set, AsyncIterator, Any
+from .database_manager import DatabaseManager, TableDefinition, Transaction
+
+# 批量生成CDKey时重新生成冲突CDKey的最大轮数
+CDKEY_BULK_MAX_ROUNDS = 8
+
 
 class CDKeyDatabase:
     def __init__(self):
@@ -30,7 +35,8 @@ class CDKeyDatabase:
     async def create_cdkey(self, cdkey: str, days: int,
                          created: datetime, expires: Optional[datetime],
                          used: bool = False, used_by: Optional[str] = None,
-                         used_at: Optional[datetime] = None):
+                         used_at: Optional[datetime] = None,
+                         tx: Optional[Transaction] = None):
         await self.db.execute_write(
             """INSERT INTO cdkey VALUES (?, ?, ?, ?, ?, ?, ?)
             ON CONFLICT(cdkey) DO UPDATE SET
@@ -39,28 +45,81 @@ class CDKeyDatabase:
                 used = excluded.used,
                 used_by = excluded.used_by,
                 used_at = excluded.used_at""",
-            (cdkey, days, created, expires, used, used_by, used_at)
+            (cdkey, days, created, expires, used, used_by, used_at),
+            tx=tx
+        )
+
+    async def create_cdkeys_bulk(self, count: int, days: int,
+                                 created: datetime, expires: Optional[datetime],
+                                 key_factory: Callable[[], str],
+                                 tx: Optional[Transaction] = None) -> List[str]:
+        """在一个事务内批量生成并插入count个新CDKey，返回生成的CDKey列表
+
+        与库中已有CDKey冲突的会在事务内重新生成，不会覆盖已有记录
+        """
+        if tx is None:
+            async with self.db.transaction() as tx:
+                return await self.create_cdkeys_bulk(count, days, created, expires, key_factory, tx=tx)
+
+        new_cdkeys: List[str] = []
+        taken: Set[str] = set()
+        for _ in range(CDKEY_BULK_MAX_ROUNDS):
+            need = count - len(new_cdkeys)
+            if need <= 0:
+                break
+            # 每轮只生成need次，重复的留到下一轮补，保证总次数有上限
+            candidates = {cdkey for cdkey in (key_factory() for _ in range(need)) if cdkey not in taken}
+            if not candidates:
+                continue
+            existing = await self._existing_cdkeys(candidates, tx)
+            fresh = [cdkey for cdkey in candidates if cdkey not in existing]
+            await self.db.execute_many(
+                "INSERT INTO cdkey (cdkey, days, created, expires, used) VALUES (?, ?, ?, ?, FALSE)",
+                [(cdkey, days, created, expires) for cdkey in fresh],
+                tx=tx
+            )
+            new_cdkeys.extend(fresh)
+            taken.update(candidates)
+
+        if len(new_cdkeys) < count:
+            raise RuntimeError(f"CDKey生成冲突过多，仅生成了{len(new_cdkeys)}/{count}个")
+        return new_cdkeys
+
+    async def _existing_cdkeys(self, cdkeys: Iterable[str], tx: Optional[Transaction] = None) -> Set[str]:
+        """一次查询返回给定CDKey中已存在于库中的部分"""
+        rows = await self.db.execute_query(
+            "SELECT cdkey FROM cdkey WHERE cdkey IN (SELECT value FROM json_each(?))",
+            (json.dumps(list(cdkeys)),),
+            tx=tx
         )
+        return {row["cdkey"] for row in rows}
 
-    async def get_cdkey(self, cdkey: str) -> Optional[dict]:
+    async def get_cdkey(self, cdkey: str, tx: Optional[Transaction] = None) -> Optional[dict]:
         result = await self.db.execute_query(
             "SELECT * FROM cdkey WHERE cdkey = ?",
-            (cdkey,)
+            (cdkey,),
+            tx=tx
         )
         return result[0] if result else None
 
     async def get_all_cdkeys(self) -> list:
         return await self.db.execute_query("SELECT * FROM cdkey ORDER BY created DESC")
 
-    async def mark_cdkey_used(self, cdkey: str, group_id: str):
+    async def iter_all_cdkeys(self, row_type: Callable[..., Any] = dict) -> AsyncIterator[Any]:
+        """流式读取全部CDKey，内存占用与表大小无关"""
+        async for row in self.db.iter_query("SELECT * FROM cdkey ORDER BY created DESC", row_type=row_type):
+            yield row
+
+    async def mark_cdkey_used(self, cdkey: str, group_id: str, tx: Optional[Transaction] = None):
         await self.db.execute_write(
             """UPDATE cdkey SET 
                 used = TRUE,
                 used_by = ?,
                 used_at = CURRENT_TIMESTAMP
                 WHERE cdkey = ?""",
-            (group_id, cdkey)
+            (group_id, cdkey),
+            tx=tx
         )
 
-    async def delete_cdkey(self, cdkey: str):
-        await self.db.execute_write("DELETE FROM cdkey WHERE cdkey = ?", (cdkey,))
+    async def delete_cdkey(self, cdkey: str, tx: Optional[Transaction] = None):
+        await self.db.execute_write("DELETE FROM cdkey WHERE cdkey = ?", (cdkey,), tx=tx)
@@ -1,15 +1,56 @@
+import asyncio
+import time
+from collections import Counter
 import aiosqlite
-from contextlib import asynccontextmanager
-from typing import List, AsyncIterator
+from contextlib import asynccontextmanager, contextmanager
+from typing import List, AsyncIterator, Optional, Iterable, Callable, Any
 from dataclasses import dataclass
 from pathlib import Path
 
+import config
+
 
 @dataclass
 class TableDefinition:
     name: str
     create_sql: str
     migrations: List[str] = None  # 版本迁移SQL（按版本顺序排列）
+    indexes: List[str] = None     # 索引SQL（CREATE INDEX IF NOT EXISTS ...），建表和迁移后执行
+
+
+# 每个新建连接都会执行的PRAGMA
+# WAL模式下读写互不阻塞；synchronous由config.db_synchronous决定，默认FULL，每次提交都fsync
+CONNECTION_PRAGMAS = [
+    "PRAGMA journal_mode = WAL",
+    f"PRAGMA synchronous = {config.db_synchronous}",
+    "PRAGMA busy_timeout = 5000",
+    "PRAGMA temp_store = MEMORY",
+    "PRAGMA cache_size = -8000",
+    "PRAGMA mmap_size = 67108864",
+]
+
+
+class Transaction:
+    """事务句柄：事务内的读写都在同一个写连接上执行，由DatabaseManager.transaction()创建"""
+
+    def __init__(self, conn: aiosqlite.Connection):
+        self.conn = conn
+        self._after_commit: List[Callable[[], Any]] = []
+
+    def call_after_commit(self, callback: Callable[[], Any]):
+        """注册提交成功后执行的回调（如清理缓存），回滚时不会执行"""
+        self._after_commit.append(callback)
+
+    async def execute(self, sql: str, params: tuple = None):
+        await self.conn.execute(sql, params or ())
+
+    async def execute_many(self, sql: str, params_seq: Iterable[tuple]):
+        await self.conn.executemany(sql, params_seq)
+
+    async def query(self, sql: str, params: tuple = None) -> List[dict]:
+        async with self.conn.execute(sql, params or ()) as cursor:
+            rows = await cursor.fetchall()
+        return [dict(row) for row in rows]
 
 
 class Singleton(type):
@@ -23,28 +64,59 @@ class Singleton(type):
 
 
 class DatabaseManager(metaclass=Singleton):
-    def __init__(self, db_path: str = Path(__file__).parent.parent.parent / "data" / "base_data.db"):
+    def __init__(self, db_path: str = Path(__file__).parent.parent.parent / "data" / "base_data.db",
+                 pool_size: Optional[int] = None,
+                 write_batch_size: Optional[int] = None,
+                 write_batch_delay: Optional[float] = None):
         self.db_path = db_path
         self._tables: List[TableDefinition] = []
 
+        # 连接池：长连接按需创建，最多pool_size个，用完归还
+        self.pool_size = max(1, pool_size or config.db_pool_size)
+        self._pool: Optional[asyncio.Queue] = None
+        self._opened = 0
+
+        # 单写入者：所有写操作排队，由后台任务在同一个连接上合并提交
+        self.write_batch_size = max(1, write_batch_size or config.db_write_batch_size)
+        self.write_batch_delay = config.db_write_batch_delay if write_batch_delay is None else write_batch_delay
+        self._write_queue: Optional[asyncio.Queue] = None
+        self._writer_task: Optional[asyncio.Task] = None
+        self._writer_conn: Optional[aiosqlite.Connection] = None
+        self._write_lock = asyncio.Lock()
+        # close()之后不再接受新的读写，避免关闭钩子之后的写入悄悄重新打开连接
+        self._closed = False
+
+        # 操作计数：query 查询次数，write 写操作次数，commit 提交次数
+        self.counters: Counter = Counter()
+        # 耗时监听器：每次查询/写入结束后以(类型, 秒数)调用，类型为query或write
+        self.timing_listeners: List[Callable[[str, float], None]] = []
+
     def register_table(self, table_def: TableDefinition):
-        self._tables.append(table_def)
+        # 同名表只注册一次（多个模块可能各自实例化同一个数据库类）
+        if all(t.name != table_def.name for t in self._tables):
+            self._tables.append(table_def)
         return self  # 支持链式调用
 
     async def initialize(self):
         """初始化数据库（建表）"""
-        async with self.connect() as conn:
-            # 创建迁移记录表
-            await conn.execute('''CREATE TABLE IF NOT EXISTS __migrations (
-                table_name TEXT PRIMARY KEY,
-                version INTEGER NOT NULL DEFAULT 0
-            )''')
+        self._check_open()
+        async with self._writer() as conn:
+            await conn.execute("BEGIN IMMEDIATE")
+            try:
+                # 创建迁移记录表
+                await conn.execute('''CREATE TABLE IF NOT EXISTS __migrations (
+                    table_name TEXT PRIMARY KEY,
+                    version INTEGER NOT NULL DEFAULT 0
+                )''')
 
-            # 初始化所有注册表
-            for table_def in self._tables:
-                await self._init_table(conn, table_def)
+                # 初始化所有注册表
+                for table_def in self._tables:
+                    await self._init_table(conn, table_def)
 
-            await conn.commit()
+                await conn.commit()
+            except Exception:
+                await conn.rollback()
+                raise
 
     async def _init_table(self, conn: aiosqlite.Connection, table_def: TableDefinition):
         """初始化单个表结构"""
@@ -55,13 +127,16 @@ class DatabaseManager(metaclass=Singleton):
         )
         exists = await cursor.fetchone()
 
-        if not exists:  # 全新表
+        if not exists:  # 全新表，create_sql已是最新结构，直接记为最新版本
             await conn.execute(table_def.create_sql)
-            await self._update_migration_version(conn, table_def.name, 0)
+            await self._update_migration_version(conn, table_def.name, len(table_def.migrations or []))
         else:
             current_version = await self._get_migration_version(conn, table_def.name)
             await self._apply_migrations(conn, table_def, current_version)
 
+        for index_sql in table_def.indexes or []:
+            await conn.execute(index_sql)
+
     async def _apply_migrations(self, conn: aiosqlite.Connection,
                                 table_def: TableDefinition, current_version: int):
         """安全执行表迁移"""
@@ -113,27 +188,248 @@ class DatabaseManager(metaclass=Singleton):
         )
 
     # 连接管理
+    async def _open_connection(self, **kwargs) -> aiosqlite.Connection:
+        """新建一个长连接并应用PRAGMA"""
+        Path(self.db_path).parent.mkdir(parents=True, exist_ok=True)
+        conn = await aiosqlite.connect(self.db_path, **kwargs)
+        conn.row_factory = aiosqlite.Row
+        for pragma in CONNECTION_PRAGMAS:
+            await conn.execute(pragma)
+        return conn
+
+    async def _acquire(self) -> aiosqlite.Connection:
+        """从连接池取出连接，池空且未达上限时新建"""
+        self._check_open()
+        if self._pool is None:
+            self._pool = asyncio.Queue()
+        if self._pool.empty() and self._opened < self.pool_size:
+            self._opened += 1
+            try:
+                return await self._open_connection()
+            except Exception:
+                self._opened -= 1
+                raise
+        return await self._pool.get()
+
+    async def _release(self, conn: aiosqlite.Connection):
+        """归还连接，未提交的事务一律回滚，损坏的连接直接丢弃"""
+        try:
+            if conn.in_transaction:
+                await conn.rollback()
+        except Exception:
+            self._opened -= 1
+            try:
+                await conn.close()
+            except Exception:
+                pass
+            return
+        self._pool.put_nowait(conn)
+
     @asynccontextmanager
     async def connect(self) -> AsyncIterator[aiosqlite.Connection]:
-        """获取异步数据库连接"""
-        conn = await aiosqlite.connect(self.db_path)
-        conn.row_factory = aiosqlite.Row  # 添加这行
+        """从连接池获取异步数据库连接，退出时归还"""
+        conn = await self._acquire()
         try:
             yield conn
         finally:
+            await self._release(conn)
+
+    @asynccontextmanager
+    async def _writer(self) -> AsyncIterator[aiosqlite.Connection]:
+        """独占写连接，写连接工作在自动提交模式，事务由调用方显式开启"""
+        async with self._write_lock:
+            if self._writer_conn is None:
+                self._writer_conn = await self._open_connection(isolation_level=None)
+            yield self._writer_conn
+
+    def _check_open(self):
+        if self._closed:
+            raise RuntimeError("数据库已关闭")
+
+    async def close(self):
+        """写完队列中剩余的写操作，等待进行中的事务结束，然后关闭所有连接；之后的读写会抛出RuntimeError"""
+        self._closed = True
+        if self._writer_task is not None and not self._writer_task.done():
+            self._write_queue.put_nowait(None)
+            await self._writer_task
+        self._writer_task = None
+        async with self._write_lock:
+            if self._writer_conn is not None:
+                await self._writer_conn.close()
+                self._writer_conn = None
+        if self._pool is None:
+            return
+        while not self._pool.empty():
+            conn = self._pool.get_nowait()
+            self._opened -= 1
             await conn.close()
 
+    # 合并提交
+    def _ensure_writer(self):
+        self._check_open()
+        if self._write_queue is None:
+            self._write_queue = asyncio.Queue()
+        if self._writer_task is None or self._writer_task.done():
+            self._writer_task = asyncio.get_running_loop().create_task(self._writer_loop())
+
+    def _drain_writes(self, batch: list) -> bool:
+        """把队列中已有的写操作取入批次，遇到停止标记返回False"""
+        while len(batch) < self.write_batch_size and not self._write_queue.empty():
+            item = self._write_queue.get_nowait()
+            if item is None:
+                return False
+            batch.append(item)
+        return True
+
+    async def _writer_loop(self):
+        """后台写入任务：攒够write_batch_size条或等待write_batch_delay秒后一次提交"""
+        running = True
+        while running:
+            item = await self._write_queue.get()
+            if item is None:
+                break
+            batch = [item]
+            running = self._drain_writes(batch)
+            if running and len(batch) < self.write_batch_size and self.write_batch_delay > 0:
+                await asyncio.sleep(self.write_batch_delay)
+                running = self._drain_writes(batch)
+            await self._commit_batch(batch)
+
+    async def _commit_batch(self, batch: list):
+        """在一个事务中执行一批写操作，每条写操作用SAVEPOINT隔离，单条失败不影响其他"""
+        batch = [item for item in batch if not item[2].cancelled()]
+        if not batch:
+            return
+        isolate = len(batch) > 1
+        done = []
+        try:
+            async with self._writer() as conn:
+                await conn.execute("BEGIN IMMEDIATE")
+                try:
+                    for sql, params, fut in batch:
+                        if isolate:
+                            await conn.execute("SAVEPOINT write_item")
+                        try:
+                            await conn.execute(sql, params)
+                        except Exception as e:
+                            if isolate:
+                                await conn.execute("ROLLBACK TO write_item")
+                                await conn.execute("RELEASE write_item")
+                            if not fut.done():
+                                fut.set_exception(e)
+                            continue
+                        if isolate:
+                            await conn.execute("RELEASE write_item")
+                        done.append(fut)
+                    await conn.commit()
+                    self.counters["commit"] += 1
+                except Exception:
+                    await conn.rollback()
+                    raise
+        except Exception as e:
+            for _, _, fut in batch:
+                if not fut.done():
+                    fut.set_exception(e)
+            return
+        # 提交完成后才通知调用方
+        for fut in done:
+            if not fut.done():
+                fut.set_result(None)
+
+    @asynccontextmanager
+    async def transaction(self) -> AsyncIterator[Transaction]:
+        """开启一个写事务，正常退出时提交，异常时回滚
+
+        事务期间独占写连接，事务内的读写应通过tx参数传入各方法，
+        不要在事务内调用不带tx的execute_write，否则会互相等待
+        """
+        self._check_open()
+        async with self._writer() as conn:
+            await conn.execute("BEGIN IMMEDIATE")
+            tx = Transaction(conn)
+            try:
+                yield tx
+            except BaseException:
+                await conn.rollback()
+                raise
+            await conn.commit()
+            self.counters["commit"] += 1
+        for callback in tx._after_commit:
+            callback()
+
+    @contextmanager
+    def _timed(self, kind: str):
+        if not self.timing_listeners:
+            yield
+            return
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            elapsed = time.perf_counter() - start
+            for listener in self.timing_listeners:
+                listener(kind, elapsed)
+
     # 基础CRUD操作
-    async def execute_query(self, sql: str, params: tuple = None) -> List[dict]:
-        """通用查询方法"""
-        async with self.connect() as conn:
-            conn.row_factory = aiosqlite.Row
-            cursor = await conn.execute(sql, params or ())
-            rows = await cursor.fetchall()
-            return [dict(row) for row in rows]
+    async def execute_query(self, sql: str, params: tuple = None,
+                            tx: Optional[Transaction] = None) -> List[dict]:
+        """通用查询方法，传入tx时在事务内查询"""
+        self.counters["query"] += 1
+        with self._timed("query"):
+            if tx is not None:
+                return await tx.query(sql, params)
+            async with self.connect() as conn:
+                async with conn.execute(sql, params or ()) as cursor:
+                    rows = await cursor.fetchall()
+                return [dict(row) for row in rows]
+
+    async def iter_query(self, sql: str, params: tuple = None,
+                         chunk_size: int = 256,
+                         row_type: Callable[..., Any] = dict) -> AsyncIterator[Any]:
+        """流式查询方法，按chunk_size分块fetchmany，逐行产出
 
-    async def execute_write(self, sql: str, params: tuple = None):
-        """通用写入方法"""
+        row_type为dict（默认）时产出列名到值的字典；为tuple时直接产出元组；
+        为其他类（如带__slots__的行类）时按row_type(*row)构造。
+        提前结束迭代时请用contextlib.aclosing包裹，以便及时归还连接
+        """
+        self.counters["query"] += 1
         async with self.connect() as conn:
-            await conn.execute(sql, params or ())
-            await conn.commit()
+            async with conn.execute(sql, params or ()) as cursor:
+                cursor.row_factory = None
+                columns = [col[0] for col in cursor.description or ()]
+                while True:
+                    with self._timed("query"):
+                        rows = await cursor.fetchmany(chunk_size)
+                    if not rows:
+                        break
+                    if row_type is dict:
+                        for row in rows:
+                            yield dict(zip(columns, row))
+                    elif row_type is tuple:
+                        for row in rows:
+                            yield row
+                    else:
+                        for row in rows:
+                            yield row_type(*row)
+
+    async def execute_write(self, sql: str, params: tuple = None,
+                            tx: Optional[Transaction] = None):
+        """通用写入方法，交给后台写入任务合并提交，返回时数据已提交；传入tx时在事务内执行"""
+        self.counters["write"] += 1
+        with self._timed("write"):
+            if tx is not None:
+                return await tx.execute(sql, params)
+            self._ensure_writer()
+            fut = asyncio.get_running_loop().create_future()
+            self._write_queue.put_nowait((sql, params or (), fut))
+            await fut
+
+    async def execute_many(self, sql: str, params_seq: Iterable[tuple],
+                           tx: Optional[Transaction] = None):
+        """批量写入方法，整批在一个事务内用executemany执行；传入tx时在该事务内执行"""
+        self.counters["write"] += 1
+        with self._timed("write"):
+            if tx is not None:
+                return await tx.execute_many(sql, params_seq)
+            async with self.transaction() as tx:
+                await tx.execute_many(sql, params_seq)
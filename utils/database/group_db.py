@@ -1,14 +1,92 @@
-from datetime import datetime
-from typing import Optional, Dict, List
+from datetime import datetime, timedelta
+from typing import Optional, Dict, List, AsyncIterator, Tuple, Iterable
 import json
-from .database_manager import DatabaseManager, TableDefinition
+import time
+from .database_manager import DatabaseManager, TableDefinition, Transaction
+
+class _GroupAuthEntry:
+    __slots__ = ("expires_at", "plugins")
+
+    def __init__(self, expires_at: float, plugins: Dict[str, bool]):
+        self.expires_at = expires_at    # 授权到期的时间戳，未授权为0
+        self.plugins = plugins          # 插件名 -> 是否启用
+
+
+class GroupAuthCache:
+    """群授权判定的进程内缓存
+
+    按群缓存授权到期时间戳和插件启用状态，命中时判定(群, 插件)是否可用不需要任何I/O。
+    群信息或插件状态被修改并提交后由GroupDatabase调用invalidate清除对应群
+    """
+
+    def __init__(self):
+        self._entries: Dict[str, _GroupAuthEntry] = {}
+        # 每次失效都会递增，加载前后版本不一致说明期间有写入，加载结果不能放进缓存
+        self.version = 0
+        self.hits = 0
+        self.misses = 0
+        self.invalidations = 0
+
+    def get(self, group_id: str) -> Optional[_GroupAuthEntry]:
+        entry = self._entries.get(group_id)
+        if entry is None:
+            self.misses += 1
+        else:
+            self.hits += 1
+        return entry
+
+    def put(self, group_id: str, entry: _GroupAuthEntry, version: int):
+        if version == self.version:
+            self._entries[group_id] = entry
+
+    def invalidate(self, group_id: Optional[str] = None):
+        """清除指定群的缓存，不指定群时全部清除"""
+        self.version += 1
+        self.invalidations += 1
+        if group_id is None:
+            self._entries.clear()
+        else:
+            self._entries.pop(group_id, None)
+
+    def stats(self) -> dict:
+        total = self.hits + self.misses
+        return {
+            "size": len(self._entries),
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": self.hits / total if total else 0.0,
+            "invalidations": self.invalidations,
+        }
+
+
+# 所有GroupDatabase实例共用一份缓存
+auth_cache = GroupAuthCache()
+
 
 class GroupDatabase:
     def __init__(self):
         self.db = DatabaseManager()
+        self.auth_cache = auth_cache
         self._register_tables()
 
     def _register_tables(self):
+        # 群插件启用状态，一行一个(群, 插件)，替代group_info.plugins中的JSON
+        # 必须先于group_info注册，group_info的迁移会向这张表回填数据
+        self.db.register_table(
+            TableDefinition(
+                name="group_plugin",
+                create_sql="""CREATE TABLE group_plugin (
+                    group_id TEXT NOT NULL,
+                    plugin TEXT NOT NULL,
+                    enabled BOOLEAN NOT NULL DEFAULT FALSE,
+                    PRIMARY KEY (group_id, plugin)
+                ) WITHOUT ROWID""",
+                migrations=[],
+                indexes=[
+                    "CREATE INDEX IF NOT EXISTS idx_group_plugin_plugin ON group_plugin (plugin, enabled)"
+                ]
+            )
+        )
         self.db.register_table(
             TableDefinition(
                 name="group_info",
@@ -19,8 +97,17 @@ class GroupDatabase:
                     expires TIMESTAMP,
                     authed_at TIMESTAMP,
                     plugins TEXT
-                )""",
-                migrations=[]
+                )""",  # plugins列已弃用，仅保留旧数据，插件状态见group_plugin表
+                migrations=[
+                    # v1: 把plugins列中的JSON回填到group_plugin表
+                    """INSERT OR IGNORE INTO group_plugin (group_id, plugin, enabled)
+                    SELECT g.group_id, p.key, p.value
+                    FROM group_info g, json_each(g.plugins) p
+                    WHERE g.plugins IS NOT NULL AND json_valid(g.plugins)""",
+                ],
+                indexes=[
+                    "CREATE INDEX IF NOT EXISTS idx_group_info_expires ON group_info (expires)"
+                ]
             )
         )
 
@@ -28,73 +115,152 @@ class GroupDatabase:
         await self.db.initialize()
 
     # 插件状态管理
-    async def update_group_plugins(self, group_id: str, plugins: Dict[str, bool]):
-        plugins_json = json.dumps(plugins)
-        await self.db.execute_write(
-            """INSERT INTO group_info (group_id, plugins)
-            VALUES (?, ?)
-            ON CONFLICT(group_id) DO UPDATE SET
-                plugins = excluded.plugins""",
-            (group_id, plugins_json)
+    async def update_group_plugins(self, group_id: str, plugins: Dict[str, bool],
+                                   tx: Optional[Transaction] = None):
+        """用plugins整体替换群的插件状态"""
+        if tx is None:
+            async with self.db.transaction() as tx:
+                return await self.update_group_plugins(group_id, plugins, tx=tx)
+        await self.db.execute_write("DELETE FROM group_plugin WHERE group_id = ?", (group_id,), tx=tx)
+        await self._upsert_plugins(group_id, plugins, tx=tx)
+        self._invalidate(group_id, tx)
+
+    async def _upsert_plugins(self, group_id: str, plugins: Dict[str, bool], tx: Transaction):
+        await self.db.execute_many(
+            """INSERT INTO group_plugin (group_id, plugin, enabled)
+            VALUES (?, ?, ?)
+            ON CONFLICT(group_id, plugin) DO UPDATE SET
+                enabled = excluded.enabled""",
+            [(group_id, name, enabled) for name, enabled in plugins.items()],
+            tx=tx
         )
 
-    async def get_group_plugins(self, group_id: str) -> Dict[str, bool]:
+    async def get_group_plugins(self, group_id: str, tx: Optional[Transaction] = None) -> Dict[str, bool]:
         result = await self.db.execute_query(
-            "SELECT plugins FROM group_info WHERE group_id = ?",
-            (group_id,)
+            "SELECT plugin, enabled FROM group_plugin WHERE group_id = ?",
+            (group_id,),
+            tx=tx
         )
-        return json.loads(result[0]["plugins"]) if result and result[0]["plugins"] else {}
+        return {row["plugin"]: bool(row["enabled"]) for row in result}
 
     async def get_groups_by_plugin(self, plugin_name: str) -> List[str]:
         results = await self.db.execute_query(
-            "SELECT group_id FROM group_info WHERE json_extract(plugins, ?) = 1",
-            (f"$.{plugin_name}",)
+            "SELECT group_id FROM group_plugin WHERE plugin = ? AND enabled = 1",
+            (plugin_name,)
         )
         return [row["group_id"] for row in results]
 
     async def get_all_plugin_states(self) -> Dict[str, Dict[str, bool]]:
-        results = await self.db.execute_query(
-            "SELECT group_id, plugins FROM group_info"
-        )
-        return {
-            row["group_id"]: json.loads(row["plugins"])
-            for row in results if row["plugins"]
-        }
+        states: Dict[str, Dict[str, bool]] = {}
+        async for group_id, plugins in self.iter_all_plugin_states():
+            states[group_id] = plugins
+        return states
+
+    async def iter_all_plugin_states(self) -> AsyncIterator[Tuple[str, Dict[str, bool]]]:
+        """流式读取所有群的插件状态，逐个产出(群号, 插件状态)"""
+        current_group = None
+        plugins: Dict[str, bool] = {}
+        async for group_id, plugin, enabled in self.db.iter_query(
+            "SELECT group_id, plugin, enabled FROM group_plugin ORDER BY group_id",
+            row_type=tuple
+        ):
+            if group_id != current_group:
+                if current_group is not None:
+                    yield current_group, plugins
+                current_group, plugins = group_id, {}
+            plugins[plugin] = bool(enabled)
+        if current_group is not None:
+            yield current_group, plugins
+
+    async def reconcile_groups(self, group_ids: Iterable[str],
+                               default_plugins: Dict[str, bool]) -> Tuple[int, int]:
+        """把群列表与数据库对齐：补齐缺失的群信息，以及这些群缺失的插件默认状态
+
+        一次查询取出差异，在一个事务内批量写入，已有的群和插件状态不会被改动。
+        返回(新增群数, 新增插件状态数)
+        """
+        group_ids = list(dict.fromkeys(group_ids))
+        async with self.db.transaction() as tx:
+            rows = await self.db.execute_query(
+                """SELECT g.group_id, p.plugin
+                FROM group_info g
+                LEFT JOIN group_plugin p ON p.group_id = g.group_id
+                    AND p.plugin IN (SELECT value FROM json_each(?))""",
+                (json.dumps(list(default_plugins)),),
+                tx=tx
+            )
+            known: Dict[str, set] = {}
+            for row in rows:
+                plugins = known.setdefault(row["group_id"], set())
+                if row["plugin"] is not None:
+                    plugins.add(row["plugin"])
+
+            missing_groups = [(group_id,) for group_id in group_ids if group_id not in known]
+            missing_plugins = [
+                (group_id, name, enabled)
+                for group_id in group_ids
+                for name, enabled in default_plugins.items()
+                if name not in known.get(group_id, ())
+            ]
+            if missing_groups:
+                await self.db.execute_many(
+                    "INSERT OR IGNORE INTO group_info (group_id) VALUES (?)",
+                    missing_groups,
+                    tx=tx
+                )
+            if missing_plugins:
+                await self.db.execute_many(
+                    "INSERT OR IGNORE INTO group_plugin (group_id, plugin, enabled) VALUES (?, ?, ?)",
+                    missing_plugins,
+                    tx=tx
+                )
+            for group_id in {row[0] for row in missing_plugins}:
+                self._invalidate(group_id, tx)
+        return len(missing_groups), len(missing_plugins)
 
     # 群信息管理
     async def create_group_info(self, group_id: str,
                               cdkey: Optional[str] = None,
                               days: Optional[int] = None,
                               expires: Optional[datetime] = None,
-                              plugins: Optional[Dict[str, bool]] = None):
-        plugins_json = json.dumps(plugins) if plugins else None
+                              plugins: Optional[Dict[str, bool]] = None,
+                              tx: Optional[Transaction] = None):
+        """创建或覆盖群信息；plugins不为空时同时写入这些插件的状态，其余插件状态保持不变"""
+        if plugins and tx is None:
+            async with self.db.transaction() as tx:
+                return await self.create_group_info(group_id, cdkey, days, expires, plugins, tx=tx)
         await self.db.execute_write(
-            """INSERT INTO group_info VALUES (?, ?, ?, ?, ?, ?)
+            """INSERT INTO group_info (group_id, cdkey, days, expires, authed_at)
+            VALUES (?, ?, ?, ?, ?)
             ON CONFLICT(group_id) DO UPDATE SET
                 cdkey = excluded.cdkey,
                 days = excluded.days,
                 expires = excluded.expires,
-                authed_at = excluded.authed_at,
-                plugins = excluded.plugins""",
-            (group_id, cdkey, days, expires, None, plugins_json)
+                authed_at = excluded.authed_at""",
+            (group_id, cdkey, days, expires, None),
+            tx=tx
         )
+        if plugins:
+            await self._upsert_plugins(group_id, plugins, tx=tx)
+        self._invalidate(group_id, tx)
 
-    async def get_group_info(self, group_id: str) -> Optional[dict]:
+    async def get_group_info(self, group_id: str, tx: Optional[Transaction] = None) -> Optional[dict]:
         result = await self.db.execute_query(
-            """SELECT g.*, c.expires as cdkey_expires 
+            """SELECT g.group_id, g.cdkey, g.days, g.expires, g.authed_at, c.expires as cdkey_expires
             FROM group_info g
             LEFT JOIN cdkey c ON g.cdkey = c.cdkey
             WHERE g.group_id = ?""",
-            (group_id,)
+            (group_id,),
+            tx=tx
         )
         if result:
-            data = dict(result[0])
-            if data.get("plugins"):
-                data["plugins"] = json.loads(data["plugins"])
+            data = result[0]
+            data["plugins"] = await self.get_group_plugins(group_id, tx=tx)
             return data
         return None
 
-    async def set_group_auth(self, group_id: str, cdkey: str, days: int, expires: Optional[datetime] = None):
+    async def set_group_auth(self, group_id: str, cdkey: str, days: int, expires: Optional[datetime] = None,
+                             tx: Optional[Transaction] = None):
         await self.db.execute_write(
             """INSERT INTO group_info (group_id, cdkey, days, expires, authed_at)
             VALUES (?, ?, ?, ?, ?)
@@ -102,14 +268,19 @@ class GroupDatabase:
                 cdkey = excluded.cdkey,
                 days = excluded.days,
                 expires = excluded.expires""",
-            (group_id, cdkey, days, expires, datetime.now())
+            (group_id, cdkey, days, expires, datetime.now()),
+            tx=tx
         )
+        self._invalidate(group_id, tx)
 
-    async def update_group_expiry(self, group_id: str, new_expires: datetime):
+    async def update_group_expiry(self, group_id: str, new_expires: datetime,
+                                  tx: Optional[Transaction] = None):
         await self.db.execute_write(
             "UPDATE group_info SET expires = ? WHERE group_id = ?",
-            (new_expires, group_id)
+            (new_expires, group_id),
+            tx=tx
         )
+        self._invalidate(group_id, tx)
 
     async def get_expiring_groups(self, days: int = 3) -> list:
         return await self.db.execute_query(
@@ -119,19 +290,90 @@ class GroupDatabase:
             (f"+{days}",)
         )
 
+    async def iter_expiring_groups(self, days: int = 3) -> AsyncIterator[dict]:
+        """流式版本的get_expiring_groups"""
+        async for row in self.db.iter_query(
+            """SELECT * FROM group_info 
+            WHERE expires BETWEEN datetime('now') AND datetime('now', ? || ' days')
+            ORDER BY expires ASC""",
+            (f"+{days}",)
+        ):
+            yield row
+
+    async def select_groups(self, authed_only: bool = False,
+                            plugin: Optional[str] = None,
+                            expiring_days: Optional[int] = None) -> List[str]:
+        """按条件筛选群号，所有条件在一条查询内完成
+
+        authed_only: 只要授权未过期的群
+        plugin: 只要启用了该插件的群
+        expiring_days: 只要授权在expiring_days天内到期的群（隐含authed_only）
+        """
+        sql = "SELECT g.group_id FROM group_info g"
+        conditions, params = [], []
+        if plugin is not None:
+            sql += " JOIN group_plugin p ON p.group_id = g.group_id AND p.plugin = ? AND p.enabled = 1"
+            params.append(plugin)
+        # expires按本地时间写入，这里同样用本地时间比较（与is_group_authed一致）
+        now = datetime.now()
+        if authed_only or expiring_days is not None:
+            conditions.append("g.expires > ?")
+            params.append(now)
+        if expiring_days is not None:
+            conditions.append("g.expires <= ?")
+            params.append(now + timedelta(days=expiring_days))
+        if conditions:
+            sql += " WHERE " + " AND ".join(conditions)
+        results = await self.db.execute_query(sql, tuple(params))
+        return [row["group_id"] for row in results]
+
     async def is_group_authed(self, group_id: str) -> bool:
-        group_info = await self.get_group_info(group_id)
-        if not group_info or not group_info.get("expires"):
-            return False
-        return datetime.fromisoformat(group_info["expires"]) > datetime.now()
+        entry = await self._get_auth_entry(group_id)
+        return time.time() < entry.expires_at
 
     # 新增方法：检查插件是否在群中启用
     async def is_plugin_enabled(self, group_id: str, plugin_name: str) -> bool:
-        plugins = await self.get_group_plugins(group_id)
-        return plugins.get(plugin_name, False)
+        entry = await self._get_auth_entry(group_id)
+        return entry.plugins.get(plugin_name, False)
+
+    # 授权缓存
+    async def _get_auth_entry(self, group_id: str) -> _GroupAuthEntry:
+        """读取群的授权缓存，未命中时查库并填充"""
+        entry = self.auth_cache.get(group_id)
+        if entry is not None:
+            return entry
+
+        version = self.auth_cache.version
+        result = await self.db.execute_query(
+            """SELECT g.expires, p.plugin, p.enabled
+            FROM (SELECT ? AS group_id) k
+            LEFT JOIN group_info g ON g.group_id = k.group_id
+            LEFT JOIN group_plugin p ON p.group_id = k.group_id""",
+            (group_id,)
+        )
+        expires = result[0]["expires"] if result else None
+        expires_at = datetime.fromisoformat(expires).timestamp() if expires else 0.0
+        plugins = {row["plugin"]: bool(row["enabled"]) for row in result if row["plugin"] is not None}
+        entry = _GroupAuthEntry(expires_at, plugins)
+        self.auth_cache.put(group_id, entry, version)
+        return entry
+
+    def _invalidate(self, group_id: str, tx: Optional[Transaction] = None):
+        """写入提交后清除群的授权缓存，在事务内时等事务提交后再清除"""
+        if tx is not None:
+            tx.call_after_commit(lambda: self.auth_cache.invalidate(group_id))
+        else:
+            self.auth_cache.invalidate(group_id)
 
     # 新增方法：设置插件在群中的启用状态
-    async def set_plugin_enabled(self, group_id: str, plugin_name: str, enabled: bool):
-        plugins = await self.get_group_plugins(group_id)
-        plugins[plugin_name] = enabled
-        await self.update_group_plugins(group_id, plugins)
+    async def set_plugin_enabled(self, group_id: str, plugin_name: str, enabled: bool,
+                                 tx: Optional[Transaction] = None):
+        await self.db.execute_write(
+            """INSERT INTO group_plugin (group_id, plugin, enabled)
+            VALUES (?, ?, ?)
+            ON CONFLICT(group_id, plugin) DO UPDATE SET
+                enabled = excluded.enabled""",
+            (group_id, plugin_name, enabled),
+            tx=tx
+        )
+        self._invalidate(group_id, tx)
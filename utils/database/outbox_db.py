@@ -0,0 +1,232 @@
+from typing import Optional, List, Tuple, Iterable
+from .database_manager import DatabaseManager, TableDefinition, Transaction
+
+'''
+发件箱：所有主动发送的消息先写入outbox表，再由内核的发送器分批取出发送
+进程中途退出时，未发送完的消息会在下次启动后继续发送
+
+status：pending 等待发送 / sending 已取出正在发送 / sent 已发送 / failed 重试耗尽
+next_attempt_at：pending时为下次发送时间，sending时为租约到期时间，
+写回结果失败时，到期后消息会重新变为待发送
+'''
+
+
+class OutboxDatabase:
+    def __init__(self):
+        self.db = DatabaseManager()
+        self._register_tables()
+
+    def _register_tables(self):
+        self.db.register_table(
+            TableDefinition(
+                name="outbox",
+                create_sql="""CREATE TABLE outbox (
+                    id INTEGER PRIMARY KEY AUTOINCREMENT,
+                    dedup_key TEXT UNIQUE,
+                    batch_id TEXT,
+                    priority INTEGER NOT NULL DEFAULT 0,
+                    target_type TEXT NOT NULL,
+                    target_id TEXT NOT NULL,
+                    message TEXT NOT NULL,
+                    status TEXT NOT NULL DEFAULT 'pending',
+                    attempts INTEGER NOT NULL DEFAULT 0,
+                    max_attempts INTEGER NOT NULL DEFAULT 3,
+                    next_attempt_at REAL NOT NULL DEFAULT 0,
+                    last_error TEXT,
+                    created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+                    sent_at TIMESTAMP
+                )""",
+                migrations=[],
+                indexes=[
+                    """CREATE INDEX IF NOT EXISTS idx_outbox_pending
+                    ON outbox (priority DESC, id) WHERE status = 'pending'""",
+                    "CREATE INDEX IF NOT EXISTS idx_outbox_batch ON outbox (batch_id, status)",
+                    """CREATE INDEX IF NOT EXISTS idx_outbox_sending
+                    ON outbox (next_attempt_at) WHERE status = 'sending'""",
+                ]
+            )
+        )
+        # 一批消息（如一次广播）全部发送结束后，向notify_type/notify_id发送汇总
+        self.db.register_table(
+            TableDefinition(
+                name="outbox_batch",
+                create_sql="""CREATE TABLE outbox_batch (
+                    batch_id TEXT PRIMARY KEY,
+                    description TEXT,
+                    notify_type TEXT,
+                    notify_id TEXT,
+                    created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+                    finished_at TIMESTAMP
+                )""",
+                migrations=[]
+            )
+        )
+
+    async def initialize(self):
+        await self.db.initialize()
+
+    # 入队
+    async def enqueue(self, target_type: str, target_id: str, message: str,
+                      priority: int = 0, dedup_key: Optional[str] = None,
+                      batch_id: Optional[str] = None, max_attempts: int = 3,
+                      tx: Optional[Transaction] = None):
+        """添加一条待发送消息，dedup_key相同的消息只会入队一次"""
+        await self.db.execute_write(
+            """INSERT OR IGNORE INTO outbox
+            (dedup_key, batch_id, priority, target_type, target_id, message, max_attempts)
+            VALUES (?, ?, ?, ?, ?, ?, ?)""",
+            (dedup_key, batch_id, priority, target_type, str(target_id), message, max_attempts),
+            tx=tx
+        )
+
+    async def enqueue_many(self, items: Iterable[Tuple[str, str, str, Optional[str]]],
+                           priority: int = 0, max_attempts: int = 3) -> int:
+        """在一个事务内添加多条待发送消息，items为(target_type, target_id, message, dedup_key)，返回条数"""
+        rows = [
+            (dedup_key, None, priority, target_type, str(target_id), message, max_attempts)
+            for target_type, target_id, message, dedup_key in items
+        ]
+        if rows:
+            await self.db.execute_many(
+                """INSERT OR IGNORE INTO outbox
+                (dedup_key, batch_id, priority, target_type, target_id, message, max_attempts)
+                VALUES (?, ?, ?, ?, ?, ?, ?)""",
+                rows
+            )
+        return len(rows)
+
+    async def enqueue_batch(self, batch_id: str, targets: Iterable[Tuple[str, str, str]],
+                            description: str = "", notify_type: Optional[str] = None,
+                            notify_id: Optional[str] = None, priority: int = 0,
+                            max_attempts: int = 3) -> int:
+        """在一个事务内登记一批消息，targets为(target_type, target_id, message)，返回入队数量"""
+        rows = [
+            (f"{batch_id}:{target_type}:{target_id}", batch_id, priority,
+             target_type, str(target_id), message, max_attempts)
+            for target_type, target_id, message in targets
+        ]
+        async with self.db.transaction() as tx:
+            await self.db.execute_write(
+                """INSERT OR IGNORE INTO outbox_batch (batch_id, description, notify_type, notify_id)
+                VALUES (?, ?, ?, ?)""",
+                (batch_id, description, notify_type, notify_id),
+                tx=tx
+            )
+            await self.db.execute_many(
+                """INSERT OR IGNORE INTO outbox
+                (dedup_key, batch_id, priority, target_type, target_id, message, max_attempts)
+                VALUES (?, ?, ?, ?, ?, ?, ?)""",
+                rows,
+                tx=tx
+            )
+        return len(rows)
+
+    # 发送器使用
+    async def reset_inflight(self):
+        """把上次退出时正在发送的消息恢复为待发送，不等租约到期"""
+        await self.db.execute_write(
+            "UPDATE outbox SET status = 'pending', next_attempt_at = 0 WHERE status = 'sending'"
+        )
+
+    async def claim(self, limit: int, now: float, lease: float) -> List[dict]:
+        """取出最多limit条已到发送时间的消息并标记为发送中，优先级高的先取
+
+        取出的消息在now + lease之前没有写回结果时（如写回失败），会重新变为待发送
+        """
+        # 先用只读查询判断有没有到期的消息，空闲时不占用写连接
+        due = await self.next_due_time()
+        if due is None or due > now:
+            return []
+        async with self.db.transaction() as tx:
+            await self.db.execute_write(
+                "UPDATE outbox SET status = 'pending' WHERE status = 'sending' AND next_attempt_at <= ?",
+                (now,),
+                tx=tx
+            )
+            rows = await self.db.execute_query(
+                """SELECT id, target_type, target_id, message, attempts, max_attempts, batch_id
+                FROM outbox
+                WHERE status = 'pending' AND next_attempt_at <= ?
+                ORDER BY priority DESC, id
+                LIMIT ?""",
+                (now, limit),
+                tx=tx
+            )
+            if rows:
+                await self.db.execute_many(
+                    "UPDATE outbox SET status = 'sending', next_attempt_at = ? WHERE id = ?",
+                    [(now + lease, row["id"]) for row in rows],
+                    tx=tx
+                )
+        return rows
+
+    async def next_due_time(self) -> Optional[float]:
+        """最早的待发送时间或租约到期时间"""
+        result = await self.db.execute_query(
+            """SELECT MIN(due) AS due FROM (
+                SELECT MIN(next_attempt_at) AS due FROM outbox WHERE status = 'pending'
+                UNION ALL
+                SELECT MIN(next_attempt_at) AS due FROM outbox WHERE status = 'sending'
+            )"""
+        )
+        return result[0]["due"] if result else None
+
+    async def complete(self, sent: List[int],
+                       retry: List[Tuple[str, float, int]],
+                       failed: List[Tuple[str, int]]):
+        """在一个事务内写回一轮发送结果
+
+        sent: 发送成功的id；retry: (错误, 下次发送时间, id)；failed: (错误, id)
+        """
+        async with self.db.transaction() as tx:
+            if sent:
+                await self.db.execute_many(
+                    """UPDATE outbox SET status = 'sent', attempts = attempts + 1,
+                    sent_at = CURRENT_TIMESTAMP WHERE id = ?""",
+                    [(row_id,) for row_id in sent],
+                    tx=tx
+                )
+            if retry:
+                await self.db.execute_many(
+                    """UPDATE outbox SET status = 'pending', attempts = attempts + 1,
+                    last_error = ?, next_attempt_at = ? WHERE id = ?""",
+                    retry,
+                    tx=tx
+                )
+            if failed:
+                await self.db.execute_many(
+                    """UPDATE outbox SET status = 'failed', attempts = attempts + 1,
+                    last_error = ? WHERE id = ?""",
+                    failed,
+                    tx=tx
+                )
+
+    async def get_finished_batches(self) -> List[dict]:
+        """已全部发送结束但还未发送汇总的批次"""
+        return await self.db.execute_query(
+            """SELECT b.* FROM outbox_batch b
+            WHERE b.finished_at IS NULL AND NOT EXISTS (
+                SELECT 1 FROM outbox o
+                WHERE o.batch_id = b.batch_id AND o.status IN ('pending', 'sending')
+            )"""
+        )
+
+    async def get_batch_messages(self, batch_id: str) -> List[dict]:
+        return await self.db.execute_query(
+            "SELECT target_id, status, attempts, last_error FROM outbox WHERE batch_id = ?",
+            (batch_id,)
+        )
+
+    async def mark_batch_finished(self, batch_id: str, tx: Optional[Transaction] = None):
+        await self.db.execute_write(
+            "UPDATE outbox_batch SET finished_at = CURRENT_TIMESTAMP WHERE batch_id = ?",
+            (batch_id,),
+            tx=tx
+        )
+
+    async def purge_sent(self, days: int = 7):
+        """清理days天前已发送的消息"""
+        await self.db.execute_write(
+            "DELETE FROM outbox WHERE status = 'sent' AND sent_at < datetime('now', ? || ' days')",
+            (f"-{days}",)
+        )
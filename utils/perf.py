@@ -0,0 +1,174 @@
+import time
+from bisect import bisect_left
+from typing import Dict, List, Optional, Tuple
+
+from nonebot.matcher import Matcher, current_matcher
+from nonebot.typing import T_State
+
+# 直方图桶的上界（毫秒），最后一个桶收纳所有更慢的样本
+BUCKET_BOUNDS_MS = (
+    0.1, 0.2, 0.3, 0.5, 0.75, 1, 1.5, 2, 3, 5, 7.5, 10, 15, 20, 30, 50, 75, 100,
+    150, 200, 300, 500, 750, 1000, 1500, 2000, 3000, 5000, 7500, 10000, float("inf")
+)
+
+
+def matcher_key(matcher: Matcher) -> str:
+    """事件响应器的标识：所在模块和定义的行号"""
+    source = matcher._source
+    if source is not None and source.lineno is not None:
+        return f"{matcher.module_name}:{source.lineno}"
+    return f"{matcher.module_name}:{type(matcher).__name__}"
+
+
+class LatencyHistogram:
+    """固定分桶的延迟直方图
+
+    记录一个样本只需一次二分查找和几次加法，不保存样本本身；
+    分位数按样本在桶内均匀分布估算，误差不超过所在桶的宽度
+    """
+
+    __slots__ = ("buckets", "count", "total", "max")
+
+    def __init__(self):
+        self.buckets = [0] * len(BUCKET_BOUNDS_MS)
+        self.count = 0
+        self.total = 0.0    # 毫秒
+        self.max = 0.0      # 毫秒
+
+    def observe(self, seconds: float):
+        ms = seconds * 1000
+        self.buckets[bisect_left(BUCKET_BOUNDS_MS, ms)] += 1
+        self.count += 1
+        self.total += ms
+        if ms > self.max:
+            self.max = ms
+
+    def percentile(self, p: float) -> float:
+        """第p百分位的估计值（毫秒）"""
+        if not self.count:
+            return 0.0
+        rank = p / 100 * self.count
+        seen = 0
+        lower = 0.0
+        for bound, n in zip(BUCKET_BOUNDS_MS, self.buckets):
+            if n and seen + n >= rank:
+                # 在桶内按线性分布插值
+                upper = min(bound, self.max)
+                return lower + (upper - lower) * (rank - seen) / n
+            seen += n
+            lower = bound
+        return self.max
+
+    @property
+    def mean(self) -> float:
+        return self.total / self.count if self.count else 0.0
+
+
+class MatcherStats:
+    """一个事件响应器（或插件）的耗时统计：总耗时、其中的数据库耗时和API耗时"""
+
+    __slots__ = ("wall", "db", "api", "errors")
+
+    def __init__(self):
+        self.wall = LatencyHistogram()
+        self.db = LatencyHistogram()
+        self.api = LatencyHistogram()
+        self.errors = 0
+
+
+class Span:
+    """一次事件响应器运行期间累计的耗时"""
+
+    __slots__ = ("key", "plugin", "start", "db", "api", "api_calls")
+
+    def __init__(self, key: str, plugin: str):
+        self.key = key
+        self.plugin = plugin
+        self.start = time.perf_counter()
+        self.db = 0.0
+        self.api = 0.0
+        self.api_calls: Dict[int, float] = {}   # id(调用参数) -> 开始时间
+
+
+# Span保存在事件响应器的state中：运行前处理器由NoneBot在单独的任务中执行，
+# 在那里设置的ContextVar传不到事件响应器，而state是同一个字典
+SPAN_KEY = "_perf_span"
+
+
+def current_span() -> Optional[Span]:
+    """当前正在运行的事件响应器的Span，不在事件响应器中时返回None"""
+    try:
+        matcher = current_matcher.get()
+    except LookupError:
+        return None
+    return matcher.state.get(SPAN_KEY)
+
+
+class PerfRegistry:
+    """按事件响应器和插件汇总的耗时统计"""
+
+    def __init__(self):
+        self.matchers: Dict[str, MatcherStats] = {}
+        self.plugins: Dict[str, MatcherStats] = {}
+        self.since = time.time()
+
+    def begin(self, state: T_State, key: str, plugin: str):
+        state[SPAN_KEY] = Span(key, plugin)
+
+    def end(self, state: T_State, error: bool = False):
+        span = state.pop(SPAN_KEY, None)
+        if span is None:
+            return
+        wall = time.perf_counter() - span.start
+        for stats in (self._stats(self.matchers, span.key), self._stats(self.plugins, span.plugin)):
+            stats.wall.observe(wall)
+            stats.db.observe(span.db)
+            stats.api.observe(span.api)
+            if error:
+                stats.errors += 1
+
+    @staticmethod
+    def _stats(table: Dict[str, MatcherStats], key: str) -> MatcherStats:
+        stats = table.get(key)
+        if stats is None:
+            stats = table[key] = MatcherStats()
+        return stats
+
+    @staticmethod
+    def add_db_time(kind: str, seconds: float):
+        """数据库耗时监听器，见DatabaseManager.timing_listeners"""
+        span = current_span()
+        if span is not None:
+            span.db += seconds
+
+    @staticmethod
+    def api_started(data: dict):
+        span = current_span()
+        if span is not None:
+            span.api_calls[id(data)] = time.perf_counter()
+
+    @staticmethod
+    def api_finished(data: dict):
+        span = current_span()
+        if span is not None:
+            start = span.api_calls.pop(id(data), None)
+            if start is not None:
+                span.api += time.perf_counter() - start
+
+    def top(self, n: int, by: str = "p99", plugins: bool = False) -> List[Tuple[str, MatcherStats]]:
+        """按总耗时的分位数（p50/p95/p99）或平均值（mean）从慢到快排序"""
+        table = self.plugins if plugins else self.matchers
+        if by == "mean":
+            key = lambda item: item[1].wall.mean
+        else:
+            p = float(by.lstrip("p"))
+            key = lambda item: item[1].wall.percentile(p)
+        return sorted(table.items(), key=key, reverse=True)[:n]
+
+    def reset(self):
+        self.matchers.clear()
+        self.plugins.clear()
+        self.since = time.time()
+
+
+perf_registry = PerfRegistry()
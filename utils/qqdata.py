@@ -1,5 +1,21 @@
+import asyncio
+from typing import Iterable, Optional
+
+import numpy as np
 from nonebot import Bot
-from dataclasses import dataclass
+from nonebot.adapters import Event
+from dataclasses import dataclass, field
+
+from utils.cache import TTLCache
+
+# 各接口的缓存：最大条目数、过期时间（秒）
+# 群列表、群信息、群成员信息会在收到对应的群通知事件时主动失效，见invalidate_by_notice
+_group_list_cache = TTLCache(maxsize=16, ttl=300)
+_group_info_cache = TTLCache(maxsize=2048, ttl=300)
+_member_info_cache = TTLCache(maxsize=16384, ttl=600)
+_stranger_info_cache = TTLCache(maxsize=4096, ttl=1800)
+# 群成员列存表，收到成员变动通知和群消息时增量更新，过期后整表重新拉取
+_member_table_cache = TTLCache(maxsize=64, ttl=3600)
 
 
 @dataclass
@@ -9,34 +25,46 @@ class GroupInfo:
     member_count: int
     max_member_count: int
 
-async def ApiGetGroupInfo(bot: Bot, group) -> GroupInfo:
+async def ApiGetGroupInfo(bot: Bot, group, use_cache: bool = True) -> GroupInfo:
     if not bot:
         raise Exception("bot为空，请检查传入参数")
     if isinstance(group, str):
         group = str(group)
-    data = await bot.call_api("get_group_info", group_id=group)
-    retdata = GroupInfo(
-        data["group_id"],
-        data["group_name"],
-        data["member_count"],
-        data["max_member_count"]
-    )
-    return retdata
 
-async def ApiGetGroupList(bot: Bot) -> list[GroupInfo]:
+    async def load() -> GroupInfo:
+        data = await bot.call_api("get_group_info", group_id=group)
+        return GroupInfo(
+            data["group_id"],
+            data["group_name"],
+            data["member_count"],
+            data["max_member_count"]
+        )
+
+    if not use_cache:
+        return await load()
+    return await _group_info_cache.get_or_load((bot.self_id, int(group)), load)
+
+async def ApiGetGroupList(bot: Bot, use_cache: bool = True) -> list[GroupInfo]:
     if not bot:
         raise Exception("bot为空，请检查传入参数")
-    retdata = []
-    groups = await bot.call_api("get_group_list")
-    for group in groups:
-        data = GroupInfo(
-            group["group_id"],
-            group["group_name"],
-            group["member_count"],
-            group["max_member_count"]
-        )
-        retdata.append(data)
-    return retdata
+
+    async def load() -> list[GroupInfo]:
+        retdata = []
+        groups = await bot.call_api("get_group_list")
+        for group in groups:
+            data = GroupInfo(
+                group["group_id"],
+                group["group_name"],
+                group["member_count"],
+                group["max_member_count"]
+            )
+            retdata.append(data)
+        return retdata
+
+    if not use_cache:
+        return await load()
+    # 返回副本，调用方修改列表不影响缓存
+    return list(await _group_list_cache.get_or_load((bot.self_id,), load))
 
 
 @dataclass
@@ -54,41 +82,268 @@ class GroupMemberInfo:
     role: str               # 成员角色，owner/admin/member
     title: str              # 专属头衔
 
-async def ApiGetGroupMemberInfo(bot: Bot, group, user) -> GroupMemberInfo:
+async def ApiGetGroupMemberInfo(bot: Bot, group, user, use_cache: bool = True) -> GroupMemberInfo:
     if not bot:
         raise Exception("bot为空，请检查传入参数")
     if isinstance(group, str):
         group = str(group)
     if isinstance(user, str):
         user = str(user)
-    data = await bot.call_api("get_group_member_info", group_id=group, user_id=user)
-    retdata = GroupMemberInfo(
+
+    async def load() -> GroupMemberInfo:
+        data = await bot.call_api("get_group_member_info", group_id=group, user_id=user)
+        return _member_from_data(data)
+
+    if not use_cache:
+        return await load()
+    return await _member_info_cache.get_or_load((bot.self_id, int(group), int(user)), load)
+
+def _member_from_data(data: dict) -> GroupMemberInfo:
+    # 成员列表接口返回的字段可能不全（如area、title），缺失时使用默认值
+    return GroupMemberInfo(
         data["group_id"],
         data["user_id"],
-        data["nickname"],
-        data["card"],
-        data["sex"],
-        data["age"],
-        data["area"],
-        data["join_time"],
-        data["last_sent_time"],
-        data["level"],
-        data["role"],
-        data["title"],
+        data.get("nickname", ""),
+        data.get("card", ""),
+        data.get("sex", "unknown"),
+        data.get("age", 0),
+        data.get("area", ""),
+        data.get("join_time", 0),
+        data.get("last_sent_time", 0),
+        data.get("level", ""),
+        data.get("role", "member"),
+        data.get("title", ""),
     )
-    return retdata
 
-async def ApiGetGroupMemberList(bot: Bot, group) -> list:
+async def ApiGetGroupMemberList(bot: Bot, group) -> list[GroupMemberInfo]:
+    """获取群成员列表，直接使用列表接口返回的数据，只调用一次API"""
     if not bot:
         raise Exception("bot为空，请检查传入参数")
     if isinstance(group, str):
         group = str(group)
     members = await bot.call_api("get_group_member_list", group_id=group)
-    retdata = []
-    for member in members:
-        info = await ApiGetGroupMemberInfo(bot, member["group_id"], member["user_id"])
-        retdata.append(info)
-    return retdata
+    return [_member_from_data(member) for member in members]
+
+
+@dataclass
+class GroupMemberListResult:
+    members: list[GroupMemberInfo]                                  # 成员信息，补充失败的成员保留列表接口的数据
+    errors: dict[int, Exception] = field(default_factory=dict)      # 补充失败的成员QQ号 -> 异常
+
+async def ApiGetGroupMemberListEnriched(bot: Bot, group, concurrency: int = 8) -> GroupMemberListResult:
+    """获取群成员列表，并逐个调用get_group_member_info刷新成员信息
+
+    最多同时进行concurrency个请求，单个成员失败不影响其他成员
+    """
+    members = await ApiGetGroupMemberList(bot, group)
+    result = GroupMemberListResult(members)
+    semaphore = asyncio.Semaphore(concurrency)
+
+    async def enrich(index: int, member: GroupMemberInfo):
+        async with semaphore:
+            try:
+                result.members[index] = await ApiGetGroupMemberInfo(
+                    bot, member.group_id, member.user_id, use_cache=False
+                )
+                _member_info_cache.set((bot.self_id, int(member.group_id), int(member.user_id)),
+                                       result.members[index])
+            except Exception as e:
+                result.errors[member.user_id] = e
+
+    await asyncio.gather(*(enrich(i, member) for i, member in enumerate(members)))
+    return result
+
+
+# 成员角色编码，按权限从低到高
+MEMBER_ROLES = ["member", "admin", "owner"]
+_ROLE_CODES = {role: code for code, role in enumerate(MEMBER_ROLES)}
+
+
+class GroupMemberTable:
+    """按列存储的群成员表
+
+    每个成员只保存QQ号、加群时间、最后发言时间、角色编码和等级编码，
+    存放在NumPy数组中，用于大群上的批量筛选（如30天未发言的成员）。
+    需要单个成员时用row()取得GroupMemberRow视图
+    """
+
+    def __init__(self, group_id: int, capacity: int = 64):
+        self.group_id = group_id
+        self._size = 0
+        self._user_id = np.zeros(capacity, dtype=np.int64)
+        self._join_time = np.zeros(capacity, dtype=np.int64)
+        self._last_sent_time = np.zeros(capacity, dtype=np.int64)
+        self._role = np.zeros(capacity, dtype=np.int8)
+        self._level = np.zeros(capacity, dtype=np.int16)
+        self._levels: list[str] = [""]                 # 等级编码 -> 等级字符串
+        self._level_codes: dict[str, int] = {"": 0}
+        self._index: dict[int, int] = {}                # QQ号 -> 行号
+
+    @classmethod
+    def from_members(cls, group_id: int, members: Iterable[GroupMemberInfo]) -> "GroupMemberTable":
+        members = list(members)
+        table = cls(group_id, capacity=max(len(members), 64))
+        for member in members:
+            table.upsert(member.user_id, member.join_time, member.last_sent_time, member.role, member.level)
+        return table
+
+    def __len__(self) -> int:
+        return self._size
+
+    def __contains__(self, user_id: int) -> bool:
+        return int(user_id) in self._index
+
+    # 列（只读视图，长度为当前成员数）
+    @property
+    def user_id(self) -> np.ndarray:
+        return self._user_id[:self._size]
+
+    @property
+    def join_time(self) -> np.ndarray:
+        return self._join_time[:self._size]
+
+    @property
+    def last_sent_time(self) -> np.ndarray:
+        return self._last_sent_time[:self._size]
+
+    @property
+    def role(self) -> np.ndarray:
+        return self._role[:self._size]
+
+    def row(self, user_id: int) -> Optional["GroupMemberRow"]:
+        user_id = int(user_id)
+        return GroupMemberRow(self, user_id) if user_id in self._index else None
+
+    # 增量更新
+    def upsert(self, user_id: int, join_time: int = 0, last_sent_time: int = 0,
+               role: str = "member", level: str = ""):
+        user_id = int(user_id)
+        index = self._index.get(user_id)
+        if index is None:
+            if self._size == len(self._user_id):
+                self._grow()
+            index = self._size
+            self._size += 1
+            self._index[user_id] = index
+            self._user_id[index] = user_id
+        self._join_time[index] = join_time or 0
+        self._last_sent_time[index] = last_sent_time or 0
+        self._role[index] = _ROLE_CODES.get(role, 0)
+        self._level[index] = self._level_code(level or "")
+
+    def remove(self, user_id: int):
+        """删除成员，用最后一行填补空位"""
+        index = self._index.pop(int(user_id), None)
+        if index is None:
+            return
+        last = self._size - 1
+        if index != last:
+            for column in (self._user_id, self._join_time, self._last_sent_time, self._role, self._level):
+                column[index] = column[last]
+            self._index[int(self._user_id[index])] = index
+        self._size = last
+
+    def touch(self, user_id: int, timestamp: int):
+        """更新最后发言时间"""
+        index = self._index.get(int(user_id))
+        if index is not None:
+            self._last_sent_time[index] = timestamp
+
+    def set_role(self, user_id: int, role: str):
+        index = self._index.get(int(user_id))
+        if index is not None:
+            self._role[index] = _ROLE_CODES.get(role, 0)
+
+    # 筛选，返回布尔掩码，可以用&、|组合后传给user_ids
+    def inactive_since(self, timestamp: int) -> np.ndarray:
+        return self.last_sent_time < timestamp
+
+    def joined_after(self, timestamp: int) -> np.ndarray:
+        return self.join_time > timestamp
+
+    def role_is(self, role: str) -> np.ndarray:
+        return self.role == _ROLE_CODES.get(role, -1)
+
+    def user_ids(self, mask: Optional[np.ndarray] = None) -> np.ndarray:
+        return self.user_id.copy() if mask is None else self.user_id[mask]
+
+    def _grow(self):
+        capacity = len(self._user_id) * 2
+        for name in ("_user_id", "_join_time", "_last_sent_time", "_role", "_level"):
+            column = getattr(self, name)
+            grown = np.zeros(capacity, dtype=column.dtype)
+            grown[:self._size] = column[:self._size]
+            setattr(self, name, grown)
+
+    def _level_code(self, level: str) -> int:
+        code = self._level_codes.get(level)
+        if code is None:
+            code = len(self._levels)
+            self._levels.append(level)
+            self._level_codes[level] = code
+        return code
+
+
+class GroupMemberRow:
+    """GroupMemberTable中单个成员的视图，读取时按QQ号定位，表被修改后依然有效
+
+    成员退群（被移出表）后present为False，此时读取属性会抛出LookupError
+    """
+    __slots__ = ("_table", "user_id")
+
+    def __init__(self, table: GroupMemberTable, user_id: int):
+        self._table = table
+        self.user_id = user_id
+
+    @property
+    def present(self) -> bool:
+        return self.user_id in self._table._index
+
+    def _get(self, column: np.ndarray) -> int:
+        index = self._table._index.get(self.user_id)
+        if index is None:
+            raise LookupError(f"成员{self.user_id}已不在群{self._table.group_id}的成员表中")
+        return int(column[index])
+
+    @property
+    def join_time(self) -> int:
+        return self._get(self._table._join_time)
+
+    @property
+    def last_sent_time(self) -> int:
+        return self._get(self._table._last_sent_time)
+
+    @property
+    def role(self) -> str:
+        return MEMBER_ROLES[self._get(self._table._role)]
+
+    @property
+    def level(self) -> str:
+        return self._table._levels[self._get(self._table._level)]
+
+    def __repr__(self) -> str:
+        if not self.present:
+            return f"GroupMemberRow(user_id={self.user_id}, present=False)"
+        return f"GroupMemberRow(user_id={self.user_id}, role={self.role}, level={self.level!r}, " \
+               f"join_time={self.join_time}, last_sent_time={self.last_sent_time})"
+
+
+async def ApiGetGroupMemberTable(bot: Bot, group, use_cache: bool = True) -> GroupMemberTable:
+    """获取群成员列存表，缓存期间通过通知事件和群消息增量更新"""
+    async def load() -> GroupMemberTable:
+        members = await ApiGetGroupMemberList(bot, group)
+        return GroupMemberTable.from_members(int(group), members)
+
+    if not use_cache:
+        return await load()
+    return await _member_table_cache.get_or_load((bot.self_id, int(group)), load)
+
+
+def touch_group_member(self_id: str, group_id: int, user_id: int, timestamp: int):
+    """群消息到达时更新已缓存成员表中的最后发言时间"""
+    table = _member_table_cache.get((str(self_id), int(group_id)))
+    if table is not None:
+        table.touch(user_id, timestamp)
 
 
 @dataclass
@@ -98,16 +353,84 @@ class StrangerInfo:
     sex: str
     age: int
 
-async def ApiGetStrangerInfo(bot: Bot, user) -> StrangerInfo:
+async def ApiGetStrangerInfo(bot: Bot, user, use_cache: bool = True) -> StrangerInfo:
     if not bot:
         raise Exception("bot为空，请检查传入参数")
     if isinstance(user, str):
         user = str(user)
-    info = await bot.call_api("get_stranger_info", user_id=user)
-    retdata = StrangerInfo(
-        info["user_id"],
-        info["nickname"],
-        info["sex"],
-        info["age"]
-    )
-    return retdata
\ No newline at end of file
+
+    async def load() -> StrangerInfo:
+        info = await bot.call_api("get_stranger_info", user_id=user)
+        return StrangerInfo(
+            info["user_id"],
+            info["nickname"],
+            info["sex"],
+            info["age"]
+        )
+
+    if not use_cache:
+        return await load()
+    return await _stranger_info_cache.get_or_load((bot.self_id, int(user)), load)
+
+
+# 缓存失效
+def invalidate_group_cache(self_id: str = None, group_id: int = None, user_id: int = None):
+    """清除缓存
+
+    只传self_id时清除该bot的全部缓存；传group_id时清除该群的群信息、群成员信息以及群列表；
+    同时传user_id时只清除该成员的信息。什么都不传时清除所有缓存
+    """
+    caches = (_group_list_cache, _group_info_cache, _member_info_cache, _stranger_info_cache, _member_table_cache)
+    if self_id is None:
+        for cache in caches:
+            cache.invalidate()
+        return
+    if group_id is None:
+        for cache in caches:
+            cache.invalidate(lambda key: key[0] == self_id)
+        return
+    group_id = int(group_id)
+    if user_id is not None:
+        user_id = int(user_id)
+        _member_info_cache.invalidate(lambda key: key == (self_id, group_id, user_id))
+        return
+    _group_list_cache.invalidate(lambda key: key[0] == self_id)
+    _group_info_cache.invalidate(lambda key: key == (self_id, group_id))
+    _member_info_cache.invalidate(lambda key: key[0] == self_id and key[1] == group_id)
+    _member_table_cache.invalidate(lambda key: key == (self_id, group_id))
+
+
+def invalidate_by_notice(event: Event):
+    """根据群通知事件清除受影响的缓存、增量更新成员表，由内核插件在收到通知事件时调用"""
+    notice_type = getattr(event, "notice_type", None)
+    group_id = getattr(event, "group_id", None)
+    if notice_type is None or group_id is None:
+        return
+    self_id = str(event.self_id)
+    user_id = getattr(event, "user_id", None)
+    sub_type = getattr(event, "sub_type", None)
+
+    if notice_type in ("group_increase", "group_decrease"):
+        if sub_type == "kick_me" or str(user_id) == self_id:
+            # bot进群、退群或被踢，整个群的缓存和群列表都失效
+            invalidate_group_cache(self_id, group_id)
+            return
+        # 只清除该成员的信息并增量更新成员表，群列表和群信息中的成员数等缓存过期后再刷新
+        if user_id is None:
+            return
+        invalidate_group_cache(self_id, group_id, user_id)
+        table = _member_table_cache.get((self_id, int(group_id)))
+        if table is not None:
+            if notice_type == "group_increase":
+                table.upsert(user_id, join_time=getattr(event, "time", 0))
+            else:
+                table.remove(user_id)
+    elif notice_type in ("group_admin", "group_card") and user_id is not None:
+        invalidate_group_cache(self_id, group_id, user_id)
+        table = _member_table_cache.get((self_id, int(group_id)))
+        if table is not None and notice_type == "group_admin":
+            table.set_role(user_id, "admin" if sub_type == "set" else "member")
+    elif notice_type == "group_name" or sub_type == "group_name":
+        # 群名变更不是OneBot v11标准事件，部分实现会以group_name上报
+        _group_list_cache.invalidate(lambda key: key[0] == self_id)
+        _group_info_cache.invalidate(lambda key: key == (self_id, int(group_id)))
\ No newline at end of file
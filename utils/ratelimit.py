@@ -0,0 +1,35 @@
+import asyncio
+import time
+
+
+class TokenBucket:
+    """令牌桶限速器
+
+    每秒补充rate个令牌，最多积攒capacity个。acquire按调用顺序排队，
+    令牌不足时等待，用来把发送速率压在对端允许的范围内
+    """
+
+    def __init__(self, rate: float, capacity: float = 1):
+        if rate <= 0:
+            raise ValueError(f"令牌桶的速率必须大于0，当前为{rate}")
+        if capacity < 1:
+            raise ValueError(f"令牌桶的容量不能小于1，当前为{capacity}")
+        self.rate = rate
+        self.capacity = capacity
+        self._tokens = self.capacity
+        self._updated = time.monotonic()
+        self._lock = asyncio.Lock()
+
+    def _refill(self):
+        now = time.monotonic()
+        self._tokens = min(self.capacity, self._tokens + (now - self._updated) * self.rate)
+        self._updated = now
+
+    async def acquire(self, tokens: float = 1):
+        async with self._lock:
+            while True:
+                self._refill()
+                if self._tokens >= tokens:
+                    self._tokens -= tokens
+                    return
+                await asyncio.sleep((tokens - self._tokens) / self.rate)
@@ -0,0 +1,145 @@
+import asyncio
+import sys
+import threading
+import time
+import traceback
+from collections import deque
+from pathlib import Path
+from types import FrameType
+from typing import Deque, List, Optional
+
+from nonebot import logger
+from nonebot.matcher import Matcher
+
+from .perf import LatencyHistogram, matcher_key
+
+PROJECT_ROOT = Path(__file__).parent.parent.resolve()
+
+
+class StallReport:
+    """一次事件循环阻塞的记录"""
+
+    __slots__ = ("started", "duration", "matcher", "plugin", "site", "stack")
+
+    def __init__(self, started: float, matcher: Optional[str], plugin: Optional[str],
+                 site: Optional[str], stack: List[str]):
+        self.started = started          # 阻塞开始的时间戳
+        self.duration: Optional[float] = None  # 阻塞时长（秒），事件循环恢复后填入
+        self.matcher = matcher          # 阻塞时正在运行的事件响应器
+        self.plugin = plugin
+        self.site = site                # 调用栈中最内层的本项目代码位置
+        self.stack = stack
+
+
+class LoopWatchdog:
+    """事件循环延迟监视器
+
+    事件循环中的心跳任务每interval秒记录一次时间，并把实际间隔超出interval的部分作为延迟记入直方图；
+    监视线程发现心跳超过threshold秒没有更新时，说明事件循环正被同步调用阻塞，
+    此时抓取事件循环线程的调用栈，从中找出正在运行的事件响应器和本项目的代码位置并记录日志
+    """
+
+    def __init__(self, threshold: float = 0.5, interval: float = 0.1, max_reports: int = 20):
+        self.threshold = threshold
+        self.interval = interval
+        self.lag = LatencyHistogram()
+        self.stalls = 0
+        self.reports: Deque[StallReport] = deque(maxlen=max_reports)
+        self._beat = 0.0
+        self._reported_beat = 0.0
+        self._loop_thread: Optional[int] = None
+        self._task: Optional[asyncio.Task] = None
+        self._thread: Optional[threading.Thread] = None
+        self._stopped = threading.Event()
+
+    @property
+    def running(self) -> bool:
+        return self._task is not None and not self._task.done()
+
+    def start(self):
+        if self.running:
+            return
+        self._loop_thread = threading.get_ident()
+        self._beat = time.monotonic()
+        self._stopped.clear()
+        self._task = asyncio.get_running_loop().create_task(self._heartbeat())
+        self._thread = threading.Thread(target=self._watch, name="loop-watchdog", daemon=True)
+        self._thread.start()
+
+    async def stop(self):
+        self._stopped.set()
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+        if self._thread is not None:
+            await asyncio.to_thread(self._thread.join, 1)
+            self._thread = None
+
+    async def _heartbeat(self):
+        while True:
+            start = time.monotonic()
+            await asyncio.sleep(self.interval)
+            self._beat = now = time.monotonic()
+            lag = max(now - start - self.interval, 0.0)
+            self.lag.observe(lag)
+            if lag >= self.threshold:
+                self.stalls += 1
+                report = self.reports[-1] if self.reports else None
+                if report is not None and report.duration is None:
+                    report.duration = lag
+                    logger.warning(
+                        f"事件循环阻塞了{lag * 1000:.0f}ms，"
+                        f"事件响应器：{report.matcher or '无'}，位置：{report.site or '未知'}"
+                    )
+                else:
+                    logger.warning(f"事件循环阻塞了{lag * 1000:.0f}ms")
+
+    def _watch(self):
+        while not self._stopped.wait(self.interval):
+            beat = self._beat
+            if beat == self._reported_beat or time.monotonic() - beat < self.interval + self.threshold:
+                continue
+            # 同一次阻塞只记录一次
+            self._reported_beat = beat
+            frame = sys._current_frames().get(self._loop_thread)
+            if frame is None:
+                continue
+            report = self._capture(frame, time.time() - (time.monotonic() - beat))
+            self.reports.append(report)
+            logger.warning(
+                f"事件循环已阻塞超过{self.threshold * 1000:.0f}ms，"
+                f"事件响应器：{report.matcher or '无'}，位置：{report.site or '未知'}，调用栈：\n"
+                + "".join(report.stack)
+            )
+
+    @staticmethod
+    def _capture(frame: FrameType, started: float) -> StallReport:
+        stack = traceback.format_stack(frame)
+        matcher = None
+        site = None
+        current: Optional[FrameType] = frame
+        # 从最内层向外查找：第一个本项目的代码位置，以及第一个Matcher实例（Matcher.run中的self）
+        while current is not None and (matcher is None or site is None):
+            if site is None:
+                path = Path(current.f_code.co_filename)
+                if PROJECT_ROOT in path.parents and "site-packages" not in path.parts:
+                    site = f"{path.relative_to(PROJECT_ROOT)}:{current.f_lineno}"
+            if matcher is None:
+                candidate = current.f_locals.get("self")
+                if isinstance(candidate, Matcher):
+                    matcher = candidate
+            current = current.f_back
+        return StallReport(
+            started=started,
+            matcher=matcher_key(matcher) if matcher is not None else None,
+            plugin=matcher.plugin_name if matcher is not None else None,
+            site=site,
+            stack=stack,
+        )
+
+
+loop_watchdog = LoopWatchdog()